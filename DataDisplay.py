@@ -10,301 +10,350 @@
 # -*- coding: utf-8 -*-
 
 from tkinter import *
-import pandas as pd
-import numpy
+import argparse
+import importlib
 import os
+import queue
 import threading
 import time
+import traceback
 
-pd.options.mode.chained_assignment = None  # Stop chained assignment warnings - I know what I'm doing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from alert_heatmap import AlertHeatmap
+from startup_snapshot import SNAPSHOT_PATH, Snapshot, SnapshotWriter, read_snapshot
+
+# Startup times are measured from here. pandas, numpy and everything built on them are only imported once the window
+# is shown, by load_session() and the functions it lets run.
+LAUNCHED = time.perf_counter()
 
 DEFAULT_DATA_PATH = os.path.join('CSVs', 'default_data.csv')
 ROOM_SENSOR_PATH = os.path.join('CSVs', 'ahs_air.csv')
 SAVED_DATA_PATH = os.path.join('CSVs', 'ahs_air_data.csv')
-HOSTNAME = '10.12.4.98'
+SESSION_ARCHIVE_PATH = os.path.join('CSVs', 'session_archive')
+HOSTNAME = '10.12.4.98'  # Gateway of the facilities missing from CSVs/gateways.csv
 PORT = '8000'
+LEGACY_FACILITY = 'ahs'  # Facility of the saved data and emergency files of single-building versions
+MAX_SESSION_READINGS = 1000000
+SHARED_SESSION_READINGS = 10000  # Readings kept for the chart to catch up on when they are shared by a collector
+UI_PUMP_INTERVAL = 50  # Milliseconds between drains of the UI event queue
+UI_FRAME_BUDGET = 0.010  # Seconds of event handling allowed per drain
+CHART_WINDOW = 8 * 60 * 60  # Seconds of history on the trend chart
+CHART_WIDTH = 900  # Pixels
+CHART_HEIGHT = 220  # Pixels
+ALL_ROOMS = 'All rooms'
+MAX_LISTED_ALERTS = 8
+UPDATED_FORMAT = "%m/%d/%Y %H:%M"  # readings_store.DATE_FORMAT, which cannot be imported before pandas
+
+# Modules the Tk thread needs once the session is loaded, imported by load_session() so it never waits on them
+DEFERRED_MODULES = ['adaptive_polling', 'async_polling', 'prefetch', 'request_manager', 'trend_chart']
+
+UI_REFRESH_SECONDS = metrics.histogram('ui_refresh_seconds', 'Seconds to refresh the displayed summary')
+UI_CLICK_TO_RENDER_SECONDS = metrics.histogram('ui_click_to_render_seconds',
+                                               'Seconds from a selection change to its summary being shown')
+DISPLAY_CACHE_LOOKUPS = metrics.counter('display_cache_lookups_total',
+                                        'Summaries looked up by the display, by where they were found')
+CSV_READ_SECONDS = metrics.histogram('csv_read_seconds', 'Seconds to read a CSV file, by file')
+STARTUP_SECONDS = metrics.histogram('startup_seconds',
+                                    'Seconds from launch to the window being shown and to the readings being loaded')
+
+parser = argparse.ArgumentParser(description='Display live air data for Andover High School.')
+parser.add_argument('--facility', default=None,
+                    help='facility to display (default: the first one of the room sensor file)')
+parser.add_argument('--collector-output', default=None,
+                    help='display the readings a running collector.py writes to this directory, '
+                         'instead of polling the gateway')
+parser.add_argument('--shared-readings', action='store_true',
+                    help='with --collector-output, read the latest readings in place from the memory-mapped file of a '
+                         'collector running on this machine with --shared-readings, instead of from its archive')
+parser.add_argument('--collector-url', default=None,
+                    help='display the readings a running collector.py pushes from its read API at this URL, '
+                         'such as http://server:8080, instead of polling the gateway')
+parser.add_argument('--batch-size', type=int, default=1,
+                    help='sensors read per gateway request, for gateways that support batch reads; others are '
+                         'detected and read one sensor per request (default: 1)')
+parser.add_argument('--metrics-file', default=None,
+                    help='collect performance metrics and write them to this JSON file periodically')
+parser.add_argument('--alert-log', default=None, help='append raised and cleared alerts to this file')
+parser.add_argument('--alert-webhook', default=None, help='post raised and cleared alerts as JSON to this URL')
+options, unknown_args = parser.parse_known_args()
+polls_gateway = options.collector_output is None and options.collector_url is None
+metrics_dumper = metrics.MetricsDumper(options.metrics_file) if options.metrics_file is not None else None
+
+# Summaries of the archive and of the emergency file, loaded in the background on first use
+archived_aggregates = {}
+default_aggregates = None
+fallback_loader = ThreadPoolExecutor(max_workers=1)
+fallbacks_loading = set()
+
+# Workers only publish to this queue, the Tk event loop drains it
+ui_events = queue.Queue()
+metrics.gauge('ui_event_queue_depth', 'Events waiting for the display to handle them', ui_events.qsize)
+
+# Time of the latest selection change not yet rendered, and the latest click-to-render latencies, in seconds
+pending_click = None
+render_latencies = deque(maxlen=1000)
+
+# (floor, wing, room, measurement column) shown on the trend chart, and the session sequence number it is up to
+chart_selection = None
+chart_sequence = None
+
+# Version of the alert engine shown by the heatmap
+alerts_version = None
+
+# Set by load_session() in the background once the window is shown, and by finish_startup() once it is done
+registry = None
+hostname, port = HOSTNAME, PORT
+archive = None
+rollups = None
+alert_engine = None
+session = None
+shared_readings = None
+snapshot_writer = None
+background_thread = None
+chart = None
+
+
+def read_layout():
+    # Read spreadsheet into the sensor registry, keeping the rooms of the displayed facility.
+    # Each row contains the following:
+    #   - Location
+    #   - Facility
+    #   - Instance ID of CO2 sensor
+    #   - Instance ID of temperature sensor
+    from sensor_registry import SensorRegistry
+
+    facilities = SensorRegistry(ROOM_SENSOR_PATH).facilities()
+    displayed = options.facility if options.facility is not None else facilities[0]
+    if displayed not in facilities:
+        print('Error:\nNo rooms of facility ' + displayed + ' in ' + ROOM_SENSOR_PATH + '!\nShutting down program...')
+        raise SystemExit(1)
+    return Snapshot.from_registry(SensorRegistry(ROOM_SENSOR_PATH, facility=displayed), facilities)
+
+
+def open_session():
+    # The heavy imports, the archive and the session, as the options ask for
+    global registry, hostname, port, archive, rollups, alert_engine, session, shared_readings, snapshot_writer
+    import pandas as pd
+    from alerts import AlertEngine, AlertNotifier, LogFileSink, WebhookSink, load_rules
+    from collector import SessionData
+    from facilities import facility_archive_path, load_gateways
+    from rollups import Rollups
+    from sensor_registry import SensorRegistry
+    from session_persistence import SessionArchive, migrate
+    from shared_readings import SHARED_READINGS_FILE, SharedReadings
+
+    for module in DEFERRED_MODULES:
+        importlib.import_module(module)
+    pd.options.mode.chained_assignment = None  # Stop chained assignment warnings - I know what I'm doing
+
+    registry = SensorRegistry(ROOM_SENSOR_PATH, facility=facility)
+    hostname, port = load_gateways().get(facility, (HOSTNAME, PORT))
+
+    # Alerts are evaluated on every batch of readings, and only sent anywhere if asked to
+    alert_sinks = []
+    if options.alert_log is not None:
+        alert_sinks.append(LogFileSink(options.alert_log))
+    if options.alert_webhook is not None:
+        alert_sinks.append(WebhookSink(options.alert_webhook))
+    alert_engine = AlertEngine(load_rules(), notifier=AlertNotifier(alert_sinks) if alert_sinks else None,
+                               facility=facility)
+
+    if polls_gateway:
+        # Readings of every session, with the output file of older versions copied in on first run
+        archive_path = facility_archive_path(SESSION_ARCHIVE_PATH, facility, snapshot.facilities)
+        if facility == LEGACY_FACILITY and not os.path.isdir(archive_path) and os.path.isfile(SAVED_DATA_PATH):
+            print('Copying ' + SAVED_DATA_PATH + ' into ' + archive_path + '... please wait')
+            migrate([SAVED_DATA_PATH], archive_path)
+        archive = SessionArchive(archive_path)
+
+        # Rolls the archive up into 5-minute, hourly and daily tiers, pruning old raw readings
+        rollups = Rollups(archive)
+        rollup_thread = threading.Thread(target=rollups.run, args=())
+        rollup_thread.daemon = True  # Daemonize thread
+        rollup_thread.start()
+
+        # Readings of the current session, and the summaries of their latest values
+        session = SessionData(archive, max_rows=MAX_SESSION_READINGS, alerts=alert_engine, facility=facility)
+    elif options.collector_url is None:
+        # The collector archives the readings, so they are only kept in memory here
+        archive = SessionArchive(facility_archive_path(options.collector_output, facility, snapshot.facilities),
+                                 read_only=True)
+        rollups = Rollups(archive)  # Only queried, the collector rolls its archive up
+        if options.shared_readings:
+            # The summaries are read in place and the chart history from the archive, so only the readings the
+            # chart has yet to add are kept here, for it and the alerts
+            shared_readings = SharedReadings(os.path.join(archive.directory, SHARED_READINGS_FILE))
+            session = SessionData(None, max_rows=SHARED_SESSION_READINGS, alerts=alert_engine, facility=facility)
+        else:
+            session = SessionData(None, max_rows=MAX_SESSION_READINGS, alerts=alert_engine, facility=facility)
+    else:
+        # The collector pushes its readings as they come in, and answers history queries for the chart
+        session = SessionData(None, max_rows=MAX_SESSION_READINGS, alerts=alert_engine, facility=facility)
 
-request_thread = None
-air_values = None
-
-background_data_update = True
-
-
-def save_data():
-    if air_values is not None:
-        print('Saving session data... please wait')
-        air_values.to_csv(SAVED_DATA_PATH)
+    # The summaries shown are saved for the next launch as they change
+    snapshot_writer = SnapshotWriter(SNAPSHOT_PATH, ROOM_SENSOR_PATH, snapshot)
 
 
-def stop():
-    import sys
-    save_data()
-    sys.exit()
+def open_live_session():
+    # Poll the gateway into a session kept only in memory, when the archive or collector could not be opened
+    global polls_gateway, registry, hostname, port, archive, rollups, session, shared_readings, snapshot_writer
+    from collector import SessionData
+    from facilities import load_gateways
+    from sensor_registry import SensorRegistry
 
+    polls_gateway = True
+    archive = rollups = shared_readings = None
+    if registry is None:
+        registry = SensorRegistry(ROOM_SENSOR_PATH, facility=facility)
+        hostname, port = load_gateways().get(facility, (HOSTNAME, PORT))
+    session = SessionData(None, max_rows=MAX_SESSION_READINGS, alerts=alert_engine, facility=facility)
+    if snapshot_writer is None:
+        snapshot_writer = SnapshotWriter(SNAPSHOT_PATH, ROOM_SENSOR_PATH, snapshot)
 
-def get_air_value_df(hostname, port, selected_room, req_thread):
-    df_dictionary = {
-        'Date / Time': [],
-        'Room': [],
-        'Temperature': [],
-        'Temperature Units': [],
-        'CO2 Level': [],
-        'CO2 Units': [],
-        'Floor': [],
-        'Wing': []
-    }
-
-    if req_thread.stopped():
-        return None
 
+def load_session():
+    # Runs on a thread of its own once the window is shown, falling back to live polling if loading fails
     try:
-        import argparse
-        from bacnet_gateway_requests import get_value_and_units
-        import datetime as dt
-
-        # Read spreadsheet into a DataFrame.
-        # Each row contains the following:
-        #   - Location
-        #   - Instance ID of CO2 sensor
-        #   - Instance ID of temperature sensor
-        if not os.path.isfile(ROOM_SENSOR_PATH):
-            print('Error:\nCouldn\'t find ' + ROOM_SENSOR_PATH + '!\nShutting down program...')
-            root.destroy()
-
-        df = pd.read_csv(ROOM_SENSOR_PATH, na_filter=False, comment='#')
-        if req_thread.stopped():
-            return None
-
-        chosen_room = df['Label'] == selected_room
-        if req_thread.stopped():
-            return None
-        filtered_room = df[chosen_room]
-        if req_thread.stopped():
-            return None
-
+        open_session()
+    except Exception as error:
+        traceback.print_exc()
+        ui_events.put(('error', 'Could not load the session: {0}'.format(error)))
         try:
-            for row_index, row in filtered_room.iterrows():
-                # Retrieve data
-                temp_value, temp_units = get_value_and_units(row['Facility'], row['Temperature'], hostname, port)
-                if req_thread.stopped():
-                    return None
-                co2_value, co2_units = get_value_and_units(row['Facility'], row['CO2'], hostname, port)
-                if req_thread.stopped():
-                    return None
-
-                # Prepare to print
-                temp_value = round(int(temp_value)) if temp_value else ''
-                temp_units = temp_units.replace('deg ', '°') if temp_units else ''
-                co2_value = round(int(co2_value)) if co2_value else ''
-                co2_units = co2_units if co2_units else ''
-
-                if req_thread.stopped():
-                    return None
-
-                # Update dictionary
-                df_dictionary['Date / Time'].append(dt.datetime.now().strftime("%m/%d/%Y %H:%M"))
-                if req_thread.stopped():
-                    return None
-                df_dictionary['Room'].append(row['Label'])
-                if req_thread.stopped():
-                    return None
-                df_dictionary['Temperature'].append(temp_value)
-                if req_thread.stopped():
-                    return None
-                df_dictionary['Temperature Units'].append(temp_units)
-                if req_thread.stopped():
-                    return None
-                df_dictionary['CO2 Level'].append(co2_value)
-                if req_thread.stopped():
-                    return None
-                df_dictionary['CO2 Units'].append(co2_units)
-                if req_thread.stopped():
-                    return None
-                df_dictionary['Floor'].append(row['Floor'])
-                if req_thread.stopped():
-                    return None
-                df_dictionary['Wing'].append(row['Wing'])
-                if req_thread.stopped():
-                    return None
-
-                break
-
-            if req_thread.stopped():
-                return None
-
-            return pd.DataFrame.from_dict(df_dictionary)
-
-        except KeyboardInterrupt:
-            stop()
-
-    except KeyboardInterrupt:
-        stop()
-
-
-def get_air_values_df(hostname, port, selected_floor, selected_wing, background_updater):
-    df_dictionary = {
-        'Date / Time': [],
-        'Room': [],
-        'Temperature': [],
-        'Temperature Units': [],
-        'CO2 Level': [],
-        'CO2 Units': [],
-        'Floor': [],
-        'Wing': []
-    }
-
-    try:
-        import argparse
-        from bacnet_gateway_requests import get_value_and_units
-        import datetime as dt
-
-        # Read spreadsheet into a DataFrame.
-        # Each row contains the following:
-        #   - Location
-        #   - Instance ID of CO2 sensor
-        #   - Instance ID of temperature sensor
-        if not os.path.isfile(ROOM_SENSOR_PATH):
-            print('Error:\nCouldn\'t find ' + ROOM_SENSOR_PATH + '!\nShutting down program...')
-            root.destroy()
-
-        df = pd.read_csv(ROOM_SENSOR_PATH, na_filter=False, comment='#')
-
-        matching_floor = df['Floor'] == str(selected_floor)
-        matching_wing = df['Wing'] == selected_wing
-
-        filtered_rooms = df[matching_floor & matching_wing]
-
-        # Iterate over the rows of the DataFrame, getting temperature and CO2 values for each location
-        for row_index, row in filtered_rooms.iterrows():
-            while True:
-                if background_updater and not background_data_update:
-                    time.sleep(5)
-                    continue
-                else:
-                    try:
-                        # Retrieve data
-                        temp_value, temp_units = get_value_and_units(row['Facility'], row['Temperature'], hostname,
-                                                                     port)
-                        co2_value, co2_units = get_value_and_units(row['Facility'], row['CO2'], hostname, port)
-
-                        # Prepare to print
-                        temp_value = round(int(temp_value)) if temp_value else ''
-                        temp_units = temp_units.replace('deg ', '°') if temp_units else ''
-                        co2_value = round(int(co2_value)) if co2_value else ''
-                        co2_units = co2_units if co2_units else ''
-
-                        # Update dictionary
-                        df_dictionary['Date / Time'].append(dt.datetime.now().strftime("%m/%d/%Y %H:%M"))
-                        df_dictionary['Room'].append(row['Label'])
-                        df_dictionary['Temperature'].append(temp_value)
-                        df_dictionary['Temperature Units'].append(temp_units)
-                        df_dictionary['CO2 Level'].append(co2_value)
-                        df_dictionary['CO2 Units'].append(co2_units)
-                        df_dictionary['Floor'].append(row['Floor'])
-                        df_dictionary['Wing'].append(row['Wing'])
-
-                        break
-
-                    except KeyboardInterrupt:
-                        stop()
-
-        return pd.DataFrame.from_dict(df_dictionary)
-    except KeyboardInterrupt:
-        stop()
+            open_live_session()
+        except Exception as live_error:
+            traceback.print_exc()
+            ui_events.put(('error', 'Could not poll the gateway either: {0}'.format(live_error)))
+            return
+        ui_events.put(('error', 'Showing live readings only, without history'))
+    ui_events.put('ready')
 
 
-def update_loaded_data(updated_df):
-    global air_values
-    air_values = updated_df
-    if air_values is not None:
-        air_values['Wing'] = air_values['Wing'].to_string()
-        fill_fields(floor.get(), str(wing.get()), measurement.get())
+def finish_startup():
+    # Runs on the Tk thread once load_session() is done: start reading, then show what needed the session
+    global background_thread, chart
+    from trend_chart import TrendChart
 
+    chart_placeholder.destroy()
+    chart = TrendChart(root, width=CHART_WIDTH, height=CHART_HEIGHT, window=CHART_WINDOW)
+    chart.canvas.grid(row=updated_row + 2, column=0, columnspan=len(COLUMN_TITLES), padx=10, pady=(0, 20))
 
-def add_to_cache(new_data_df):
-    global air_values
-    if air_values is None:
-        air_values = new_data_df
+    if polls_gateway:
+        background_thread = BACnetThread()
+    elif shared_readings is not None:
+        background_thread = SharedReadingsThread()
+    elif options.collector_url is None:
+        background_thread = FollowerThread(archive.directory)
     else:
-        air_values = pd.concat([air_values, new_data_df], ignore_index=True)
-
-    if air_values is not None:
-        if air_values['Floor'].dtype != numpy.float64:
-            air_values['Floor'] = air_values['Floor'].astype(str).astype(int)
-        fill_fields(floor.get(), str(wing.get()), measurement.get())
-
-
-class RequestThread(threading.Thread):
-    """Thread class with a stop() method. The thread itself has to check
-    regularly for the stopped() condition."""
+        background_thread = StreamThread(options.collector_url)
+    fill_fields(floor.get(), str(wing.get()), measurement.get())
+    update_room_menu()
+    show_chart()
+    update_alerts()
 
-    def __init__(self, selected_floor, selected_wing):
-        super(RequestThread, self).__init__()
-        self._stop_event = threading.Event()
-        self.selected_floor = selected_floor
-        self.selected_wing = selected_wing
+    ready = time.perf_counter() - LAUNCHED
+    STARTUP_SECONDS.observe(ready, stage='ready')
+    print('Readings loaded {0:.0f} ms after launch'.format(ready * 1000))
 
-        req_thread = threading.Thread(target=self.request_data, args=())
-        req_thread.daemon = True  # Daemonize thread
-        req_thread.start()  # Start the execution
 
-    def stop(self):
-        self._stop_event.set()
+# The floors, wings and rooms of the facility, and the summaries shown when it was last closed. They come from the
+# snapshot of the last run unless the room sensor file changed since, so the window can be shown straight away.
+if not os.path.isfile(ROOM_SENSOR_PATH):
+    print('Error:\nCouldn\'t find ' + ROOM_SENSOR_PATH + '!\nShutting down program...')
+    raise SystemExit(1)
+snapshot = read_snapshot(SNAPSHOT_PATH, ROOM_SENSOR_PATH, options.facility)
+if snapshot is None:
+    snapshot = read_layout()
+facility = snapshot.facility
 
-    def stopped(self):
-        return self._stop_event.is_set()
 
-    def request_data(self):
-        global background_data_update
-        background_data_update = False
+def save_data():
+    if render_latencies:
+        latencies = sorted(render_latencies)
+        print('Click-to-render latency: median {0:.1f} ms, max {1:.1f} ms over {2} clicks'.format(
+            latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000, len(latencies)))
+    if polls_gateway and background_thread is not None:
+        print('Requests: {completed} completed, {cancelled} cancelled, {deduplicated} deduplicated, '
+              '{failed} failed'.format(**background_thread.requests.metrics()))
+    if session is not None:
+        print('Saving session data... please wait')
+        session.close()
+        if snapshot_writer is not None:
+            snapshot_writer.update(live_aggregates(), force=True)
+        if alert_engine is not None and alert_engine.notifier is not None:
+            alert_engine.notifier.close()
+    if metrics_dumper is not None:
+        metrics_dumper.dump()
+
+
+def get_default_aggregates():
+    # The emergency file never changes, so it is only summarized once
+    global default_aggregates
+    import pandas as pd
+    from air_aggregates import AggregateCache
+    from readings_store import air_df_columns, air_df_to_readings
+
+    if default_aggregates is None:
+        aggregates = AggregateCache()
+        if facility == LEGACY_FACILITY and os.path.isfile(DEFAULT_DATA_PATH):
+            with CSV_READ_SECONDS.time(file='default_data'):
+                default_data = pd.read_csv(DEFAULT_DATA_PATH, index_col=0, na_filter=False)
+            aggregates.update(air_df_to_readings(default_data), air_df_columns(default_data)[1])
+        default_aggregates = aggregates
+    return default_aggregates
+
+
+def get_archived_aggregates(selected_floor, selected_wing):
+    # Only the selected floor and wing are read from the archive, once per session
+    from air_aggregates import AggregateCache
+
+    aggregates = archived_aggregates.get((selected_floor, selected_wing))
+    if aggregates is None:
+        aggregates = AggregateCache()
+        if archive is not None:
+            aggregates.update(archive.latest([(selected_floor, selected_wing)]), archive.units)
+        archived_aggregates[(selected_floor, selected_wing)] = aggregates
+    return aggregates
+
+
+def load_fallbacks(selected_floor, selected_wing):
+    # Runs on the fallback loader, so the file reads never block the display
+    get_archived_aggregates(selected_floor, selected_wing)
+    get_default_aggregates()
+    ui_events.put('refresh')
+
+
+def get_fallback_aggregates(selected_floor, selected_wing):
+    """ Get the archive and emergency file summaries of a floor and wing, if they have been loaded
+    :rtype: list
+    :return: The summaries to try in order, or None while they are being loaded in the background
+    """
+    archived = archived_aggregates.get((selected_floor, selected_wing))
+    if archived is None or default_aggregates is None:
+        if (selected_floor, selected_wing) not in fallbacks_loading:
+            fallbacks_loading.add((selected_floor, selected_wing))
+            fallback_loader.submit(load_fallbacks, selected_floor, selected_wing)
+        return None
+    return [archived, default_aggregates]
 
-        if not os.path.isfile(ROOM_SENSOR_PATH):
-            print('Error:\nCouldn\'t find ' + ROOM_SENSOR_PATH + '!\nShutting down program...')
-            root.destroy()
 
-        rooms = pd.read_csv(ROOM_SENSOR_PATH, na_filter=False, comment='#')
-        if self.stopped():
-            background_data_update = True
-            return
-        matching_floor = rooms['Floor'] == str(self.selected_floor)
-        if self.stopped():
-            background_data_update = True
-            return
-        matching_wing = rooms['Wing'] == self.selected_wing
-        if self.stopped():
-            background_data_update = True
-            return
+def stop():
+    import sys
+    save_data()
+    sys.exit()
 
-        rooms = rooms[matching_floor & matching_wing]
-        if self.stopped():
-            background_data_update = True
-            return
 
-        if self.stopped():
-            background_data_update = True
-            return
+def live_aggregates():
+    # Summaries of the readings coming in, read in place when a collector on this machine shares them
+    return session.aggregates if shared_readings is None else shared_readings
 
-        data_df = None
-        if self.stopped():
-            background_data_update = True
-            return
 
-        for row_index, row in rooms.iterrows():
-            if not self.stopped():
-                df = get_air_value_df(HOSTNAME, PORT, row['Label'], self)
-                if df is None:
-                    self.stop()
-                    continue
-                data_df = pd.concat([data_df, df], ignore_index=True) if data_df is not None else df
-                time.sleep(1)
-            else:
-                background_data_update = True
-                return
-        add_to_cache(data_df)
-        if self.stopped():
-            background_data_update = True
-            return
-        background_data_update = True
+def update_loaded_data(updated_df):
+    if updated_df is not None and not updated_df.empty:
+        snapshot_writer.update(live_aggregates())
+        ui_events.put('refresh')
 
 
 class BACnetThread(object):
@@ -313,210 +362,415 @@ class BACnetThread(object):
     until the application exits.
     """
 
-    def __init__(self, interval=10):
+    def __init__(self, interval=10, concurrency=None):
         """ Constructor
         :type interval: int
         :param interval: Check interval, in seconds
+        :type concurrency: int
+        :param concurrency: Maximum number of gateway requests in flight at once, None for DEFAULT_CONCURRENCY
         """
+        from adaptive_polling import AdaptiveScheduler
+        from async_polling import AsyncPoller, DEFAULT_CONCURRENCY
+        from collector import Collector
+        from prefetch import PrefetchScheduler
+        from request_manager import RequestManager
+
+        concurrency = DEFAULT_CONCURRENCY if concurrency is None else concurrency
         self.interval = interval
-        self.used_combos = None
-        self.updated_values = None
+        self.collector = Collector(session, registry,
+                                   AsyncPoller(hostname, port, concurrency=concurrency, batch_size=options.batch_size),
+                                   interval=interval)
+        self.collector.listeners.append(update_loaded_data)
 
-        thread = threading.Thread(target=self.run, args=())
+        # Reads of single floors and wings, shared by the prefetcher and the selection
+        self.requests = RequestManager(self.collector)
+
+        # Warms every floor and wing, the selected one first, then polls each sensor as often as it changes
+        self.prefetcher = PrefetchScheduler(self.collector, interval=interval,
+                                            refresher=AdaptiveScheduler(self.collector, initial_period=interval),
+                                            requests=self.requests)
+        self.prefetcher.focus(floor.get(), str(wing.get()))
+
+        thread = threading.Thread(target=self.prefetcher.run, args=())
         thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def focus(self, selected_floor, selected_wing):
+        self.prefetcher.focus(selected_floor, selected_wing)
+
+    def request(self, selected_floor, selected_wing):
+        # Only the latest selection is worth waiting for
+        self.requests.cancel_all(keep=(int(selected_floor), str(selected_wing)))
+        self.requests.request(selected_floor, selected_wing)
 
-    def run(self):
-        """ Method that runs forever """
-        while True:
-            # Updates the already-requested rooms
-            if air_values is not None:
-                # Find which floor-wing combinations have been used so far
-                self.used_combos = air_values.groupby(
-                    ['Wing', 'Floor']).size().reset_index()
 
-                for row_index, row in self.used_combos.iterrows():
-                    if row['Floor'] == '' and row['Wing'] == '':
-                        self.used_combos.drop(row_index)
-                        continue
-                    df = get_air_values_df(HOSTNAME, PORT, row['Floor'], row['Wing'], True)
-                    self.updated_values = pd.concat([self.updated_values, df],
-                                                    ignore_index=True) if self.updated_values is not None else df
-                    time.sleep(1)
+class FollowerThread(object):
+    """
+    Displays the readings of a running collector instead of polling the
+    gateway. The run() method will be started and it will run in the
+    background until the application exits.
+    """
 
-                update_loaded_data(self.updated_values)
+    def __init__(self, directory, interval=10):
+        """ Constructor
+        :type directory: str
+        :param directory: Output directory of the collector for the displayed facility
+        :type interval: int
+        :param interval: Check interval, in seconds
+        """
+        from collector import ArchiveFollower
 
-                self.updated_values = None
+        self.follower = ArchiveFollower(session, directory, interval=interval)
+        self.follower.listeners.append(update_loaded_data)
 
-            time.sleep(self.interval)
+        thread = threading.Thread(target=self.follower.run, args=())
+        thread.daemon = True  # Daemonize thread
+        thread.start()
 
 
-class BACnetThread(object):
+class SharedReadingsThread(object):
     """
-    The run() method will be started and it will run in the background
-    until the application exits.
+    Displays the readings a collector on this machine shares in memory,
+    instead of polling the gateway. The run() method will be started and it
+    will run in the background until the application exits.
     """
 
-    def __init__(self, interval=10):
+    def __init__(self, interval=1):
         """ Constructor
         :type interval: int
         :param interval: Check interval, in seconds
         """
         self.interval = interval
-        self.used_combos = None
-        self.updated_values = None
-
         thread = threading.Thread(target=self.run, args=())
         thread.daemon = True  # Daemonize thread
         thread.start()
 
     def run(self):
         """ Method that runs forever """
-        while True:
-            # Updates the already-requested rooms
-            if air_values is not None:
-                # Find which floor-wing combinations have been used so far
-                self.used_combos = air_values.groupby(
-                    ['Wing', 'Floor']).size().reset_index()
+        global shared_readings
+        from shared_readings import SharedReadings
 
-                for row_index, row in self.used_combos.iterrows():
-                    if row['Floor'] == '' and row['Wing'] == '':
-                        self.used_combos.drop(row_index)
-                        continue
-                    df = get_air_values_df(HOSTNAME, PORT, row['Floor'], row['Wing'], True)
-                    self.updated_values = pd.concat([self.updated_values, df],
-                                                    ignore_index=True) if self.updated_values is not None else df
+        sequence = None
+        timestamps = None
+        while True:
+            if shared_readings.replaced():
+                # The collector was restarted
+                shared_readings.close()
+                shared_readings = SharedReadings(shared_readings.path)
+                sequence = timestamps = None
+            if shared_readings.sequence != sequence:
+                # Only the rooms read since are copied out, into a capped session, to keep the chart and the
+                # alerts going
+                sequence = shared_readings.sequence
+                columns, timestamps = shared_readings.read_since(timestamps)
+                if columns['rooms']:
+                    start = session.readings.sequence
+                    session.record_columns(columns, shared_readings.units, archive=False)
+                    update_loaded_data(session.readings.since(start)[0])
+            time.sleep(self.interval)
 
-                update_loaded_data(self.updated_values)
 
-                self.updated_values = None
+class StreamThread(object):
+    """
+    Displays the readings a running collector pushes from its read API
+    instead of polling the gateway. The run() method will be started and it
+    will run in the background until the application exits.
+    """
 
-            time.sleep(self.interval)
+    def __init__(self, url):
+        """ Constructor
+        :type url: str
+        :param url: Base URL of the collector's read API
+        """
+        from reading_stream import StreamFollower
 
+        self.follower = StreamFollower(session, url, facility=facility)
+        self.follower.listeners.append(update_loaded_data)
 
-thread = BACnetThread()
+        thread = threading.Thread(target=self.follower.run, args=())
+        thread.daemon = True  # Daemonize thread
+        thread.start()
 
 
 def update_labels(avg_measure, max_measure, max_measure_room, unit, data_timestamp):
+    global pending_click
     row_labels[0].config(text="Data last updated at: {0} EST".format(data_timestamp))
     row_labels[1].config(text=(str(round(avg_measure, 2)) + ' ' + str(unit)))
     row_labels[2].config(text=(str(round(max_measure, 2)) + ' ' + str(unit)))
     row_labels[3].config(text=str(max_measure_room))
 
+    if pending_click is not None:
+        render_latencies.append(time.perf_counter() - pending_click)
+        UI_CLICK_TO_RENDER_SECONDS.observe(render_latencies[-1])
+        pending_click = None
+
+
+def show_load_error(message):
+    # In the title bar, where it stays while the display carries on, and in place of the chart until there is one
+    print(message)
+    root.title('{0} Air Data - {1}'.format(facility.upper(), message))
+    if chart is None:
+        chart_placeholder.itemconfigure(placeholder_text, text=message, fill='Red')
+
+
+def pump_events():
+    # Drain what the workers have published, within the frame budget, then render once
+    deadline = time.perf_counter() + UI_FRAME_BUDGET
+    refresh = False
+    chart_history = None
+    while time.perf_counter() < deadline:
+        try:
+            event = ui_events.get_nowait()
+        except queue.Empty:
+            break
+        if event == 'refresh':
+            refresh = True
+        elif event == 'ready':
+            finish_startup()
+        elif event[0] == 'error':
+            show_load_error(event[1])
+        elif event[0] == 'chart' and event[1] == chart_selection:
+            chart_history = event
+
+    if refresh:
+        fill_fields(floor.get(), str(wing.get()), measurement.get())
+        update_alerts()
+    if chart_history is not None:
+        plot_chart(*chart_history[2:])
+    if refresh or chart_history is not None:
+        update_chart()
+    root.after(UI_PUMP_INTERVAL, pump_events)
+
+
+def select_chart_rows(frame, selection):
+    selected_floor, selected_wing, selected_room, measurement_column = selection
+    rows = frame[(frame['Floor'] == selected_floor) & (frame['Wing'] == selected_wing)]
+    if selected_room != ALL_ROOMS:
+        rows = rows[rows['Room'].astype(str) == selected_room]
+    return rows
+
+
+def load_chart(selection):
+    # Runs on the fallback loader: the selection's history from the archive rollups, about one bucket per pixel
+    import numpy
+    import pandas as pd
+    import requests
+    from rollups import ROLLUP_COLUMNS, local_now
+
+    sequence = session.readings.sequence
+    measurement_column = selection[3]
+    start, resolution = local_now() - CHART_WINDOW, CHART_WINDOW / chart.plot_width
+    if rollups is not None:
+        history = rollups.query([selection[:2]], start=start, resolution=resolution)
+    elif polls_gateway:
+        history = pd.DataFrame({column: numpy.empty(0) for column in ROLLUP_COLUMNS})  # No archive to read from
+    else:
+        # Asked of the collector, whose archive it is
+        try:
+            history = background_thread.follower.history(selection[:2], start, resolution)
+        except (requests.RequestException, ValueError) as error:
+            print('Could not load the chart history: ' + str(error))
+            return
+    history = select_chart_rows(history, selection)
+
+    # The mean of the rooms in each bucket, weighted by their number of readings
+    counts = history[measurement_column + ' Count'].to_numpy()
+    totals = numpy.nan_to_num(history[measurement_column + ' Mean'].to_numpy(dtype=numpy.float64)) * counts
+    buckets = pd.DataFrame({'Timestamp': history['Timestamp'].to_numpy(), 'Total': totals, 'Count': counts})
+    buckets = buckets.groupby('Timestamp').sum()
+    buckets = buckets[buckets['Count'] > 0]
+    ui_events.put(('chart', selection, buckets.index.to_numpy(), (buckets['Total'] / buckets['Count']).to_numpy(),
+                   sequence))
+
+
+def plot_chart(timestamps, values, sequence):
+    global chart_sequence
+    selected_floor, selected_wing, selected_room, measurement_column = chart_selection
+    if selected_room == ALL_ROOMS:
+        title = '{0} floor, {1} wing: {2}'.format(floor_name(selected_floor), selected_wing, measurement_column)
+    else:
+        title = 'Room {0}: {1}'.format(selected_room, measurement_column)
+    units = session.readings.units.get(measurement_column, '')
+    if not units and archive is not None:
+        units = archive.units.get(measurement_column, '')
+    chart.plot(timestamps, values, title, units)
+    chart_sequence = sequence
+
+
+def update_chart():
+    # Add what the session recorded since, as the mean of the rooms read at each minute
+    global chart_sequence
+    if chart_sequence is None:
+        return
+    readings, chart_sequence = session.readings.since(chart_sequence)
+    means = select_chart_rows(readings, chart_selection).groupby('Timestamp')[chart_selection[3]].mean()
+    chart.extend(means.index.to_numpy(), means.to_numpy())
+
+
+def show_chart():
+    # The history of the selection is loaded in the background, then the chart follows the session
+    global chart_selection, chart_sequence
+    if chart is None:
+        return  # Shown once the session is loaded
+    measurement_column = 'CO2 Level' if measurement.get() == 0 else 'Temperature'
+    chart_selection = (floor.get(), str(wing.get()), room.get(), measurement_column)
+    chart_sequence = None
+    fallback_loader.submit(load_chart, chart_selection)
+
+
+def show_alerts():
+    # List the alerts raised on the selected floor and wing
+    if alert_engine is None:
+        return
+    units = session.readings.units
+    alerts = alert_engine.active((floor.get(), str(wing.get())))
+    if not alerts:
+        alert_label.config(text='No alerts on this floor and wing', fg='Black')
+        return
+    lines = ['Room {0}: {1} ({2:g} {3} since {4})'.format(alert.room, alert.rule, round(alert.value, 1),
+                                                         units.get(alert.measurement, ''),
+                                                         time.strftime('%H:%M', time.gmtime(alert.since)))
+             for alert in alerts[:MAX_LISTED_ALERTS]]
+    if len(alerts) > MAX_LISTED_ALERTS:
+        lines.append('...and {0} more'.format(len(alerts) - MAX_LISTED_ALERTS))
+    alert_label.config(text='\n'.join(lines), fg='Red')
+
+
+def update_alerts():
+    # Recolor the heatmap and the list only when an alert was raised or cleared
+    global alerts_version
+    if alert_engine is None or alert_engine.version == alerts_version:
+        return
+    alerts_version = alert_engine.version
+    heatmap.update(alert_engine.active_counts())
+    show_alerts()
+
+
+def select_alert_cell(selected_floor, selected_wing):
+    floor.set(selected_floor)
+    wing.set(selected_wing)
+    set_floor()
+
 
 def fill_fields(selected_floor, selected_wing, selected_measurement):
-    enough_info = False
     measurement_column = 'CO2 Level' if selected_measurement == 0 else 'Temperature'
-    unit_column = 'CO2 Units' if selected_measurement == 0 else 'Temperature Units'
-
-    selected_df = None
-    global request_thread
-
-    # Check if the session cache has data, request the data otherwise
-    if air_values is not None:
-        matching_floor = air_values['Floor'] == selected_floor
-        matching_wing = air_values['Wing'] == selected_wing
-        filtered_rooms = air_values[matching_floor & matching_wing]
-        if len(filtered_rooms) >= 1 and len(filtered_rooms[measurement_column]) != 0:
-            # The session cache has non-empty data for the wing
-            enough_info = True
-            selected_df = air_values
+
+    with UI_REFRESH_SECONDS.time():
+        if background_thread is None:
+            # Still loading, only the snapshot of the last run can be shown
+            aggregates, source = snapshot, 'snapshot'
+            aggregate = snapshot.get(selected_floor, selected_wing, measurement_column)
         else:
-            if request_thread is None:
-                request_thread = RequestThread(selected_floor, selected_wing)
-                request_thread.start()
+            # Check if the session cache has data, request the data otherwise
+            if polls_gateway:
+                background_thread.focus(selected_floor, selected_wing)
+            aggregates = live_aggregates()
+            aggregate = aggregates.get(selected_floor, selected_wing, measurement_column)
+            source = 'session'
+            if aggregate is None and polls_gateway and not aggregates.was_read(selected_floor, selected_wing):
+                background_thread.request(selected_floor, selected_wing)
+
+        # Check the snapshot of the last run and the output file from the last session, then fallback to an
+        # emergency file
+        if aggregate is None:
+            fallbacks = [snapshot]
+            if background_thread is not None:
+                fallbacks += get_fallback_aggregates(selected_floor, selected_wing) or []
+            for source, aggregates in zip(['snapshot', 'archive', 'default'], fallbacks):
+                aggregate = aggregates.get(selected_floor, selected_wing, measurement_column)
+                if aggregate is not None:
+                    break
             else:
-                request_thread.stop()
-                request_thread.join()
-                request_thread = RequestThread(selected_floor, selected_wing)
-                request_thread.start()
+                source = 'miss'
+        DISPLAY_CACHE_LOOKUPS.inc(source=source)
 
-    else:
-        if request_thread is None:
-            request_thread = RequestThread(selected_floor, selected_wing)
-            request_thread.start()
-        else:
-            request_thread.stop()
-            request_thread.join()
-            request_thread = RequestThread(selected_floor, selected_wing)
-            request_thread.start()
-
-    # Check if the output file from the last session has data
-
-    if not enough_info:
-        if os.path.isfile(SAVED_DATA_PATH):
-            df = pd.read_csv(SAVED_DATA_PATH, index_col=0)
-            if len(df[(df['Floor'] == selected_floor) & (df['Wing'] == selected_wing)]) >= 1 and len(
-                    df[measurement_column]) != 0:
-                # The session cache has non-empty data for the wing
-                enough_info = True
-                selected_df = df
-
-    # Fallback to an emergency file
-    if not enough_info:
-        if os.path.isfile(DEFAULT_DATA_PATH):
-            df = pd.read_csv(DEFAULT_DATA_PATH, index_col=0)
-            if len(df[(df['Floor'] == selected_floor) & (df['Wing'] == selected_wing)]) >= 1 and len(
-                    df[measurement_column]) != 0:
-                enough_info = True
-                selected_df = df
-
-    if enough_info:
-
-        matching_floor = selected_df['Floor'] == selected_floor
-        matching_wing = selected_df['Wing'] == selected_wing
-
-        filtered_rooms = selected_df[matching_floor & matching_wing]
-
-        if not filtered_rooms.empty:
-            filtered_rooms[measurement_column] = pd.to_numeric(filtered_rooms[measurement_column], errors='coerce')
-            filtered_rooms[unit_column] = filtered_rooms[unit_column].astype(str)
-
-        for row_index, row in filtered_rooms[measurement_column].iteritems():
-            if filtered_rooms[unit_column].get(row_index) == '' or filtered_rooms[unit_column].get(row_index) == 'nan':
-                continue
-            unit = filtered_rooms[unit_column].get(row_index)
-            break
+        if aggregate is not None:
+            unit = aggregates.units.get(measurement_column, '')
+            data_timestamp = time.strftime(UPDATED_FORMAT, time.gmtime(aggregate.timestamp))
+
+            update_labels(aggregate.mean, aggregate.maximum, aggregate.maximum_room, unit, data_timestamp)
 
-        avg_measure = filtered_rooms[measurement_column].mean()
 
-        max_measure = 0
-        max_measure_room = 'None'
+def floor_name(floor_number):
+    # Ordinal shown on a floor's radio button, e.g. 1st or 12th
+    if floor_number % 100 in (11, 12, 13):
+        return str(floor_number) + 'th'
+    return str(floor_number) + {1: 'st', 2: 'nd', 3: 'rd'}.get(floor_number % 10, 'th')
 
-        for row_index, row in filtered_rooms.iterrows():
-            if row[measurement_column] > max_measure:
-                max_measure = row[measurement_column]
-                max_measure_room = row['Room']
 
-        data_timestamp = filtered_rooms['Date / Time'].get(filtered_rooms['Date / Time'].last_valid_index())
+def floor_wings(selected_floor):
+    return [combo_wing for combo_floor, combo_wing in snapshot.combos() if combo_floor == selected_floor]
 
-        update_labels(avg_measure, max_measure, max_measure_room, unit, data_timestamp)
 
+# The floors and wings offered are the ones the facility has in the room sensor file
+FLOOR_NUMBERS = sorted(set(combo_floor for combo_floor, combo_wing in snapshot.combos()))
+WING_LETTERS = sorted(set(combo_wing for combo_floor, combo_wing in snapshot.combos()))
 
 root = Tk()
-root.title("AHS Air Data")
+root.title("{0} Air Data".format(facility.upper()))
 root.configure(background='white')
 root.resizable(False, False)
 
-wing = StringVar(root, value='A')  # The selected wing
-floor = IntVar(root, value=1)  # The selected floor
+wing = StringVar(root, value=floor_wings(FLOOR_NUMBERS[0])[0])  # The selected wing
+floor = IntVar(root, value=FLOOR_NUMBERS[0])  # The selected floor
 measurement = IntVar(root, value=1)  # The selected measurement
+room = StringVar(root, value=ALL_ROOMS)  # The room charted, or all of the floor and wing
+
+
+def update_room_menu():
+    # Offer the rooms of the selected floor and wing
+    menu = room_menu['menu']
+    menu.delete(0, 'end')
+    if registry is None:
+        labels = snapshot.rooms.get((floor.get(), str(wing.get())), [])
+    else:
+        labels = sorted(registry.rooms_in(floor.get(), str(wing.get()))['Label'].astype(str))
+    for label in [ALL_ROOMS] + labels:
+        menu.add_command(label=label, command=lambda label=label: set_room(label))
+    room.set(ALL_ROOMS)
+
+
+def set_room(label):
+    room.set(label)
+    show_chart()
 
 
 def set_wing():
+    global pending_click
+    pending_click = time.perf_counter()
     fill_fields(floor.get(), str(wing.get()), measurement.get())
+    update_room_menu()
+    show_chart()
+    show_alerts()
 
 
-def set_floor():
-    for radio_index in range(1, len(wing_radios)):
-        if floor.get() == 1:
-            wing_radios[radio_index].grid_remove()
+def show_wings():
+    # Only offer the wings of the selected floor, moving the selection onto one of them if needed
+    wings_on_floor = floor_wings(floor.get())
+    for wing_letter, wing_radio in zip(WING_LETTERS, wing_radios):
+        if wing_letter in wings_on_floor:
+            wing_radio.grid()
         else:
-            wing_radios[radio_index].grid()
+            wing_radio.grid_remove()
+    if wings_on_floor and wing.get() not in wings_on_floor:
+        wing.set(wings_on_floor[0])
+
+
+def set_floor():
+    global pending_click
+    pending_click = time.perf_counter()
+    show_wings()
     fill_fields(floor.get(), str(wing.get()), measurement.get())
+    update_room_menu()
+    show_chart()
+    show_alerts()
 
 
 def set_measurement():
+    global pending_click
+    pending_click = time.perf_counter()
     fill_fields(floor.get(), str(wing.get()), measurement.get())
+    show_chart()
 
 
 # Setup table layout
@@ -532,17 +786,15 @@ for col in COLUMN_TITLES:
 
     # Add floor options
     if col_number == 0:
-        FLOOR_NAMES = ['1st', '2nd', '3rd']
         current_row = 1
 
-        for floor_name in FLOOR_NAMES:
-            Radiobutton(text=floor_name, fg="Black", bg="White", variable=floor, value=int(floor_name[0]),
+        for floor_number in FLOOR_NUMBERS:
+            Radiobutton(text=floor_name(floor_number), fg="Black", bg="White", variable=floor, value=floor_number,
                         command=set_floor).grid(row=current_row, column=col_number, sticky='we')
             current_row += 1
 
     # Add wing options
     elif col_number == 1:
-        WING_LETTERS = ['A', 'B', 'C', 'D']
         current_row = 1
         for index, wing_letter in enumerate(WING_LETTERS):
             if index == len(WING_LETTERS) - 1:
@@ -560,7 +812,8 @@ for col in COLUMN_TITLES:
 
         row_label = Label(bg="White", fg="Blue", relief=FLAT, text="Data last updated at: 1/1/1970 00:00")
         row_labels.append(row_label)
-        row_label.grid(row=current_row, column=0, columnspan=len(COLUMN_TITLES), sticky='we', ipady="2", padx=10,
+        updated_row = max(current_row, len(FLOOR_NUMBERS) + 1)
+        row_label.grid(row=updated_row, column=0, columnspan=len(COLUMN_TITLES), sticky='we', ipady="2", padx=10,
                        pady=(0, 20))
 
     # Add measurement options
@@ -583,12 +836,39 @@ for col in COLUMN_TITLES:
 
     col_number += 1
 
+# Trend of the selected floor and wing, or of one of its rooms
+room_menu = OptionMenu(root, room, ALL_ROOMS)
+room_menu.configure(bg="White")
+room_menu.grid(row=updated_row + 1, column=0, sticky='w', padx=10)
+chart_placeholder = Canvas(root, width=CHART_WIDTH, height=CHART_HEIGHT, bg='white', highlightthickness=0)
+placeholder_text = chart_placeholder.create_text(CHART_WIDTH / 2, CHART_HEIGHT / 2, fill='Gray',
+                                                 text='Loading history...')
+chart_placeholder.grid(row=updated_row + 2, column=0, columnspan=len(COLUMN_TITLES), padx=10, pady=(0, 20))
+
+# Alerts raised across the building, and the ones of the selected floor and wing
+heatmap = AlertHeatmap(root, FLOOR_NUMBERS, WING_LETTERS, snapshot.combos(), select_alert_cell, floor_name)
+heatmap.canvas.grid(row=updated_row + 3, column=0, columnspan=2, sticky='nw', padx=10, pady=(0, 20))
+alert_label = Label(bg="White", fg="Black", justify=LEFT, anchor='nw')
+alert_label.grid(row=updated_row + 3, column=2, columnspan=len(COLUMN_TITLES) - 2, sticky='nwe', pady=(0, 20))
+
 root.grid_columnconfigure(0, weight=1)
-fill_fields(floor.get(), str(wing.get()), measurement.get())
+root.after(UI_PUMP_INTERVAL, pump_events)
 try:
-    for radio_index in range(1, len(wing_radios)):
-        wing_radios[radio_index].grid_remove()  # Hide radios by default
+    show_wings()  # Hide the wings the first floor does not have
+    update_room_menu()
+    fill_fields(floor.get(), str(wing.get()), measurement.get())
     root.protocol("WM_DELETE_WINDOW", stop)
+
+    # Draw the window now, then load everything else behind it
+    root.update()
+    first_paint = time.perf_counter() - LAUNCHED
+    STARTUP_SECONDS.observe(first_paint, stage='first_paint')
+    print('Window shown {0:.0f} ms after launch, from {1}'.format(
+        first_paint * 1000, 'the snapshot of the last run' if snapshot.written else 'the room sensor file'))
+    loader = threading.Thread(target=load_session, args=())
+    loader.daemon = True  # Daemonize thread
+    loader.start()
+
     root.mainloop()
 except KeyboardInterrupt:
     stop()
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""
+#
+# File:              adaptive_polling.py
+# Description:       Polls each sensor on its own period, shortened while its
+#                    readings change quickly or are out of range and lengthened
+#                    while they are stable, within a global budget of gateway
+#                    requests per second.
+#
+"""
+
+import heapq
+import math
+import random
+import threading
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+import metrics
+from air_data import build_air_df
+from bacnet_gateway_requests import Reading, is_valid_instance
+from collector import report_loop_error
+
+DEFAULT_MIN_PERIOD = 5  # Seconds
+DEFAULT_MAX_PERIOD = 300  # Seconds
+DEFAULT_INITIAL_PERIOD = 10  # Seconds
+DEFAULT_MAX_RATE = 20  # Gateway requests per second
+DEFAULT_BATCH_WINDOW = 1  # Seconds ahead of time a sensor may be polled, to share a batch with others
+PERIOD_GROWTH = 1.5  # Factor applied to the period of a sensor after a stable reading
+
+# A change of at least `change` between two readings halves the period, a value outside [low, high] sets it to the
+# minimum. Values are compared as displayed, so in whole degrees and ppm.
+SensorPolicy = namedtuple('SensorPolicy', ['change', 'low', 'high'])
+DEFAULT_POLICIES = {
+    'Temperature': SensorPolicy(change=1, low=65, high=78),
+    'CO2 Level': SensorPolicy(change=50, low=None, high=1000),
+}
+
+# Air values DataFrame column -> room sensor file column of its instance
+SENSOR_COLUMNS = {'Temperature': 'Temperature', 'CO2 Level': 'CO2'}
+
+
+class SensorSchedule(object):
+    """Polling state of one sensor"""
+
+    def __init__(self, facility, instance, position, period, next_due):
+        self.facility = facility
+        self.instance = instance
+        self.position = position  # Row of the sensor's room in the registry
+        self.period = period
+        self.next_due = next_due
+        self.value = None
+
+    def adapt(self, value, policy, min_period, max_period):
+        """ Update the period from a new reading """
+        out_of_range = (policy.low is not None and value < policy.low) or \
+                       (policy.high is not None and value > policy.high)
+        if out_of_range:
+            self.period = min_period
+        elif self.value is not None and abs(value - self.value) >= policy.change:
+            self.period = max(min_period, self.period / 2)
+        else:
+            self.period = min(max_period, self.period * PERIOD_GROWTH)
+        self.value = value
+
+
+class AdaptiveScheduler(object):
+    """
+    Keeps every sensor of the registry in a priority queue keyed by the time
+    it is next due. Each pass polls the due sensors, as many as the request
+    budget allows, through a Collector's poller and publishes them through
+    the collector. Readings recorded by any other sweep of the collector also
+    count, so a sensor is never polled again sooner than its period.
+    """
+
+    def __init__(self, collector, min_period=DEFAULT_MIN_PERIOD, max_period=DEFAULT_MAX_PERIOD,
+                 initial_period=DEFAULT_INITIAL_PERIOD, max_rate=DEFAULT_MAX_RATE, policies=None,
+                 batch_window=DEFAULT_BATCH_WINDOW):
+        """ Constructor
+        :type collector: Collector
+        :param collector: Collector whose poller reads the sensors and whose session records them
+        :type min_period: float
+        :param min_period: Shortest seconds between two polls of a sensor
+        :type max_period: float
+        :param max_period: Longest seconds between two polls of a sensor
+        :type initial_period: float
+        :param initial_period: Seconds between polls of a sensor until its readings have been seen
+        :type max_rate: float
+        :param max_rate: Gateway requests allowed per second, on average
+        :type policies: dict
+        :param policies: Measurement column -> SensorPolicy, defaults to DEFAULT_POLICIES
+        :type batch_window: float
+        :param batch_window: Seconds ahead of time a sensor may be polled, so that fewer, larger batches are recorded
+        """
+        self.collector = collector
+        self.min_period = min_period
+        self.max_period = max_period
+        self.initial_period = initial_period
+        self.max_rate = max_rate
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.batch_window = batch_window
+        self.requests = 0  # Gateway requests made so far
+
+        self._rooms = None
+        self._sensors = {}  # (room, measurement column) -> SensorSchedule
+        self._queue = []  # (next due, room, measurement column), stale entries are skipped when popped
+        self._capacity = max(1.0, max_rate)  # At least one request, so rates below one per second still poll
+        self._tokens = self._capacity
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        self.collector.listeners.append(self.observe)
+
+        metrics.gauge('adaptive_sensors_due', 'Sensors due for a poll, waiting for the request budget',
+                      self._count_due)
+        metrics.gauge('adaptive_sensors', 'Sensors polled on an adaptive period', lambda: len(self._sensors))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def _schedule(self, key, sensor):
+        heapq.heappush(self._queue, (sensor.next_due, key[0], key[1]))
+
+    def _sync(self):
+        # Follow changes to the room sensor file, keeping the state of unchanged sensors
+        rooms = self.collector.registry.rooms
+        if rooms is self._rooms:
+            return
+        self._rooms = rooms
+
+        now = time.monotonic()
+        sensors = {}
+        for position, (label, facility, room_floor, room_wing) in enumerate(
+                zip(rooms['Label'], rooms['Facility'], rooms['Floor'], rooms['Wing'])):
+            if pd.isna(room_floor) or room_wing == '':
+                continue  # Only rooms on a floor and wing are shown, as with whole-building sweeps
+            for column, sensor_column in SENSOR_COLUMNS.items():
+                instance = rooms[sensor_column].iat[position]
+                if not is_valid_instance(instance):
+                    continue
+                key = (label, column)
+                sensor = self._sensors.get(key)
+                if sensor is not None and (sensor.facility, sensor.instance) == (facility, instance):
+                    sensor.position = position
+                else:
+                    # Spread the first polls over the initial period
+                    sensor = SensorSchedule(facility, instance, position, self.initial_period,
+                                            now + random.uniform(0, self.initial_period))
+                sensors[key] = sensor
+
+        self._sensors = sensors
+        self._queue = []
+        for key, sensor in sensors.items():
+            self._schedule(key, sensor)
+
+    def observe(self, air_df):
+        """ Adapt the periods of the sensors with readings in an air values DataFrame """
+        if air_df is None or air_df.empty:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            for column, policy in self.policies.items():
+                values = pd.to_numeric(air_df[column], errors='coerce')
+                for room, value in zip(air_df['Room'].astype(str), values):
+                    sensor = self._sensors.get((room, column))
+                    if sensor is None or math.isnan(value):
+                        continue
+                    sensor.adapt(value, policy, self.min_period, self.max_period)
+                    sensor.next_due = now + sensor.period
+                    self._schedule((room, column), sensor)
+
+    def _count_due(self):
+        now = time.monotonic()
+        return sum(1 for sensor in list(self._sensors.values()) if sensor.next_due <= now)
+
+    def _take_due(self, now):
+        # Refill the request budget, then pop as many due sensors as it allows
+        self._tokens = min(self._capacity, self._tokens + (now - self._refilled) * self.max_rate)
+        self._refilled = now
+
+        due = []
+        while self._queue and self._queue[0][0] <= now + self.batch_window and len(due) + 1 <= self._tokens:
+            next_due, room, column = heapq.heappop(self._queue)
+            sensor = self._sensors.get((room, column))
+            if sensor is None or sensor.next_due != next_due:
+                continue  # Rescheduled since it was queued
+            due.append(((room, column), sensor))
+        self._tokens -= len(due)
+        return due
+
+    def _delay(self, now):
+        # Seconds until the next sensor is due, or until the budget allows the next request
+        while self._queue:
+            next_due, room, column = self._queue[0]
+            sensor = self._sensors.get((room, column))
+            if sensor is not None and sensor.next_due == next_due:
+                if next_due <= now:
+                    return max(0.0, (1 - self._tokens) / self.max_rate)
+                return next_due - now
+            heapq.heappop(self._queue)
+        return self.max_period
+
+    def poll_due(self):
+        """ Poll the sensors that are due, within the request budget
+        :rtype: float
+        :return: Seconds until the next poll is needed
+        """
+        with self._lock:
+            self._sync()
+            now = time.monotonic()
+            due = self._take_due(now)
+
+            # Keep polling a sensor at its current period even if the gateway does not answer
+            for key, sensor in due:
+                sensor.next_due = now + sensor.period
+                self._schedule(key, sensor)
+
+            # The room frame is taken along with the sensors' positions in it, which a reload of the room sensor file
+            # while they are polled would change
+            rooms = self._rooms
+            due = [(key, sensor.facility, sensor.instance, sensor.position) for key, sensor in due]
+
+        if due:
+            # One row per room, with nothing in the measurements that were not due
+            positions = sorted(set(position for key, facility, instance, position in due))
+            rows = {position: index for index, position in enumerate(positions)}
+            readings = [Reading(None, None)] * (2 * len(positions))
+            columns = list(SENSOR_COLUMNS)
+            instances = [(facility, instance) for key, facility, instance, position in due]
+            for (key, facility, instance, position), reading in zip(
+                    due, self.collector.poller.get_values_and_units(instances)):
+                readings[2 * rows[position] + columns.index(key[1])] = reading
+            self.requests += len(instances)
+            self.collector.publish(build_air_df(rooms.iloc[positions], readings))
+
+        with self._lock:
+            return self._delay(time.monotonic())
+
+    def run(self):
+        """ Poll due sensors until stopped """
+        while not self.stopped():
+            try:
+                delay = self.poll_due()
+            except Exception:
+                report_loop_error('adaptive poll')
+                delay = self.min_period  # The sensors taken were already rescheduled
+            self._stop_event.wait(delay)
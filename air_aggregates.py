@@ -0,0 +1,102 @@
+"""
+#
+# File:              air_aggregates.py
+# Description:       Computes the floor/wing summaries shown by the display for
+#                    the whole building in one grouped pass, and caches them
+#                    so the display only has to look them up.
+#
+"""
+
+import threading
+from collections import namedtuple
+
+import numpy
+import pandas as pd
+
+MEASUREMENT_COLUMNS = ['CO2 Level', 'Temperature']
+
+Aggregate = namedtuple('Aggregate', ['mean', 'maximum', 'maximum_room', 'minimum', 'count', 'timestamp'])
+
+
+def compute_aggregates(readings):
+    """ Summarize every (floor, wing, measurement) of the given readings
+    :type readings: DataFrame
+    :param readings: Readings in the ReadingsStore.view() format
+    :rtype: dict
+    :return: (floor, wing, measurement column) -> Aggregate, for those with at least one valid reading
+    """
+    aggregates = {}
+    if readings is None or readings.empty:
+        return aggregates
+
+    keys = pd.DataFrame({'Floor': readings['Floor'].to_numpy(), 'Wing': readings['Wing'].astype(str).to_numpy()})
+    timestamps = pd.Series(readings['Timestamp'].to_numpy()).groupby([keys['Floor'], keys['Wing']]).max()
+
+    for measurement_column in MEASUREMENT_COLUMNS:
+        values = pd.Series(readings[measurement_column].to_numpy(dtype=numpy.float64))
+        grouped = values.groupby([keys['Floor'], keys['Wing']])
+        summary = grouped.agg(['mean', 'max', 'min', 'count'])
+        summary = summary[summary['count'] > 0]  # Every room unavailable: no summary, so fallbacks are shown
+
+        # Room with the maximum of each group: sort by value, keep the first valid row of each group
+        valid = values.notna().to_numpy()
+        order = numpy.argsort(-values.to_numpy()[valid], kind='stable')
+        valid_keys = keys[valid].iloc[order]
+        valid_rooms = readings['Room'].astype(str).to_numpy()[valid][order]
+        first_rows = ~valid_keys.duplicated().to_numpy()
+        maximum_rooms = dict(zip(zip(valid_keys['Floor'].to_numpy()[first_rows],
+                                     valid_keys['Wing'].to_numpy()[first_rows]), valid_rooms[first_rows]))
+
+        for (group_floor, group_wing), row in summary.iterrows():
+            aggregates[(int(group_floor), group_wing, measurement_column)] = Aggregate(
+                mean=float(row['mean']), maximum=float(row['max']),
+                maximum_room=maximum_rooms.get((group_floor, group_wing), 'None'), minimum=float(row['min']),
+                count=int(row['count']), timestamp=int(timestamps[(group_floor, group_wing)]))
+
+    return aggregates
+
+
+class AggregateCache(object):
+    """
+    Latest summaries of every (floor, wing, measurement), replaced as a whole
+    after each sweep so readers never see a half-updated table.
+    """
+
+    def __init__(self):
+        self.units = {}
+        self._aggregates = {}
+        self._combos = set()  # (floor, wing) of every room read, even those without a valid value
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._aggregates)
+
+    def update(self, readings, units=None):
+        """ Recompute every summary from the given readings, in the ReadingsStore.view() format """
+        aggregates = compute_aggregates(readings)
+        combos = set() if readings is None else set(zip(readings['Floor'].astype(int), readings['Wing'].astype(str)))
+        with self._lock:
+            self._aggregates = aggregates
+            self._combos = combos
+            if units:
+                self.units = dict(units)
+
+    def get(self, selected_floor, selected_wing, measurement_column):
+        """ Look up the summary of a floor, wing and measurement
+        :rtype: Aggregate
+        :return: The summary, or None if there were no readings for the floor and wing
+        """
+        return self._aggregates.get((int(selected_floor), str(selected_wing), measurement_column))
+
+    def was_read(self, selected_floor, selected_wing):
+        """ Whether any room of a floor and wing was read, even if none had a valid value, so it has no summary
+        :rtype: bool
+        """
+        return (int(selected_floor), str(selected_wing)) in self._combos
+
+    def items(self):
+        """ Get every summary
+        :rtype: list
+        :return: ((floor, wing, measurement column), Aggregate) pairs
+        """
+        return list(self._aggregates.items())
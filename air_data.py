@@ -0,0 +1,52 @@
+"""
+#
+# File:              air_data.py
+# Description:       Builds the session DataFrame of air readings shared by the
+#                    display and the background pollers.
+#
+"""
+
+import datetime as dt
+
+import pandas as pd
+
+AIR_COLUMNS = ['Date / Time', 'Room', 'Temperature', 'Temperature Units', 'CO2 Level', 'CO2 Units', 'Floor', 'Wing']
+
+
+# Gateway instances needed for the given rooms, as (facility, instance) pairs: temperature then CO2 for each room
+def room_instances(rooms):
+    instances = []
+    for facility, temperature_instance, co2_instance in zip(rooms['Facility'].tolist(), rooms['Temperature'].tolist(),
+                                                            rooms['CO2'].tolist()):
+        instances.append((facility, temperature_instance))
+        instances.append((facility, co2_instance))
+    return instances
+
+
+# Build the air values DataFrame from rooms and their readings, ordered as by room_instances()
+def build_air_df(rooms, readings):
+    df_dictionary = {column: [] for column in AIR_COLUMNS}
+    timestamp = dt.datetime.now().strftime("%m/%d/%Y %H:%M")
+
+    for index, (label, room_floor, room_wing) in enumerate(zip(rooms['Label'].tolist(), rooms['Floor'].tolist(),
+                                                                rooms['Wing'].tolist())):
+        temp_value, temp_units = readings[2 * index]
+        co2_value, co2_units = readings[2 * index + 1]
+
+        # Prepare to print
+        temp_value = round(int(temp_value)) if temp_value else ''
+        temp_units = temp_units.replace('deg ', '°') if temp_units else ''
+        co2_value = round(int(co2_value)) if co2_value else ''
+        co2_units = co2_units if co2_units else ''
+
+        # Update dictionary
+        df_dictionary['Date / Time'].append(timestamp)
+        df_dictionary['Room'].append(label)
+        df_dictionary['Temperature'].append(temp_value)
+        df_dictionary['Temperature Units'].append(temp_units)
+        df_dictionary['CO2 Level'].append(co2_value)
+        df_dictionary['CO2 Units'].append(co2_units)
+        df_dictionary['Floor'].append(room_floor)
+        df_dictionary['Wing'].append(room_wing)
+
+    return pd.DataFrame.from_dict(df_dictionary)
@@ -0,0 +1,83 @@
+"""
+#
+# File:              alert_heatmap.py
+# Description:       Grid of the floors and wings of a building on a Tk canvas,
+#                    each cell colored by how many alerts are raised there.
+#                    Clicking a cell selects its floor and wing.
+#
+"""
+
+from tkinter import Canvas
+
+CELL_WIDTH = 70  # Pixels
+CELL_HEIGHT = 26  # Pixels
+MARGINS = {'left': 60, 'top': 40, 'right': 10, 'bottom': 10}  # Pixels around the grid
+
+# Fill of a cell with at least the given number of alerts, from the most alerts down
+COLORS = [(4, '#E05A47'), (2, '#F9A65A'), (1, '#FCE38A'), (0, '#DFF0D8')]
+MISSING_COLOR = '#F0F0F0'  # Floors and wings the building does not have
+
+
+class AlertHeatmap(object):
+    """
+    One rectangle and one count per floor and wing, created once. Updates
+    only recolor the cells whose count changed.
+    """
+
+    def __init__(self, master, floors, wings, combos, on_select, floor_label=str):
+        """ Constructor
+        :type master: Widget
+        :param master: Parent of the canvas
+        :type floors: list
+        :param floors: Floor numbers, one row each
+        :type wings: list
+        :param wings: Wing letters, one column each
+        :type combos: list
+        :param combos: (floor, wing) combinations the building has
+        :type on_select: function
+        :param on_select: Called with the floor and wing of a clicked cell
+        :type floor_label: function
+        :param floor_label: Text of a floor's row, from its number
+        """
+        self.canvas = Canvas(master, bg='white', highlightthickness=0,
+                             width=MARGINS['left'] + len(wings) * CELL_WIDTH + MARGINS['right'],
+                             height=MARGINS['top'] + len(floors) * CELL_HEIGHT + MARGINS['bottom'])
+        self._cells = {}  # (floor, wing) -> (rectangle, text)
+        self._counts = {}
+
+        self.canvas.create_text(MARGINS['left'], MARGINS['top'] / 4, anchor='nw', fill='Blue', text='Active alerts')
+        for column, wing_letter in enumerate(wings):
+            self.canvas.create_text(MARGINS['left'] + (column + 0.5) * CELL_WIDTH, MARGINS['top'] - 8, anchor='s',
+                                    fill='Black', text=wing_letter)
+        # The top floor is drawn at the top
+        for row, floor_number in enumerate(reversed(floors)):
+            top = MARGINS['top'] + row * CELL_HEIGHT
+            self.canvas.create_text(MARGINS['left'] - 8, top + CELL_HEIGHT / 2, anchor='e', fill='Black',
+                                    text=floor_label(floor_number))
+            for column, wing_letter in enumerate(wings):
+                left = MARGINS['left'] + column * CELL_WIDTH
+                combo = (floor_number, wing_letter)
+                if combo not in combos:
+                    self.canvas.create_rectangle(left, top, left + CELL_WIDTH, top + CELL_HEIGHT, fill=MISSING_COLOR,
+                                                 outline='white')
+                    continue
+                rectangle = self.canvas.create_rectangle(left, top, left + CELL_WIDTH, top + CELL_HEIGHT,
+                                                         fill=COLORS[-1][1], outline='white')
+                text = self.canvas.create_text(left + CELL_WIDTH / 2, top + CELL_HEIGHT / 2, fill='Black', text='0')
+                self._cells[combo] = (rectangle, text)
+                self._counts[combo] = 0
+                for item in (rectangle, text):
+                    self.canvas.tag_bind(item, '<Button-1>', lambda event, combo=combo: on_select(*combo))
+
+    def update(self, counts):
+        """ Show the alerts raised on each floor and wing
+        :type counts: dict
+        :param counts: (floor, wing) -> number of alerts, missing ones have none
+        """
+        for combo, (rectangle, text) in self._cells.items():
+            count = counts.get(combo, 0)
+            if count == self._counts[combo]:
+                continue
+            self._counts[combo] = count
+            self.canvas.itemconfig(rectangle, fill=next(color for least, color in COLORS if count >= least))
+            self.canvas.itemconfig(text, text=str(count))
@@ -0,0 +1,411 @@
+"""
+#
+# File:              alerts.py
+# Description:       Alert rules evaluated on every batch of readings as it is
+#                    recorded. Each room keeps the state of each rule, so only
+#                    the new readings are looked at, and alerts that are
+#                    raised or cleared are sent to the configured sinks,
+#                    de-duplicated and rate limited, from a thread of their own.
+#
+"""
+
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import deque, namedtuple
+
+import numpy
+import pandas as pd
+import requests
+
+import metrics
+from readings_store import DATE_FORMAT
+from rolling_stats import MEASUREMENT_COLUMNS
+
+# Optional rules replacing DEFAULT_RULES, as Name, Measurement, Above, Below, Change and Minutes columns. A rule with
+# a Change is met when the measurement changes by that much within Minutes, any other rule when the measurement stays
+# above Above or below Below for Minutes.
+RULES_PATH = os.path.join('CSVs', 'alert_rules.csv')
+
+DEFAULT_RENOTIFY_INTERVAL = 30 * 60  # Seconds before an alert raised again for the same room and rule is sent again
+DEFAULT_MAX_PER_MINUTE = 20  # Notifications sent per minute, on average
+MAX_QUEUED = 1000  # Notifications waiting for the sinks, newer ones are dropped when it is full
+WEBHOOK_TIMEOUT = 5  # Seconds
+
+ALERT_TRANSITIONS = metrics.counter('alert_transitions_total', 'Alerts raised and cleared, by rule')
+ALERT_NOTIFICATIONS = metrics.counter('alert_notifications_total', 'Alert notifications, by result')
+
+# Latest engine of each facility, reported by the alerts_active gauge
+_engines = weakref.WeakValueDictionary()
+metrics.gauge('alerts_active', 'Alerts currently raised, by facility',
+              lambda: {(() if facility is None else (('facility', facility),)): len(engine._active)
+                       for facility, engine in list(_engines.items())})
+
+# An alert of a rule in a room. `since` is the epoch second of the first reading meeting the rule, `value` the latest
+# reading of the measurement.
+Alert = namedtuple('Alert', ['rule', 'room', 'floor', 'wing', 'measurement', 'value', 'since', 'timestamp'])
+
+
+class _RuleState(object):
+    """State of one rule in one room"""
+
+    __slots__ = ['since', 'active', 'window']
+
+    def __init__(self):
+        self.since = None  # Epoch second the rule has been met since, None while it is not
+        self.active = False
+        self.window = None
+
+
+class ThresholdRule(object):
+    """Met while a measurement stays above or below a limit for at least a duration"""
+
+    def __init__(self, name, measurement, above=None, below=None, duration=0):
+        """ Constructor
+        :type name: str
+        :param name: Name shown in notifications
+        :type measurement: str
+        :param measurement: Measurement column, 'Temperature' or 'CO2 Level'
+        :type above: float
+        :param above: Values above it meet the rule, None for no upper limit
+        :type below: float
+        :param below: Values below it meet the rule, None for no lower limit
+        :type duration: float
+        :param duration: Seconds the limit must be crossed for before the alert is raised
+        """
+        self.name = name
+        self.measurement = measurement
+        self.above = above
+        self.below = below
+        self.duration = duration
+
+    def check(self, state, timestamp, value):
+        """ Add a reading to the state of a room
+        :rtype: bool
+        :return: Whether the rule is met
+        """
+        if (self.above is not None and value > self.above) or (self.below is not None and value < self.below):
+            if state.since is None:
+                state.since = timestamp
+            return timestamp - state.since >= self.duration
+        state.since = None
+        return False
+
+    def describe(self):
+        limits = []
+        if self.above is not None:
+            limits.append('above {0:g}'.format(self.above))
+        if self.below is not None:
+            limits.append('below {0:g}'.format(self.below))
+        description = '{0} {1}'.format(self.measurement, ' or '.join(limits))
+        if self.duration:
+            description += ' for {0:g} min'.format(self.duration / 60)
+        return description
+
+
+class RateRule(object):
+    """Met while a measurement has risen (or fallen, for a negative change) by at least a change within a period"""
+
+    def __init__(self, name, measurement, change, period):
+        """ Constructor
+        :type name: str
+        :param name: Name shown in notifications
+        :type measurement: str
+        :param measurement: Measurement column, 'Temperature' or 'CO2 Level'
+        :type change: float
+        :param change: Rise that meets the rule, or fall if negative
+        :type period: float
+        :param period: Seconds the change must happen within
+        """
+        self.name = name
+        self.measurement = measurement
+        self.change = change
+        self.period = period
+
+    def check(self, state, timestamp, value):
+        """ Add a reading to the state of a room
+        :rtype: bool
+        :return: Whether the rule is met
+        """
+        if state.window is None:
+            state.window = deque()
+        window = state.window
+        window.append((timestamp, value))
+        while window[0][0] < timestamp - self.period:
+            window.popleft()
+
+        change = value - window[0][1]
+        if change >= self.change if self.change > 0 else change <= self.change:
+            if state.since is None:
+                state.since = window[0][0]
+            return True
+        state.since = None
+        return False
+
+    def describe(self):
+        return '{0} {1} by {2:g} within {3:g} min'.format(self.measurement, 'rising' if self.change > 0 else 'falling',
+                                                          abs(self.change), self.period / 60)
+
+
+DEFAULT_RULES = [
+    ThresholdRule('High CO2', 'CO2 Level', above=1000, duration=10 * 60),
+    ThresholdRule('Too warm', 'Temperature', above=78, duration=15 * 60),
+    ThresholdRule('Too cold', 'Temperature', below=65, duration=15 * 60),
+    RateRule('CO2 rising fast', 'CO2 Level', change=400, period=15 * 60),
+]
+
+
+def load_rules(path=RULES_PATH):
+    """ Read the alert rules
+    :rtype: list
+    :return: The rules of the file, DEFAULT_RULES if it does not exist
+    """
+    if not os.path.isfile(path):
+        return list(DEFAULT_RULES)
+
+    def number(text):
+        return float(text) if text.strip() else None
+
+    rules = []
+    for row in pd.read_csv(path, dtype=str, na_filter=False).to_dict(orient='records'):
+        name, measurement = row['Name'].strip(), row['Measurement'].strip()
+        if measurement not in MEASUREMENT_COLUMNS.values():
+            raise ValueError('Unknown measurement {0} in alert rule {1}'.format(measurement, name))
+        seconds = (number(row['Minutes']) or 0) * 60
+        if number(row['Change']) is not None:
+            rules.append(RateRule(name, measurement, number(row['Change']), seconds))
+        elif number(row['Above']) is None and number(row['Below']) is None:
+            raise ValueError('Alert rule {0} has no Above, Below or Change'.format(name))
+        else:
+            rules.append(ThresholdRule(name, measurement, number(row['Above']), number(row['Below']), seconds))
+    return rules
+
+
+class LogFileSink(object):
+    """Appends a line per notification to a text file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, notification):
+        with open(self.path, 'a') as log_file:
+            log_file.write('{0}  {1:<7}  {2}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                       notification['state'].upper(), notification['message']))
+
+
+class WebhookSink(object):
+    """Posts each notification as JSON to a URL"""
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, notification):
+        self.session.post(self.url, json=notification, timeout=self.timeout).raise_for_status()
+
+
+class AlertNotifier(object):
+    """
+    Sends raised and cleared alerts to sinks. An alert raised again for the
+    same room and rule within the renotify interval is not sent, a cleared
+    alert is only sent if it was raised, and a token bucket limits how many
+    are sent per minute. Sinks are called from a thread of their own, so a
+    slow webhook never holds up recording.
+    """
+
+    def __init__(self, sinks, renotify_interval=DEFAULT_RENOTIFY_INTERVAL, max_per_minute=DEFAULT_MAX_PER_MINUTE):
+        """ Constructor
+        :type sinks: list
+        :param sinks: Objects with a send(notification) method, such as LogFileSink and WebhookSink
+        :type renotify_interval: float
+        :param renotify_interval: Seconds before an alert of the same room and rule is sent again
+        :type max_per_minute: float
+        :param max_per_minute: Notifications sent per minute, on average
+        """
+        self.sinks = list(sinks)
+        self.renotify_interval = renotify_interval
+        self.max_per_minute = max_per_minute
+        self.suppressed = 0  # Raised alerts held back by the rate limit since the last notification sent
+
+        self._last_sent = {}  # (facility, rule, room) -> monotonic second its alert was last sent
+        self._sent = set()  # (facility, rule, room) of the alerts sent and not yet cleared
+        self._tokens = float(max_per_minute)
+        self._refilled = time.monotonic()
+        self._queue = queue.Queue(maxsize=MAX_QUEUED)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self, state, alert, description, facility=None):
+        """ Queue a notification of an alert raised or cleared, unless it is a duplicate or over the rate limit
+        :type state: str
+        :param state: 'raised' or 'cleared'
+        """
+        key = (facility, alert.rule, alert.room)
+        now = time.monotonic()
+        with self._lock:
+            if state == 'cleared':
+                if key not in self._sent:
+                    return
+                self._sent.discard(key)
+            else:
+                last_sent = self._last_sent.get(key)
+                if last_sent is not None and now - last_sent < self.renotify_interval:
+                    ALERT_NOTIFICATIONS.inc(result='duplicate')
+                    return
+                self._tokens = min(self.max_per_minute, self._tokens + (now - self._refilled) * self.max_per_minute / 60)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.suppressed += 1
+                    ALERT_NOTIFICATIONS.inc(result='rate_limited')
+                    return
+                self._tokens -= 1
+                self._last_sent[key] = now
+                self._sent.add(key)
+            suppressed, self.suppressed = self.suppressed, 0
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._deliver, args=())
+                self._thread.daemon = True  # Daemonize thread
+                self._thread.start()
+
+        message = '{0}: {1} in room {2} ({3}{4}), {5}'.format(
+            'Raised' if state == 'raised' else 'Cleared', alert.rule, alert.room, alert.floor, alert.wing,
+            description)
+        if facility is not None:
+            message = '[{0}] {1}'.format(facility, message)
+        if suppressed:
+            message += ' ({0} more alerts held back by the rate limit)'.format(suppressed)
+        notification = {
+            'state': state,
+            'facility': facility,
+            'rule': alert.rule,
+            'description': description,
+            'room': alert.room,
+            'floor': alert.floor,
+            'wing': alert.wing,
+            'measurement': alert.measurement,
+            'value': alert.value,
+            'since': time.strftime(DATE_FORMAT, time.gmtime(alert.since)),
+            'time': time.strftime(DATE_FORMAT, time.gmtime(alert.timestamp)),
+            'suppressed': suppressed,
+            'message': message,
+        }
+        try:
+            self._queue.put_nowait(notification)
+        except queue.Full:
+            ALERT_NOTIFICATIONS.inc(result='dropped')
+
+    def _deliver(self):
+        while True:
+            notification = self._queue.get()
+            if notification is None:
+                return
+            for sink in self.sinks:
+                try:
+                    sink.send(notification)
+                    ALERT_NOTIFICATIONS.inc(result='sent', sink=type(sink).__name__)
+                except Exception as error:
+                    ALERT_NOTIFICATIONS.inc(result='failed', sink=type(sink).__name__)
+                    print('Could not send an alert to {0}: {1}'.format(type(sink).__name__, error))
+
+    def close(self):
+        """ Send the notifications still queued, then stop """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(WEBHOOK_TIMEOUT * 2)
+
+
+class AlertEngine(object):
+    """
+    Evaluates every rule against each batch of readings as it is recorded,
+    keeping the state of each rule per room, so a batch costs time in
+    proportion to its readings and not to the history behind them.
+    """
+
+    def __init__(self, rules=None, notifier=None, facility=None):
+        """ Constructor
+        :type rules: list
+        :param rules: ThresholdRule and RateRule objects, defaults to DEFAULT_RULES
+        :type notifier: AlertNotifier
+        :param notifier: Notifier raised and cleared alerts are sent to, None to only keep the active alerts
+        :type facility: str
+        :param facility: Facility of the readings, included in notifications
+        """
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.notifier = notifier
+        self.facility = facility
+        self.version = 0  # Incremented whenever an alert is raised or cleared
+
+        self._rules = {}  # ReadingsStore.append() argument -> rules of its measurement
+        for rule in self.rules:
+            for argument, measurement_column in MEASUREMENT_COLUMNS.items():
+                if measurement_column == rule.measurement:
+                    self._rules.setdefault(argument, []).append(rule)
+        self._states = {}  # (rule name, room) -> _RuleState
+        self._active = {}  # (rule name, room) -> Alert
+        self._lock = threading.Lock()
+        _engines[facility] = self
+
+    def update(self, columns):
+        """ Evaluate the rules on a batch of readings, given as ReadingsStore.append() arguments """
+        with self._lock:
+            for argument, rules in self._rules.items():
+                values = numpy.asarray(columns[argument], dtype=numpy.float64)
+                for index in numpy.flatnonzero(~numpy.isnan(values)):
+                    timestamp = int(columns['timestamps'][index])
+                    value = float(values[index])
+                    room = columns['rooms'][index]
+                    for rule in rules:
+                        key = (rule.name, room)
+                        state = self._states.get(key)
+                        if state is None:
+                            state = _RuleState()
+                            self._states[key] = state
+                        met = rule.check(state, timestamp, value)
+                        if met:
+                            self._active[key] = Alert(rule.name, room, int(columns['floors'][index]),
+                                                      str(columns['wings'][index]), rule.measurement, value,
+                                                      state.since, timestamp)
+                        if met == state.active:
+                            continue
+                        state.active = met
+                        if met:
+                            self._transition('raised', rule, self._active[key])
+                        else:
+                            alert = self._active.pop(key)._replace(value=value, timestamp=timestamp)
+                            self._transition('cleared', rule, alert)
+
+    def _transition(self, state, rule, alert):
+        self.version += 1
+        ALERT_TRANSITIONS.inc(rule=rule.name, state=state)
+        if self.notifier is not None:
+            self.notifier.notify(state, alert, rule.describe(), self.facility)
+
+    def active(self, combo=None):
+        """ Get the alerts currently raised
+        :type combo: tuple
+        :param combo: (floor, wing) to get the alerts of, None for the whole building
+        :rtype: list
+        :return: Alert tuples, by floor, wing and room
+        """
+        with self._lock:
+            alerts = list(self._active.values())
+        if combo is not None:
+            alerts = [alert for alert in alerts if (alert.floor, alert.wing) == combo]
+        return sorted(alerts, key=lambda alert: (alert.floor, alert.wing, alert.room, alert.rule))
+
+    def active_counts(self):
+        """ Count the alerts currently raised on each floor and wing
+        :rtype: dict
+        :return: (floor, wing) -> number of alerts
+        """
+        counts = {}
+        with self._lock:
+            for alert in self._active.values():
+                counts[(alert.floor, alert.wing)] = counts.get((alert.floor, alert.wing), 0) + 1
+        return counts
@@ -0,0 +1,223 @@
+"""
+#
+# File:              async_polling.py
+# Description:       Asyncio polling engine that reads every sensor of the
+#                    building as concurrent tasks, so a full sweep takes about
+#                    one gateway round trip instead of one per sensor.
+#
+"""
+
+import asyncio
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from air_data import build_air_df, room_instances
+from bacnet_gateway_requests import (BACnetGatewayClient, CircuitBreaker, Reading, UNAVAILABLE, backoff_delay,
+                                     batch_args, chunked, is_valid_instance, parse_batch_response,
+                                     parse_gateway_response, DEFAULT_BATCH_SIZE, DEFAULT_CONNECT_TIMEOUT,
+                                     DEFAULT_READ_TIMEOUT, DEFAULT_MAX_ATTEMPTS, DEFAULT_BACKOFF_BASE,
+                                     DEFAULT_BACKOFF_CAP, GATEWAY_BATCH_FALLBACKS, GATEWAY_BATCH_SECONDS,
+                                     GATEWAY_ERRORS, GATEWAY_REQUEST_SECONDS, GATEWAY_RETRIES, GATEWAY_UNAVAILABLE)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # Fall back to running the blocking client in a thread pool
+
+DEFAULT_CONCURRENCY = 32
+
+
+class AsyncPoller(object):
+    """
+    Polls the gateway from a private event loop running in a daemon thread.
+    Every sensor is scheduled as its own task, with a semaphore shared by all
+    polls capping the number of requests in flight to the gateway. Uses aiohttp when it is installed, and the
+    pooled BACnetGatewayClient on a thread pool otherwise. With a batch size above 1, sensors are read that many
+    per request instead, one task per batch, falling back to a task per sensor if the gateway cannot read batches.
+    """
+
+    def __init__(self, hostname, port, concurrency=DEFAULT_CONCURRENCY, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_cap=DEFAULT_BACKOFF_CAP, circuit_breaker=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        """ Constructor
+        :type hostname: str
+        :param hostname: Hostname or IP address of the gateway
+        :type port: str
+        :param port: Port of the gateway
+        :type concurrency: int
+        :param concurrency: Maximum number of requests in flight at once
+        :type connect_timeout: float
+        :param connect_timeout: Seconds to wait for a connection to the gateway
+        :type read_timeout: float
+        :param read_timeout: Seconds to wait for the gateway to respond
+        :type max_attempts: int
+        :param max_attempts: Attempts per instance before giving up
+        :type backoff_base: float
+        :param backoff_base: Upper bound of the first retry delay, in seconds
+        :type backoff_cap: float
+        :param backoff_cap: Upper bound of any retry delay, in seconds
+        :type circuit_breaker: CircuitBreaker
+        :param circuit_breaker: Breaker shared by every request to this gateway
+        :type batch_size: int
+        :param batch_size: Maximum sensors read per request
+        """
+        self.url = 'http://' + str(hostname) + ':' + str(port)
+        self.concurrency = concurrency
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.batch_size = batch_size
+        self.supports_batch = None  # Unknown until the first batch read
+
+        self._session = None
+        self._semaphore = None
+        self._client = None
+        self._executor = None
+        if aiohttp is None:
+            self._client = BACnetGatewayClient(hostname, port, max_workers=concurrency,
+                                               connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                               max_attempts=max_attempts, backoff_base=backoff_base,
+                                               backoff_cap=backoff_cap, circuit_breaker=self.circuit_breaker,
+                                               batch_size=batch_size)
+            self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, args=())
+        self._thread.daemon = True  # Daemonize thread
+        self._thread.start()
+
+    def close(self):
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        if self._client is not None:
+            self._client.close()
+            self._executor.shutdown(wait=False)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _get_session(self):
+        # The session has to be created inside the event loop that uses it
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout))
+        return self._session
+
+    async def _fetch(self, semaphore, facility, instance):
+        if not is_valid_instance(instance):
+            return Reading(None, None)
+
+        async with semaphore:
+            if aiohttp is None:
+                return await self._loop.run_in_executor(self._executor, self._client.get_value_and_units,
+                                                        facility, instance)
+
+            with GATEWAY_REQUEST_SECONDS.time(facility=facility, instance=instance):
+                return await self._request(facility, instance)
+
+    async def _fetch_batch(self, semaphore, pairs):
+        # Readings of the pairs in request order, or None if the gateway does not support batch reads
+        async with semaphore:
+            if aiohttp is None:
+                readings = await self._loop.run_in_executor(self._executor, self._client.read_batch, pairs)
+            else:
+                with GATEWAY_BATCH_SECONDS.time():
+                    readings = await self._request_batch(pairs)
+        self.supports_batch = readings is not None
+        return readings
+
+    async def _request(self, facility, instance):
+        args = {
+            'facility': facility,
+            'instance': instance
+        }
+        response = await self._post(args)
+        if response is None or response[0] != 200:
+            return UNAVAILABLE
+        return parse_gateway_response(response[1])
+
+    async def _request_batch(self, pairs):
+        response = await self._post(batch_args(pairs))
+        if response is None:
+            return [UNAVAILABLE] * len(pairs)
+        readings = parse_batch_response(response[1], len(pairs)) if response[0] == 200 else None
+        if readings is None:
+            GATEWAY_BATCH_FALLBACKS.inc()
+        return readings
+
+    async def _post(self, args):
+        # Status and text of the gateway's response, retrying on connection errors and server errors, or None if it
+        # could not be reached. A request the gateway rejects (another error status) counts as a failure but is not
+        # retried, and its response is returned
+        session = await self._get_session()
+        for attempt in range(self.max_attempts):
+            if not self.circuit_breaker.allow_request():
+                # The gateway is known to be down
+                GATEWAY_UNAVAILABLE.inc(reason='circuit_open')
+                return None
+
+            try:
+                async with session.post(self.url, data=args) as gateway_rsp:
+                    response = gateway_rsp.status, await gateway_rsp.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                response = None
+
+            if response is not None and response[0] == 200:
+                self.circuit_breaker.record_success()
+                return response
+
+            GATEWAY_ERRORS.inc()
+            self.circuit_breaker.record_failure()
+            if response is not None and response[0] < 500:
+                return response
+            if attempt < self.max_attempts - 1:
+                GATEWAY_RETRIES.inc()
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+
+        GATEWAY_UNAVAILABLE.inc(reason='attempts_exhausted')
+        return None
+
+    async def _poll(self, instances):
+        # Simultaneous polls share the limit, so the gateway never sees more than concurrency requests at once
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        # Each distinct instance is only requested once per sweep
+        distinct = list(OrderedDict.fromkeys(instances))
+        readings = {}
+        if self.batch_size > 1 and self.supports_batch is not False:
+            valid = [(facility, instance) for facility, instance in distinct if is_valid_instance(instance)]
+            batches = [(pairs, asyncio.ensure_future(self._fetch_batch(self._semaphore, pairs)))
+                       for pairs in chunked(valid, self.batch_size)]
+            await asyncio.gather(*[task for pairs, task in batches])
+            for pairs, task in batches:
+                if task.result() is not None:
+                    readings.update(zip(pairs, task.result()))
+
+        # Instances the gateway could not read in batches are read one at a time
+        tasks = {(facility, instance): asyncio.ensure_future(self._fetch(self._semaphore, facility, instance))
+                 for facility, instance in distinct if (facility, instance) not in readings}
+        await asyncio.gather(*tasks.values())
+        readings.update((pair, task.result()) for pair, task in tasks.items())
+
+        return [readings[(facility, instance)] for facility, instance in instances]
+
+    # Start requesting present values and units for a list of (facility, instance) pairs, returning a
+    # concurrent.futures.Future of the readings. Cancelling the future cancels the requests still in flight.
+    def submit(self, instances):
+        return asyncio.run_coroutine_threadsafe(self._poll(list(instances)), self._loop)
+
+    # Request present values and units for a list of (facility, instance) pairs, blocking until all have finished
+    def get_values_and_units(self, instances):
+        return self.submit(instances).result()
+
+    # Read every room in the rooms DataFrame, returning the air values DataFrame
+    def poll_rooms(self, rooms):
+        return build_air_df(rooms, self.get_values_and_units(room_instances(rooms)))
@@ -1,49 +1,342 @@
 import requests
 import json
+import random
 import time
+import threading
 
-from requests.exceptions import ConnectionError
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
+import metrics
 
-# Request present value and units for the supplied instance
-def get_value_and_units(facility, instance, gateway_hostname, gateway_port):
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CONNECT_TIMEOUT = 3.05  # Seconds
+DEFAULT_READ_TIMEOUT = 10  # Seconds
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF_BASE = 0.5  # Seconds
+DEFAULT_BACKOFF_CAP = 8  # Seconds
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30  # Seconds
+DEFAULT_BATCH_SIZE = 1  # Instances per request, 1 for the single reads every gateway supports
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+GATEWAY_REQUEST_SECONDS = metrics.histogram('gateway_request_seconds',
+                                            'Seconds to read one sensor from the gateway, retries included')
+GATEWAY_ERRORS = metrics.counter('gateway_errors_total',
+                                 'Gateway requests failed by a connection error, timeout or error status')
+GATEWAY_RETRIES = metrics.counter('gateway_retries_total', 'Gateway requests retried after an error')
+GATEWAY_UNAVAILABLE = metrics.counter('gateway_unavailable_total', 'Sensor reads given up on, by reason')
+GATEWAY_CIRCUIT_OPENED = metrics.counter('gateway_circuit_opened_total', 'Times the gateway circuit breaker opened')
+GATEWAY_BATCH_SECONDS = metrics.histogram('gateway_batch_seconds',
+                                          'Seconds to read one batch of sensors from the gateway, retries included')
+GATEWAY_BATCH_FALLBACKS = metrics.counter('gateway_batch_fallbacks_total',
+                                          'Batches read one sensor at a time, the gateway not supporting batch reads')
+
+Reading = namedtuple('Reading', ['value', 'units'])
+
+
+class UnavailableReading(Reading):
+    """Reading returned when the gateway could not be reached, so callers can tell it apart from an empty value"""
+    __slots__ = ()
+
+
+UNAVAILABLE = UnavailableReading(None, None)
+
+
+def is_unavailable(reading):
+    return isinstance(reading, UnavailableReading)
+
+
+# Extract present value and units from the text of a gateway response, UNAVAILABLE if it is not one
+def parse_gateway_response(text):
     value = None
     units = None
 
-    if str(instance).isdigit() and int(instance) > 0:
-        # Instance appears to be valid
+    try:
+
+        # Convert JSON response to Python dictionary
+        dc_rsp = json.loads(text)
+
+        # Extract BACnet response from the dictionary
+        dc_bn_rsp = dc_rsp['bacnet_response']
+
+        # Extract result from BACnet response
+        if (dc_bn_rsp['success']):
+
+            dc_data = dc_bn_rsp['data']
+
+            if dc_data['success']:
+                value = dc_data['presentValue']
+                units = dc_data['units']
+
+    except (ValueError, KeyError, TypeError):
+        GATEWAY_UNAVAILABLE.inc(reason='invalid_response')
+        return UNAVAILABLE
+
+    return Reading(value, units)
+
+
+# Arguments of a request reading several (facility, instance) pairs at once, like BACnet ReadPropertyMultiple
+def batch_args(pairs):
+    return {'read_multiple': json.dumps([[facility, str(instance)] for facility, instance in pairs])}
+
+
+# Extract the readings of a batch read from the text of a gateway response, in request order, or None if the gateway
+# answered like one that does not support batch reads
+def parse_batch_response(text, count):
+    try:
+        dc_data = json.loads(text)['bacnet_response']['data']
+        results = dc_data['results']
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(results, list) or len(results) != count:
+        return None
+    try:
+        return [Reading(result['presentValue'], result['units']) if result.get('success') else Reading(None, None)
+                for result in results]
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+# Split a list of (facility, instance) pairs into batches of at most the given size
+def chunked(pairs, batch_size):
+    return [pairs[start:start + batch_size] for start in range(0, len(pairs), batch_size)]
+
+
+# Whether an instance ID from the room sensor file can be requested
+def is_valid_instance(instance):
+    return str(instance).isdigit() and int(instance) > 0
+
 
+# Delay before the given retry: capped exponential backoff with full jitter
+def backoff_delay(attempt, backoff_base=DEFAULT_BACKOFF_BASE, backoff_cap=DEFAULT_BACKOFF_CAP):
+    return random.uniform(0, min(backoff_cap, backoff_base * (2 ** attempt)))
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive gateway failures. Once failure_threshold is reached the
+    circuit opens and calls are short-circuited until reset_timeout has passed,
+    after which a single trial call is let through.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """ Constructor
+        :type failure_threshold: int
+        :param failure_threshold: Consecutive failures before the circuit opens
+        :type reset_timeout: float
+        :param reset_timeout: Seconds to wait before letting a trial call through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_in_flight or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    GATEWAY_CIRCUIT_OPENED.inc()
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class BACnetGatewayClient(object):
+    """
+    Reusable client for the BACnet gateway. Requests share one keep-alive
+    session, and batches of instances are fetched concurrently over a bounded
+    worker pool. With a batch size above 1, each request reads that many
+    instances at once, until the gateway answers like one that cannot, after
+    which instances are read one per request again.
+    """
+
+    def __init__(self, hostname, port, max_workers=DEFAULT_MAX_WORKERS, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_cap=DEFAULT_BACKOFF_CAP, circuit_breaker=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        """ Constructor
+        :type hostname: str
+        :param hostname: Hostname or IP address of the gateway
+        :type port: str
+        :param port: Port of the gateway
+        :type max_workers: int
+        :param max_workers: Maximum number of requests in flight at once
+        :type connect_timeout: float
+        :param connect_timeout: Seconds to wait for a connection to the gateway
+        :type read_timeout: float
+        :param read_timeout: Seconds to wait for the gateway to respond
+        :type max_attempts: int
+        :param max_attempts: Attempts per instance before giving up
+        :type backoff_base: float
+        :param backoff_base: Upper bound of the first retry delay, in seconds
+        :type backoff_cap: float
+        :param backoff_cap: Upper bound of any retry delay, in seconds
+        :type circuit_breaker: CircuitBreaker
+        :param circuit_breaker: Breaker shared by every request to this gateway
+        :type batch_size: int
+        :param batch_size: Maximum instances read per request
+        """
+        self.url = 'http://' + str(hostname) + ':' + str(port)
+        self.max_workers = max_workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.batch_size = batch_size
+        self.supports_batch = None  # Unknown until the first batch read
+
+        # Keep one pooled connection per worker alive between requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    # Request present value and units for the supplied instance
+    def get_value_and_units(self, facility, instance):
+        if is_valid_instance(instance):
+            # Instance appears to be valid
+            with GATEWAY_REQUEST_SECONDS.time(facility=facility, instance=instance):
+                return self._request(facility, instance)
+
+        return Reading(None, None)
+
+    def _request(self, facility, instance):
         # Set up request arguments
         args = {
             'facility': facility,
             'instance': instance
         }
-        while True:
+        gateway_rsp = self._post(args)
+        if gateway_rsp is None or gateway_rsp.status_code != 200:
+            return UNAVAILABLE
+        return parse_gateway_response(gateway_rsp.text)
+
+    # Request present values and units for (facility, instance) pairs in one request, returning the readings in the
+    # order of the pairs, or None if the gateway does not support batch reads
+    def read_batch(self, pairs):
+        with GATEWAY_BATCH_SECONDS.time():
+            gateway_rsp = self._post(batch_args(pairs))
+        if gateway_rsp is None:
+            return [UNAVAILABLE] * len(pairs)
+
+        readings = parse_batch_response(gateway_rsp.text, len(pairs)) if gateway_rsp.status_code == 200 else None
+        if readings is None:
+            GATEWAY_BATCH_FALLBACKS.inc()
+            self.supports_batch = False
+        else:
+            self.supports_batch = True
+        return readings
+
+    # Post a request to the gateway, retrying on connection errors and server errors, returning the response or None
+    # if it could not be reached. A request the gateway rejects (another error status) counts as a failure but is not
+    # retried, and its response is returned
+    def _post(self, args):
+        for attempt in range(self.max_attempts):
+            if not self.circuit_breaker.allow_request():
+                # The gateway is known to be down
+                GATEWAY_UNAVAILABLE.inc(reason='circuit_open')
+                return None
+
             try:
 
                 # Issue request to HTTP service
-                url = 'http://' + str(gateway_hostname) + ':' + str(gateway_port)
-                gateway_rsp = requests.post(url, data=args)
+                gateway_rsp = self.session.post(self.url, data=args, timeout=self.timeout)
 
-                # Convert JSON response to Python dictionary
-                dc_rsp = json.loads(gateway_rsp.text)
+            except (ConnectionError, Timeout):
+                gateway_rsp = None
 
-                # Extract BACnet response from the dictionary
-                dc_bn_rsp = dc_rsp['bacnet_response']
+            if gateway_rsp is not None and gateway_rsp.status_code == 200:
+                self.circuit_breaker.record_success()
+                return gateway_rsp
 
-                # Extract result from BACnet response
-                if (dc_bn_rsp['success']):
+            GATEWAY_ERRORS.inc()
+            self.circuit_breaker.record_failure()
+            if gateway_rsp is not None and gateway_rsp.status_code < 500:
+                return gateway_rsp
+            if attempt < self.max_attempts - 1:
+                GATEWAY_RETRIES.inc()
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
 
-                    dc_data = dc_bn_rsp['data']
+        GATEWAY_UNAVAILABLE.inc(reason='attempts_exhausted')
+        return None
 
-                    if dc_data['success']:
-                        value = dc_data['presentValue']
-                        units = dc_data['units']
+    # Request present values and units for a list of (facility, instance) pairs
+    def get_values_and_units(self, instances):
+        instances = list(instances)
 
-            except ConnectionError:
-                time.sleep(5)
-                continue
+        # Each distinct instance is only requested once per batch
+        distinct = list(OrderedDict.fromkeys(instances))
+        readings = {}
+        if self.batch_size > 1 and self.supports_batch is not False:
+            valid = [(facility, instance) for facility, instance in distinct if is_valid_instance(instance)]
+            batches = [(pairs, self._executor.submit(self.read_batch, pairs))
+                       for pairs in chunked(valid, self.batch_size)]
+            for pairs, future in batches:
+                if future.result() is not None:
+                    readings.update(zip(pairs, future.result()))
+
+        # Instances the gateway could not read in batches are read one at a time
+        futures = {(facility, instance): self._executor.submit(self.get_value_and_units, facility, instance)
+                   for facility, instance in distinct if (facility, instance) not in readings}
+        readings.update((pair, future.result()) for pair, future in futures.items())
+        return [readings[(facility, instance)] for facility, instance in instances]
+
+
+# Get the shared client for a gateway, creating it with the given options on first use
+def get_client(gateway_hostname, gateway_port, **client_options):
+    key = (str(gateway_hostname), str(gateway_port))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = BACnetGatewayClient(gateway_hostname, gateway_port, **client_options)
+            _clients[key] = client
+    return client
+
+
+# Request present value and units for the supplied instance
+def get_value_and_units(facility, instance, gateway_hostname, gateway_port):
+    return get_client(gateway_hostname, gateway_port).get_value_and_units(facility, instance)
 
-            break
 
-    return value, units
+# Request present values and units for a list of (facility, instance) pairs
+def get_values_and_units(instances, gateway_hostname, gateway_port):
+    return get_client(gateway_hostname, gateway_port).get_values_and_units(instances)
@@ -0,0 +1,197 @@
+"""
+#
+# File:              benchmark.py
+# Description:       Reproducible benchmark of the collection path and of the
+#                    summaries the display looks up, against fake gateways of
+#                    100 to 10,000 sensors. Results can be saved as JSON and
+#                    compared with an earlier run to catch regressions.
+#
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from air_aggregates import MEASUREMENT_COLUMNS
+from async_polling import AsyncPoller, DEFAULT_CONCURRENCY
+from bacnet_gateway_requests import DEFAULT_BATCH_SIZE
+from collector import Collector, SessionData
+from fake_gateway import write_sensor_file
+from readings_store import air_df_columns
+from sensor_registry import SensorRegistry
+
+DEFAULT_SENSOR_COUNTS = [100, 1000, 10000]
+DEFAULT_LATENCY = 0.01  # Seconds
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.10  # Slowdown reported as a regression
+
+# Measurements compared against a baseline, lower is better
+COMPARED_MEASUREMENTS = ['sweep_seconds', 'cpu_seconds', 'peak_memory_bytes', 'record_seconds', 'lookup_seconds']
+
+
+def start_gateway(sensor_path, latency, jitter, failure_rate, batch=True):
+    """ Run a fake gateway in its own process, so it does not count against the measured CPU and memory
+    :rtype: tuple
+    :return: The gateway process and the port it listens on
+    """
+    gateway = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'fake_gateway.py'),
+                                '--port', '0', '--sensors', sensor_path, '--latency', str(latency),
+                                '--jitter', str(jitter), '--failure-rate', str(failure_rate)] +
+                               ([] if batch else ['--no-batch']),
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    line = gateway.stdout.readline()  # Printed once it is listening
+    if not line:
+        gateway.kill()
+        raise RuntimeError('The fake gateway did not start')
+    return gateway, int(line.strip().rsplit(':', 1)[1])
+
+
+def run_benchmark(sensor_count, latency=DEFAULT_LATENCY, jitter=0.0, failure_rate=0.0,
+                  concurrency=DEFAULT_CONCURRENCY, repeats=DEFAULT_REPEATS, batch_size=DEFAULT_BATCH_SIZE,
+                  gateway_batch=True):
+    """ Measure full sweeps of a building of the given size, and the summaries built from them
+    :rtype: dict
+    :return: Medians of the measurements over the repeats
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        sensor_path = os.path.join(directory, 'sensors.csv')
+        write_sensor_file(sensor_path, sensor_count)
+        gateway, port = start_gateway(sensor_path, latency, jitter, failure_rate, gateway_batch)
+        poller = AsyncPoller('127.0.0.1', port, concurrency=concurrency, batch_size=batch_size)
+        try:
+            registry = SensorRegistry(sensor_path)
+            rooms = registry.rooms_in_combos(registry.combos())
+            session = SessionData(None)
+            collector = Collector(session, registry, poller)
+
+            # Open the connections before measuring
+            collector.sweep()
+
+            sweeps, cpu_times, record_times, lookup_times, missing = [], [], [], [], []
+            for repeat in range(repeats):
+                started, cpu_started = time.perf_counter(), time.process_time()
+                air_df = poller.poll_rooms(rooms)
+                sweeps.append(time.perf_counter() - started)
+                cpu_times.append(time.process_time() - cpu_started)
+                missing.append(int((air_df['Temperature'].astype(str) == '').sum() +
+                                   (air_df['CO2 Level'].astype(str) == '').sum()))
+
+                # What the display does with a sweep: record it, then look up a summary per selection
+                columns, units = air_df_columns(air_df)
+                started = time.perf_counter()
+                session.record_columns(columns, units)
+                record_times.append(time.perf_counter() - started)
+
+                selections = [(combo_floor, combo_wing, measurement_column)
+                              for combo_floor, combo_wing in registry.combos()
+                              for measurement_column in MEASUREMENT_COLUMNS]
+                started = time.perf_counter()
+                for selection in selections:
+                    session.aggregates.get(*selection)
+                lookup_times.append((time.perf_counter() - started) / len(selections))
+
+            # Memory is traced on a separate sweep, as tracing slows everything down
+            tracemalloc.start()
+            collector.sweep()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            poller.close()
+            gateway.kill()
+            gateway.wait()
+
+    sweep_seconds = statistics.median(sweeps)
+    return {
+        'sensors': sensor_count,
+        'rooms': len(rooms),
+        'sweep_seconds': sweep_seconds,
+        'reads_per_second': sensor_count / sweep_seconds,
+        'cpu_seconds': statistics.median(cpu_times),
+        'peak_memory_bytes': peak_memory,
+        'record_seconds': statistics.median(record_times),
+        'lookup_seconds': statistics.median(lookup_times),
+        'missing_readings': statistics.median(missing),
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """ Find the measurements that got worse than the baseline by more than the tolerance
+    :rtype: list
+    :return: (sensor count, measurement, baseline value, new value) of each regression
+    """
+    baseline_results = {result['sensors']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result['sensors'])
+        if previous is None:
+            continue
+        for measurement in COMPARED_MEASUREMENTS:
+            if previous.get(measurement) and result[measurement] > previous[measurement] * (1 + tolerance):
+                regressions.append((result['sensors'], measurement, previous[measurement], result[measurement]))
+    return regressions
+
+
+def print_results(results):
+    print('{0:>8} {1:>7} {2:>10} {3:>10} {4:>9} {5:>11} {6:>12} {7:>12} {8:>8}'.format(
+        'sensors', 'rooms', 'sweep (s)', 'reads/s', 'CPU (s)', 'peak (MiB)', 'record (ms)', 'lookup (us)', 'missing'))
+    for result in results:
+        print('{0:>8} {1:>7} {2:>10.3f} {3:>10.0f} {4:>9.3f} {5:>11.1f} {6:>12.2f} {7:>12.2f} {8:>8}'.format(
+            result['sensors'], result['rooms'], result['sweep_seconds'], result['reads_per_second'],
+            result['cpu_seconds'], result['peak_memory_bytes'] / 2 ** 20, result['record_seconds'] * 1000,
+            result['lookup_seconds'] * 1e6, result['missing_readings']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collection path against a fake gateway.')
+    parser.add_argument('--sensors', type=int, nargs='+', default=DEFAULT_SENSOR_COUNTS,
+                        help='sensor counts to benchmark')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='seconds the gateway takes to answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random extra delay, in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability of dropping a request')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='maximum gateway requests in flight at once')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='sensors read per gateway request (default: 1, one sensor per request)')
+    parser.add_argument('--no-batch-gateway', action='store_true',
+                        help='run the fake gateway without batch reads, to measure the fallback to single reads')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='measured sweeps per sensor count')
+    parser.add_argument('--save', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare the results with a JSON file saved earlier')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='slowdown over the baseline reported as a regression (default: 0.10 for 10%%)')
+    options = parser.parse_args()
+
+    results = []
+    for count in options.sensors:
+        results.append(run_benchmark(count, latency=options.latency, jitter=options.jitter,
+                                     failure_rate=options.failure_rate, concurrency=options.concurrency,
+                                     repeats=options.repeats, batch_size=options.batch_size,
+                                     gateway_batch=not options.no_batch_gateway))
+    print_results(results)
+
+    if options.save is not None:
+        with open(options.save, 'w') as results_file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': vars(options),
+                'results': results,
+            }, results_file, indent=2)
+
+    if options.baseline is not None:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), options.tolerance)
+        for sensor_count, measurement, previous, current in regressions:
+            print('Regression: {0} at {1} sensors went from {2:.6g} to {3:.6g}'.format(measurement, sensor_count,
+                                                                                     previous, current))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,359 @@
+"""
+#
+# File:              collector.py
+# Description:       Headless collection of building readings. Polls the
+#                    gateway on an interval and records every sweep to the
+#                    session archive, without a display, so that one collector
+#                    can serve any number of displays.
+#
+"""
+
+import argparse
+import os
+import signal
+import threading
+import time
+import traceback
+import weakref
+
+import metrics
+from air_aggregates import AggregateCache
+from readings_store import ReadingsStore, air_df_columns, readings_to_columns
+from rolling_stats import RollingStatsEngine
+from session_persistence import ARCHIVE_PATH, SessionArchive
+
+DEFAULT_INTERVAL = 10  # Seconds
+DEFAULT_MAX_ROWS = 1000000
+ROOM_SENSOR_PATH = os.path.join('CSVs', 'ahs_air.csv')
+HOSTNAME = '10.12.4.98'
+PORT = '8000'
+
+SWEEP_SECONDS = metrics.histogram('sweep_seconds', 'Seconds to read the rooms of a floor/wing, or of several')
+RECORD_SECONDS = metrics.histogram('session_record_seconds',
+                                   'Seconds to record a sweep: store, archive, rolling statistics and summaries')
+LOOP_ERRORS = metrics.counter('loop_errors_total', 'Exceptions caught in background loops, by loop')
+
+# Latest session of each facility, reported by the readings store gauges
+_sessions = weakref.WeakValueDictionary()
+
+
+def _by_facility(measure):
+    # Gauge function measuring every session, labelled by its facility
+    return lambda: {(() if facility is None else (('facility', facility),)): measure(session)
+                    for facility, session in list(_sessions.items())}
+
+
+metrics.gauge('readings_store_bytes', 'Bytes allocated by the in-memory readings store, by facility',
+              _by_facility(lambda session: session.readings.nbytes))
+metrics.gauge('readings_store_rows', 'Readings held in memory, by facility',
+              _by_facility(lambda session: len(session.readings)))
+
+
+def combo_label(combos):
+    # Label of a sweep in the metrics: its floor and wing, or whether it covers several
+    if combos is None:
+        return 'building'
+    if len(combos) == 1:
+        return '{0}{1}'.format(*combos[0])
+    return 'several'
+
+
+# Log an exception of a background loop, which carries on with its next iteration: the one being handled,
+# or one taken from a failed future
+def report_loop_error(loop, error=None):
+    LOOP_ERRORS.inc(loop=loop)
+    print('Error in the {0} loop, retrying on its next iteration:'.format(loop))
+    if error is None:
+        traceback.print_exc()
+    else:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+class SessionData(object):
+    """
+    Everything kept about the readings of a session: the readings themselves,
+    their archive, the summaries of their latest values, optionally their
+    rolling statistics, and the alerts raised on them. Listeners are called
+    with the columns and units of every batch recorded.
+    """
+
+    def __init__(self, archive=None, max_rows=DEFAULT_MAX_ROWS, alerts=None, rolling_stats=False, facility=None):
+        """ Constructor
+        :type archive: SessionArchive
+        :param archive: Archive new readings are written to, None to not archive them
+        :type max_rows: int
+        :param max_rows: Maximum readings kept in memory
+        :type alerts: AlertEngine
+        :param alerts: Alert rules evaluated on new readings, None to not evaluate any
+        :type rolling_stats: bool
+        :param rolling_stats: Whether to keep rolling statistics of every room and floor/wing
+        :type facility: str
+        :param facility: Facility of the readings, labelling the session's metrics
+        """
+        self.archive = archive
+        self.readings = ReadingsStore(max_rows=max_rows)
+        self.aggregates = AggregateCache()
+        self.rolling_stats = RollingStatsEngine() if rolling_stats else None
+        self.alerts = alerts
+        self.version = 0  # Incremented whenever readings are recorded
+        self.listeners = []
+        _sessions[facility] = self
+
+    def record_columns(self, columns, units, archive=True):
+        """ Record readings given as ReadingsStore.append() arguments """
+        with RECORD_SECONDS.time():
+            self.readings.units.update(units)
+            self.readings.append(**columns)
+            if archive and self.archive is not None:
+                self.archive.append_columns(columns, units)
+            if self.rolling_stats is not None:
+                self.rolling_stats.update(columns)
+            if self.alerts is not None:
+                self.alerts.update(columns)
+            self.aggregates.update(self.readings.latest(), self.readings.units)
+            self.version += 1
+        for listener in self.listeners:
+            listener(columns, units)
+
+    def record(self, air_df):
+        """ Record the rows of an air values DataFrame, parsing them only once """
+        if air_df is None or air_df.empty:
+            return
+        columns, units = air_df_columns(air_df)
+        self.record_columns(columns, units)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+class Collector(object):
+    """
+    Sweeps the rooms of the sensor registry through a poller and records
+    the readings to a session. Listeners are called with the DataFrame of
+    every sweep.
+    """
+
+    def __init__(self, session, registry, poller, interval=DEFAULT_INTERVAL):
+        """ Constructor
+        :type session: SessionData
+        :param session: Session the readings are recorded to
+        :type registry: SensorRegistry
+        :param registry: Rooms and their sensors
+        :type poller: AsyncPoller
+        :param poller: Poller used to read the sensors
+        :type interval: float
+        :param interval: Seconds between the starts of consecutive sweeps
+        """
+        self.session = session
+        self.registry = registry
+        self.poller = poller
+        self.interval = interval
+        self.listeners = []
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def sweep(self, combos=None):
+        """ Read and record every room of the given (floor, wing) combinations, all of them by default
+        :rtype: DataFrame
+        """
+        rooms = self.registry.rooms_in_combos(self.registry.combos() if combos is None else combos)
+        with SWEEP_SECONDS.time(combo=combo_label(combos)):
+            air_df = self.poller.poll_rooms(rooms)
+        return self.publish(air_df)
+
+    def publish(self, air_df):
+        """ Record an air values DataFrame read by this collector's poller and pass it to the listeners
+        :rtype: DataFrame
+        """
+        self.session.record(air_df)
+        for listener in self.listeners:
+            listener(air_df)
+        return air_df
+
+    def run(self):
+        """ Sweep the whole building every interval until stopped """
+        while not self.stopped():
+            started = time.monotonic()
+            try:
+                self.sweep()
+            except Exception:
+                report_loop_error('sweep')
+            self._stop_event.wait(max(0, self.interval - (time.monotonic() - started)))
+
+
+class ArchiveFollower(object):
+    """
+    Reads the readings that a collector in another process writes to its
+    archive, and records them to a local session without archiving them
+    again.
+    """
+
+    def __init__(self, session, directory=ARCHIVE_PATH, interval=DEFAULT_INTERVAL):
+        """ Constructor
+        :type session: SessionData
+        :param session: Local session the readings are recorded to
+        :type directory: str
+        :param directory: Output directory of the collector
+        :type interval: float
+        :param interval: Seconds between checks for new readings
+        """
+        self.session = session
+        self.archive = SessionArchive(directory, read_only=True)
+        self.interval = interval
+        self.listeners = []
+        self._cursor = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def poll(self):
+        """ Record the readings written since the last poll
+        :rtype: DataFrame
+        :return: The new readings, in the ReadingsStore.view() format
+        """
+        new_readings, self._cursor = self.archive.read_new(self._cursor)
+        if not new_readings.empty:
+            self.session.record_columns(readings_to_columns(new_readings), self.archive.units, archive=False)
+            for listener in self.listeners:
+                listener(new_readings)
+        return new_readings
+
+    def run(self):
+        """ Poll for new readings every interval until stopped """
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception:
+                report_loop_error('archive follower')
+            self._stop_event.wait(self.interval)
+
+
+if __name__ == '__main__':
+    from adaptive_polling import DEFAULT_MAX_RATE
+    from alerts import AlertNotifier, LogFileSink, RULES_PATH, WebhookSink, load_rules
+    from async_polling import DEFAULT_CONCURRENCY
+    from bacnet_gateway_requests import DEFAULT_BATCH_SIZE
+    from facilities import FacilityCollectors, GATEWAYS_PATH, load_gateways
+    from rollups import DEFAULT_RAW_RETENTION
+
+    parser = argparse.ArgumentParser(description='Collect building air readings without a display.')
+    parser.add_argument('--hostname', default=HOSTNAME,
+                        help='hostname or IP address of the BACnet gateway of facilities missing from --gateways')
+    parser.add_argument('--port', default=PORT, help='port of that BACnet gateway')
+    parser.add_argument('--gateways', default=GATEWAYS_PATH,
+                        help='CSV file of the gateway of each facility (Facility, Hostname and Port columns)')
+    parser.add_argument('--sensors', default=ROOM_SENSOR_PATH, help='room sensor CSV file')
+    parser.add_argument('--facilities', nargs='+', default=None,
+                        help='facilities to collect (default: every facility of the room sensor file)')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between sweeps')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='maximum requests in flight at once to each gateway')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='sensors read per gateway request, for gateways that support batch reads; others are '
+                             'detected and read one sensor per request (default: 1)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='poll each sensor on its own period, adapted to how fast its readings change, '
+                             'instead of sweeping every interval (see adaptive_polling.py)')
+    parser.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE,
+                        help='requests per second allowed to each gateway with --adaptive')
+    parser.add_argument('--output', default=ARCHIVE_PATH,
+                        help='archive directory displays read from, with a Facility=<name> directory per facility '
+                             'when the room sensor file has several')
+    parser.add_argument('--shared-readings', action='store_true',
+                        help='also keep the latest readings in a memory-mapped file in the output directory of each '
+                             'facility, read in place by displays on this machine (see shared_readings.py)')
+    parser.add_argument('--rolling-stats', action='store_true',
+                        help='keep rolling statistics (running, EWMA and 15 min, 1 h and 24 h windows) of every room '
+                             'and floor/wing, served at /stats with --api-port (see rolling_stats.py)')
+    parser.add_argument('--flush-interval', type=float, default=0,
+                        help='minimum seconds between archive writes (default: write every sweep)')
+    parser.add_argument('--raw-retention-days', type=float, default=DEFAULT_RAW_RETENTION / (24 * 60 * 60),
+                        help='days of raw readings to archive once rolled up into 5-minute, hourly and daily '
+                             'tiers (0 to keep all of them, see rollups.py)')
+    parser.add_argument('--alert-rules', default=RULES_PATH,
+                        help='CSV file of alert rules (default rules if it does not exist, see alerts.py)')
+    parser.add_argument('--alert-log', default=None, help='append raised and cleared alerts to this file')
+    parser.add_argument('--alert-webhook', default=None, help='post raised and cleared alerts as JSON to this URL')
+    parser.add_argument('--api-port', type=int, default=None,
+                        help='also serve the readings over HTTP on this port (see read_api.py)')
+    parser.add_argument('--api-host', default='127.0.0.1', help='address the HTTP API listens on')
+    parser.add_argument('--metrics', action='store_true',
+                        help='collect performance metrics, served at /metrics with --api-port (see metrics.py)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='collect performance metrics and write them to this JSON file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.DEFAULT_DUMP_INTERVAL,
+                        help='seconds between writes of --metrics-file')
+    options = parser.parse_args()
+
+    if options.metrics:
+        metrics.enable()
+    dumper = None
+    if options.metrics_file is not None:
+        dumper = metrics.MetricsDumper(options.metrics_file, options.metrics_interval)
+
+    sinks = []
+    if options.alert_log is not None:
+        sinks.append(LogFileSink(options.alert_log))
+    if options.alert_webhook is not None:
+        sinks.append(WebhookSink(options.alert_webhook))
+
+    collection = FacilityCollectors(options.sensors, options.output, options.hostname, options.port,
+                                    gateways=load_gateways(options.gateways), facilities=options.facilities,
+                                    interval=options.interval, concurrency=options.concurrency,
+                                    flush_interval=options.flush_interval,
+                                    raw_retention=options.raw_retention_days * 24 * 60 * 60 or None,
+                                    alert_rules=load_rules(options.alert_rules),
+                                    notifier=AlertNotifier(sinks) if sinks else None,
+                                    shared_readings=options.shared_readings, batch_size=options.batch_size,
+                                    rolling_stats=options.rolling_stats)
+    if options.adaptive:
+        collection.poll_adaptively(options.interval, options.max_rate)
+
+    def terminate(signal_number, frame):
+        raise KeyboardInterrupt
+
+    # Stop cleanly when the service manager asks
+    signal.signal(signal.SIGTERM, terminate)
+
+    for shard in collection.shards.values():
+        print('Collecting {0} from {1}:{2} every {3} s into {4}'.format(shard.facility, shard.endpoint[0],
+                                                                      shard.endpoint[1], options.interval,
+                                                                      shard.session.archive.directory))
+    try:
+        collection.run()
+        if options.api_port is None:
+            while True:
+                time.sleep(options.interval)
+        else:
+            import asyncio
+            from read_api import ReadApiServer
+
+            server = ReadApiServer.for_shards(collection.shards.values(), host=options.api_host,
+                                              port=options.api_port)
+
+            async def serve():
+                # Let the event loop handle the stop signals so open connections are closed cleanly
+                stop_event = asyncio.Event()
+                for signal_number in (signal.SIGINT, signal.SIGTERM):
+                    asyncio.get_running_loop().add_signal_handler(signal_number, stop_event.set)
+                await server.start()
+                print('Serving readings on http://{0}:{1}'.format(options.api_host, server.port))
+                await stop_event.wait()
+                server.close()
+
+            asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collection.stop()
+        print('Saving session data... please wait')
+        collection.close()
+        if dumper is not None:
+            dumper.dump()
@@ -0,0 +1,165 @@
+"""
+#
+# File:              facilities.py
+# Description:       Collection partitioned by facility. Each facility of the
+#                    room sensor file gets its own registry view, session and
+#                    archive, and sweeps on its own thread. Facilities behind
+#                    the same gateway share one poller, so each gateway has an
+#                    independent pool of requests.
+#
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from alerts import AlertEngine
+from async_polling import AsyncPoller, DEFAULT_CONCURRENCY
+from bacnet_gateway_requests import DEFAULT_BATCH_SIZE
+from collector import Collector, SessionData, DEFAULT_INTERVAL, DEFAULT_MAX_ROWS, HOSTNAME, PORT, ROOM_SENSOR_PATH
+from rollups import DEFAULT_RAW_RETENTION, Rollups
+from sensor_registry import SensorRegistry
+from session_persistence import ARCHIVE_PATH, SessionArchive
+from shared_readings import SHARED_READINGS_FILE, SharedReadingsWriter
+
+# Gateway of each facility, as Facility, Hostname and Port columns. Facilities not listed use the default gateway.
+GATEWAYS_PATH = os.path.join('CSVs', 'gateways.csv')
+
+
+def load_gateways(path=GATEWAYS_PATH):
+    """ Read the gateway of each facility
+    :rtype: dict
+    :return: Facility -> (hostname, port), empty if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return {}
+    gateways = pd.read_csv(path, dtype=str, na_filter=False)
+    return {facility.strip(): (hostname.strip(), port.strip())
+            for facility, hostname, port in zip(gateways['Facility'], gateways['Hostname'], gateways['Port'])}
+
+
+def facility_archive_path(directory, facility, facilities):
+    # A single facility keeps the archive layout of earlier versions, several get a partition each
+    if len(facilities) <= 1:
+        return directory
+    return os.path.join(directory, 'Facility={0}'.format(facility))
+
+
+class FacilityShard(object):
+    """Collection state of one facility"""
+
+    def __init__(self, facility, endpoint, session, collector, rollups):
+        self.facility = facility
+        self.endpoint = endpoint  # (hostname, port) of its gateway
+        self.session = session
+        self.collector = collector
+        self.rollups = rollups
+        self.poll_loop = collector  # Replaced by an AdaptiveScheduler when sensors are polled adaptively
+        self.shared_readings = None  # SharedReadingsWriter, when displays on the same machine read in place
+
+
+class FacilityCollectors(object):
+    """
+    One Collector per facility of the room sensor file, each recording to its
+    own session and archive. A slow or unreachable gateway only delays the
+    facilities behind it, and adding a facility adds a shard instead of
+    lengthening everyone's sweep.
+    """
+
+    def __init__(self, sensor_path=ROOM_SENSOR_PATH, output=ARCHIVE_PATH, hostname=HOSTNAME, port=PORT,
+                 gateways=None, facilities=None, interval=DEFAULT_INTERVAL, concurrency=DEFAULT_CONCURRENCY,
+                 flush_interval=0, max_rows=DEFAULT_MAX_ROWS, raw_retention=DEFAULT_RAW_RETENTION, alert_rules=None,
+                 notifier=None, shared_readings=False, batch_size=DEFAULT_BATCH_SIZE, rolling_stats=False):
+        """ Constructor
+        :type sensor_path: str
+        :param sensor_path: Room sensor CSV file
+        :type output: str
+        :param output: Archive directory, with a Facility=<name> partition per facility if there are several
+        :type hostname: str
+        :param hostname: Gateway of the facilities missing from gateways
+        :type port: str
+        :param port: Port of that gateway
+        :type gateways: dict
+        :param gateways: Facility -> (hostname, port), read from GATEWAYS_PATH by default
+        :type facilities: list
+        :param facilities: Facilities to collect, all of the room sensor file by default
+        :type interval: float
+        :param interval: Seconds between the starts of consecutive sweeps of a facility
+        :type concurrency: int
+        :param concurrency: Maximum requests in flight at once to each gateway
+        :type flush_interval: float
+        :param flush_interval: Minimum seconds between archive writes
+        :type max_rows: int
+        :param max_rows: Maximum readings kept in memory per facility
+        :type raw_retention: float
+        :param raw_retention: Seconds of raw readings archived once rolled up, None to keep all of them
+        :type alert_rules: list
+        :param alert_rules: Alert rules evaluated on the readings of every facility, defaults to DEFAULT_RULES
+        :type notifier: AlertNotifier
+        :param notifier: Notifier shared by the facilities' alerts, None to not send any
+        :type shared_readings: bool
+        :param shared_readings: Whether to also keep each facility's latest readings in a shared readings file in
+                                its archive directory, for displays on the same machine (see shared_readings.py)
+        :type batch_size: int
+        :param batch_size: Maximum sensors read per gateway request, 1 to read them one at a time
+        :type rolling_stats: bool
+        :param rolling_stats: Whether to keep rolling statistics of every room and floor/wing of each facility
+        """
+        every_facility = SensorRegistry(sensor_path).facilities()
+        gateways = load_gateways() if gateways is None else gateways
+        self.notifier = notifier
+        self.pollers = OrderedDict()  # (hostname, port) -> AsyncPoller shared by the facilities behind it
+        self.shards = OrderedDict()  # Facility -> FacilityShard
+
+        for facility in every_facility if facilities is None else facilities:
+            endpoint = tuple(gateways.get(facility, (hostname, port)))
+            if endpoint not in self.pollers:
+                self.pollers[endpoint] = AsyncPoller(endpoint[0], endpoint[1], concurrency=concurrency,
+                                                     batch_size=batch_size)
+            archive = SessionArchive(facility_archive_path(output, facility, every_facility),
+                                     flush_interval=flush_interval)
+            session = SessionData(archive, max_rows=max_rows,
+                                  alerts=AlertEngine(alert_rules, notifier=notifier, facility=facility),
+                                  rolling_stats=rolling_stats, facility=facility)
+            collector = Collector(session, SensorRegistry(sensor_path, facility=facility), self.pollers[endpoint],
+                                  interval=interval)
+            self.shards[facility] = FacilityShard(facility, endpoint, session, collector,
+                                                  Rollups(archive, raw_retention=raw_retention))
+            if shared_readings:
+                self.shards[facility].shared_readings = SharedReadingsWriter(
+                    os.path.join(archive.directory, SHARED_READINGS_FILE), collector.registry, session)
+                session.listeners.append(self.shards[facility].shared_readings.update)
+
+    def poll_adaptively(self, initial_period, max_rate):
+        """ Poll each sensor on its own period instead of sweeping, sharing each gateway's request budget """
+        from adaptive_polling import AdaptiveScheduler
+
+        for shard in self.shards.values():
+            sharing = sum(1 for other in self.shards.values() if other.endpoint == shard.endpoint)
+            shard.poll_loop = AdaptiveScheduler(shard.collector, initial_period=initial_period,
+                                                max_rate=max_rate / sharing)
+
+    def run(self):
+        """ Start polling and rolling up every facility, each on its own threads """
+        for shard in self.shards.values():
+            for target in (shard.poll_loop.run, shard.rollups.run):
+                thread = threading.Thread(target=target, args=())
+                thread.daemon = True  # Daemonize thread
+                thread.start()
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard.poll_loop.stop()
+            shard.rollups.stop()
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.session.close()
+            if shard.shared_readings is not None:
+                shard.shared_readings.close()
+        for poller in self.pollers.values():
+            poller.close()
+        if self.notifier is not None:
+            self.notifier.close()
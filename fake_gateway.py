@@ -0,0 +1,200 @@
+"""
+#
+# File:              fake_gateway.py
+# Description:       Local stand-in for the BACnet gateway, speaking the same
+#                    bacnet_response/presentValue JSON protocol, with injectable
+#                    latency, dropped connections and error pages for testing
+#                    the gateway client. Batch
+#                    reads (read_multiple) can be answered, or ignored like a
+#                    gateway that does not support them.
+#
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ROOM_SENSOR_PATH = os.path.join('CSVs', 'ahs_air.csv')
+
+
+# Build instance -> (value, units) for every sensor in the room sensor file
+def load_sensors(path=ROOM_SENSOR_PATH):
+    sensors = {}
+    with open(path, newline='') as sensor_file:
+        for row in csv.DictReader(row for row in sensor_file if not row.startswith('#')):
+            facility = row['Facility']
+            if row['Temperature'].isdigit():
+                sensors[(facility, row['Temperature'])] = (random.uniform(66, 78), 'deg F')
+            if row['CO2'].isdigit():
+                sensors[(facility, row['CO2'])] = (random.uniform(400, 1200), 'ppm')
+    return sensors
+
+
+# Write a room sensor file with the given number of sensors, a temperature and a CO2 sensor per room, with the rooms
+# spread evenly over the floors and wings
+def write_sensor_file(path, sensor_count, floors=3, wings='ABCDE', facility='ahs', first_instance=3000001):
+    with open(path, 'w', newline='') as sensor_file:
+        writer = csv.writer(sensor_file)
+        writer.writerow(['Label', 'Facility', 'Temperature', 'CO2', 'Wing', 'Floor'])
+        for room in range((sensor_count + 1) // 2):
+            room_floor = 1 + room % floors
+            room_wing = wings[(room // floors) % len(wings)]
+            temperature = first_instance + 2 * room
+            co2 = temperature + 1 if 2 * room + 1 < sensor_count else ''
+            writer.writerow(['{0}{1}{2:05d}'.format(room_floor, room_wing, room), facility, temperature, co2,
+                             room_wing, room_floor])
+
+
+class _GatewayServer(ThreadingHTTPServer):
+    request_queue_size = 128  # Accept a burst of concurrent connections, as the real gateway's server does
+    daemon_threads = True
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        gateway = self.server.gateway
+        length = int(self.headers.get('Content-Length', 0))
+        args = parse_qs(self.rfile.read(length).decode('utf-8'))
+
+        gateway.count_request()
+        delay = gateway.latency + random.uniform(0, gateway.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if gateway.down or random.random() < gateway.failure_rate:
+            # Drop the connection without answering
+            self.close_connection = True
+            return
+
+        if random.random() < gateway.error_rate:
+            # Answer like a web server in front of a failing gateway
+            body = b'<html><body><h1>500 Internal Server Error</h1></body></html>'
+            self.send_response(500)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if 'read_multiple' in args and gateway.batch:
+            body = json.dumps(gateway.batch_response_for(json.loads(args['read_multiple'][0]))).encode('utf-8')
+        else:
+            facility = args.get('facility', [''])[0]
+            instance = args.get('instance', [''])[0]
+            body = json.dumps(gateway.response_for(facility, instance)).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGateway(object):
+    """
+    Threaded HTTP server answering gateway requests on localhost. Use as a
+    context manager, or call start() and stop().
+    """
+
+    def __init__(self, port=0, sensors=None, latency=0.0, jitter=0.0, failure_rate=0.0, batch=True, error_rate=0.0):
+        """ Constructor
+        :type port: int
+        :param port: Port to listen on, 0 picks a free port
+        :type sensors: dict
+        :param sensors: (facility, instance) -> (value, units), defaults to the room sensor file
+        :type latency: float
+        :param latency: Seconds added to every response
+        :type jitter: float
+        :param jitter: Upper bound of a random extra delay per response, in seconds
+        :type failure_rate: float
+        :param failure_rate: Probability that a request's connection is dropped
+        :type batch: bool
+        :param batch: Whether to answer batch reads, otherwise they are answered as a read of no instance
+        :type error_rate: float
+        :param error_rate: Probability that a request is answered with a 500 error page instead of JSON
+        """
+        self.sensors = sensors if sensors is not None else load_sensors()
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.batch = batch
+        self.error_rate = error_rate
+        self.down = False
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+        self.server = _GatewayServer(('127.0.0.1', port), _GatewayHandler)
+        self.server.gateway = self
+        self.hostname, self.port = self.server.server_address[:2]
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def response_for(self, facility, instance):
+        sensor = self.sensors.get((facility, instance))
+        if sensor is None:
+            return {'bacnet_response': {'success': True, 'data': {'success': False}}}
+
+        # Let the value drift a little between reads
+        value, units = sensor
+        value += random.uniform(-0.5, 0.5)
+        self.sensors[(facility, instance)] = (value, units)
+        return {'bacnet_response': {'success': True,
+                                    'data': {'success': True, 'presentValue': value, 'units': units}}}
+
+    def batch_response_for(self, pairs):
+        results = [self.response_for(facility, instance)['bacnet_response']['data'] for facility, instance in pairs]
+        return {'bacnet_response': {'success': True, 'data': {'success': True, 'results': results}}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the BACnet gateway.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random extra delay, in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability of dropping a request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of answering with a 500 error page')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='ignore batch reads, like a gateway that only answers one instance per request')
+    parser.add_argument('--sensors', default=ROOM_SENSOR_PATH, help='room sensor CSV file of the sensors to serve')
+    options = parser.parse_args()
+
+    gateway = FakeGateway(options.port, sensors=load_sensors(options.sensors), latency=options.latency,
+                          jitter=options.jitter, failure_rate=options.failure_rate, batch=not options.no_batch,
+                          error_rate=options.error_rate)
+    print('Fake gateway listening on {0}:{1}'.format(gateway.hostname, gateway.port), flush=True)
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        gateway.server.server_close()
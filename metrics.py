@@ -0,0 +1,305 @@
+"""
+#
+# File:              metrics.py
+# Description:       Counters, timing histograms and gauges for the gateway
+#                    calls, sweeps, file reads and display refreshes, exported
+#                    as Prometheus text or JSON. Metrics are off by default and
+#                    cost a single flag check per update until enabled.
+#
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+DEFAULT_DUMP_INTERVAL = 60  # Seconds
+
+_enabled = False
+_metrics = {}  # Name -> metric, in registration order
+_registry_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonic count per set of labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(key, value) for key, value in self._values.items()]
+
+    def prometheus(self):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(key), _format_value(value))
+                for key, value in self.samples()]
+
+    def json(self):
+        return [{'labels': dict(key), 'value': value} for key, value in self.samples()]
+
+
+class _Timer(object):
+    """Observes the seconds spent in a with block into a histogram"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _NullTimer(object):
+    """Stands in for a timer while metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Histogram(object):
+    """Distribution of observed values per set of labels, in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # Label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = state
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        """ Time a with block
+        :rtype: object
+        :return: Context manager observing its duration, a no-op while metrics are disabled
+        """
+        if not _enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self):
+        # Cumulative bucket counts, sum and count of each set of labels
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = []
+                total = 0
+                for count in state[:len(self.buckets)]:
+                    total += count
+                    cumulative.append(total)
+                samples.append((key, cumulative, state[-2], state[-1]))
+        return samples
+
+    def prometheus(self):
+        lines = []
+        for key, cumulative, total, count in self.samples():
+            for bound, bucket_count in zip(self.buckets, cumulative):
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(key, [('le', _format_value(bound))]),
+                                                        bucket_count))
+            lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(key, [('le', '+Inf')]), count))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(key), _format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(key), count))
+        return lines
+
+    def json(self):
+        return [{'labels': dict(key), 'count': count, 'sum': total,
+                 'buckets': dict(zip([str(bound) for bound in self.buckets], cumulative))}
+                for key, cumulative, total, count in self.samples()]
+
+
+class Gauge(object):
+    """
+    Value read from a function when the metrics are exported, so it costs
+    nothing in between. The function returns a number, or a dictionary of
+    label tuples to numbers, and may be replaced as its owner is recreated.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        try:
+            value = self.function()
+        except Exception:
+            return []  # The owner is not ready yet, or has been closed
+        if isinstance(value, dict):
+            return [(_label_key(dict(labels)), sample) for labels, sample in value.items()]
+        return [((), value)]
+
+    def prometheus(self):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(key), _format_value(value))
+                for key, value in self.samples()]
+
+    def json(self):
+        return [{'labels': dict(key), 'value': value} for key, value in self.samples()]
+
+
+def _register(metric_class, name, *args):
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = metric_class(name, *args)
+            _metrics[name] = metric
+        return metric
+
+
+def counter(name, description):
+    """ Get the counter of the given name, registering it on first use
+    :rtype: Counter
+    """
+    return _register(Counter, name, description)
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    """ Get the histogram of the given name, registering it on first use
+    :rtype: Histogram
+    """
+    return _register(Histogram, name, description, buckets)
+
+
+def gauge(name, description, function):
+    """ Register the function read by the gauge of the given name, replacing any earlier one
+    :rtype: Gauge
+    """
+    metric = _register(Gauge, name, description)
+    metric.function = function
+    return metric
+
+
+def render_prometheus():
+    """ Export every metric in the Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    for metric in list(_metrics.values()):
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+        lines.extend(metric.prometheus())
+    return '\n'.join(lines) + '\n'
+
+
+def render_json():
+    """ Export every metric as a JSON document
+    :rtype: str
+    """
+    return json.dumps({
+        'timestamp': time.time(),
+        'metrics': {metric.name: {'type': metric.kind, 'help': metric.description, 'values': metric.json()}
+                    for metric in list(_metrics.values())},
+    })
+
+
+class MetricsDumper(object):
+    """
+    Writes the JSON export of the metrics to a file every interval, replacing
+    it atomically so readers never see a partial file. Enables the metrics.
+    """
+
+    def __init__(self, path, interval=DEFAULT_DUMP_INTERVAL):
+        """ Constructor
+        :type path: str
+        :param path: File the metrics are written to
+        :type interval: float
+        :param interval: Seconds between writes
+        """
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        enable()
+
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def dump(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(render_json())
+        os.replace(temporary_path, self.path)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
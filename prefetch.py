@@ -0,0 +1,144 @@
+"""
+#
+# File:              prefetch.py
+# Description:       Warms the readings of every floor/wing at startup, the
+#                    selected one first and then its neighbours, and keeps
+#                    them all refreshed in the background.
+#
+"""
+
+import threading
+import time
+
+from concurrent.futures import wait
+
+from collector import report_loop_error
+
+DEFAULT_INTERVAL = 10  # Seconds between refreshes of the whole building
+DEFAULT_BATCH_SIZE = 4  # Cold floor/wing combinations swept together while warming up
+
+
+class PrefetchScheduler(object):
+    """
+    Drives a Collector one floor/wing batch at a time. Until every combination
+    has readings, cold combinations are swept in priority order: the focused
+    (selected) one alone, then its nearest neighbours in batches. Once the
+    building is warm, it is swept as a whole every interval (or left to a
+    refresher), and focusing a cold combination sweeps it right away.
+    """
+
+    def __init__(self, collector, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE, refresher=None,
+                 requests=None):
+        """ Constructor
+        :type collector: Collector
+        :param collector: Collector used to sweep and record the rooms
+        :type interval: float
+        :param interval: Seconds between refreshes of the whole building
+        :type batch_size: int
+        :param batch_size: Cold combinations swept together while warming up
+        :type refresher: AdaptiveScheduler
+        :param refresher: Polls the sensors once the building is warm, instead of whole-building sweeps
+        :type requests: RequestManager
+        :param requests: Reads cold combinations one request each, so they are shared with on-demand reads
+        """
+        self.collector = collector
+        self.interval = interval
+        self.batch_size = batch_size
+        self.refresher = refresher
+        self.requests = requests
+        self.warm = set()
+        self._focus = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._next_refresh = time.monotonic() + interval
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def focus(self, selected_floor, selected_wing):
+        """ Move a floor and wing to the front of the queue, sweeping it next if it is cold """
+        self._focus = (int(selected_floor), str(selected_wing))
+        if self._focus not in self.warm:
+            self._wake.set()
+
+    def priority(self):
+        """ Get every (floor, wing) combination, the focused one first and then by distance from it
+        :rtype: list
+        """
+        combos = self.collector.registry.combos()
+        if self._focus is None:
+            return combos
+
+        focus_floor, focus_wing = self._focus
+        wings = sorted(set(combo_wing for combo_floor, combo_wing in combos) | {focus_wing})
+        focus_index = wings.index(focus_wing)
+
+        def distance(combo):
+            return abs(combo[0] - focus_floor) + abs(wings.index(combo[1]) - focus_index)
+
+        return sorted(combos, key=lambda combo: (distance(combo), combo))
+
+    def _warm_from(self, air_df):
+        # A combination is warm once the gateway has answered for one of its rooms
+        if air_df is None or air_df.empty:
+            return
+        answered = air_df[(air_df['Temperature'].astype(str) != '') | (air_df['CO2 Level'].astype(str) != '')]
+        for combo_floor, combo_wing in zip(answered['Floor'], answered['Wing']):
+            if str(combo_floor) != '' and str(combo_wing) != '':
+                self.warm.add((int(combo_floor), str(combo_wing)))
+
+    def _sweep(self, combos):
+        warmed = len(self.warm)
+        if self.requests is None:
+            self._warm_from(self.collector.sweep(combos))
+        else:
+            # Cancelled and failed requests are still cold, and requested again in a later batch
+            futures = [self.requests.request(combo_floor, combo_wing) for combo_floor, combo_wing in combos]
+            for future in wait(futures).done:
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    report_loop_error('prefetch', future.exception())
+                else:
+                    self._warm_from(future.result())
+        return len(self.warm) - warmed
+
+    def run_once(self):
+        """ Sweep the next batch of cold combinations, or the whole building if it is due for a refresh
+        :rtype: bool
+        :return: Whether a cold combination was warmed, so the next batch should follow right away
+        """
+        combos = self.priority()
+        cold = [combo for combo in combos if combo not in self.warm]
+        if cold:
+            # The focused combination goes alone, so the display has it after a single round trip
+            batch = cold[:1] if cold[0] == self._focus else cold[:self.batch_size]
+            if self._sweep(batch):
+                return True
+
+        if self.refresher is not None:
+            self._next_refresh = time.monotonic() + self.refresher.poll_due()
+        elif time.monotonic() >= self._next_refresh:
+            self._next_refresh = time.monotonic() + self.interval
+            self._sweep(combos)
+        return False
+
+    def run(self):
+        """ Warm up, then refresh every interval until stopped """
+        while not self.stopped():
+            self._wake.clear()
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                report_loop_error('prefetch')
+                # Not right away, so a sweep that keeps failing is not retried in a tight loop
+                self._next_refresh = time.monotonic() + (self.interval if self.refresher is None
+                                                         else self.refresher.min_period)
+
+            # Wait for the next refresh, or for a cold combination to be focused
+            self._wake.wait(max(0, self._next_refresh - time.monotonic()))
@@ -0,0 +1,459 @@
+"""
+#
+# File:              read_api.py
+# Description:       Small asyncio HTTP server answering JSON queries from the
+#                    cached readings of a session, so displays and other
+#                    clients never have to talk to the BACnet gateway directly.
+#
+#                    GET /latest       Latest reading of every room
+#                    GET /aggregates   Summaries of every floor/wing
+#                    GET /readings     Readings between start and end (epoch seconds)
+#                    GET /history      Minimum, mean, maximum and count of each room's
+#                                      readings between start and end, in buckets no
+#                                      longer than resolution seconds (see rollups.py)
+#                    GET /alerts       Alerts currently raised (see alerts.py)
+#                    GET /stats        Rolling statistics of each floor/wing, or of
+#                                      one room with room=<label>: running count,
+#                                      mean, variance, min, max, EWMA and latest
+#                                      value, and 15 min, 1 h and 24 h windows,
+#                                      when kept (see rolling_stats.py)
+#                    GET /facilities   Floor/wing combinations of every facility served
+#                    GET /stream       Server-sent events: a snapshot of every room's
+#                                      latest reading, then the rooms whose readings
+#                                      changed each time new ones are recorded (see
+#                                      reading_stream.py). Clients reconnecting with
+#                                      Last-Event-ID resume where they left off
+#                    GET /metrics      Performance metrics in the Prometheus text format,
+#                                      when they are enabled (see metrics.py)
+#
+#                    Each accepts optional facility, floor and wing query
+#                    parameters, the first facility served being the default.
+#                    /latest also accepts max_age (seconds): if the selected
+#                    floor/wing is older than that, it is fetched from the
+#                    gateway first, with simultaneous requests sharing one fetch.
+#
+"""
+
+import asyncio
+import gzip
+import json
+import math
+import time
+import traceback
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+import metrics
+from reading_stream import ReadingStream
+from readings_store import DATE_FORMAT, readings_to_columns
+from rolling_stats import MEASUREMENT_COLUMNS
+from rollups import Rollups, local_now
+
+DEFAULT_API_PORT = 8080
+MAX_CACHED_RESPONSES = 256
+MAX_HEADER_LINES = 100
+STREAM_KEEPALIVE = 15  # Seconds between comments sent on an idle stream, so proxies and clients keep it open
+API_PATHS = ['/latest', '/aggregates', '/readings', '/history', '/alerts', '/stats', '/facilities', '/stream',
+             '/metrics']
+
+API_REQUEST_SECONDS = metrics.histogram('api_request_seconds', 'Seconds to answer a read API request')
+API_RESPONSE_CACHE = metrics.counter('api_response_cache_total', 'Read API bodies served from or added to the cache')
+API_STREAM_EVENTS = metrics.counter('api_stream_events_total', 'Snapshot and delta events sent to stream clients')
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+STATUS_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}
+
+
+def _clean(value):
+    # JSON has no NaN, report missing values as null
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class _Facility(object):
+    """Session and collector of one facility served, with its gateway fetches"""
+
+    def __init__(self, name, session, collector):
+        self.name = name
+        self.session = session
+        self.collector = collector
+        self.fetched_at = {}  # (floor, wing) -> time.monotonic() of the latest sweep that included it
+        self.in_flight = {}  # (floor, wing) -> future of the gateway fetch in progress
+        self.rollups = Rollups(session.archive) if session.archive is not None else None
+        if collector is not None:
+            collector.listeners.append(self.note_sweep)
+
+        # Listening first, so no readings recorded meanwhile are missed
+        self.stream = ReadingStream()
+        session.listeners.append(self.stream.publish)
+        latest = session.readings.latest()
+        if not latest.empty:
+            self.stream.publish(readings_to_columns(latest), session.readings.units)
+
+    def note_sweep(self, air_df):
+        now = time.monotonic()
+        for combo_floor, combo_wing in set(zip(air_df['Floor'], air_df['Wing'])):
+            if not pd.isna(combo_floor) and combo_wing != '':
+                self.fetched_at[(int(combo_floor), str(combo_wing))] = now
+
+    def combos(self):
+        # From the room sensor file when collecting, otherwise from the readings seen so far
+        if self.collector is not None:
+            return self.collector.registry.combos()
+        latest = self.session.readings.latest()
+        return sorted(set((int(combo_floor), str(combo_wing))
+                          for combo_floor, combo_wing in zip(latest['Floor'], latest['Wing'])
+                          if not pd.isna(combo_floor) and combo_wing != ''))
+
+
+class ReadApiServer(object):
+    """
+    Serves the readings of a SessionData over HTTP, or of one per facility.
+    Responses carry an ETag derived from the server's start time and the
+    session version, so clients polling with If-None-Match get an empty 304
+    until new readings arrive, or the collector restarts, and encoded bodies
+    are cached until then. Bodies are built and gzipped (for clients that
+    accept it) on worker threads, so slow queries never hold up the event
+    loop. /stream instead keeps its connection open and pushes new readings
+    as they are recorded.
+    """
+
+    def __init__(self, session, collector=None, host='127.0.0.1', port=DEFAULT_API_PORT, facility=None):
+        """ Constructor
+        :type session: SessionData
+        :param session: Session whose readings are served
+        :type collector: Collector
+        :param collector: Collector used to refresh stale floors and wings, None to only serve cached readings
+        :type host: str
+        :param host: Address to listen on
+        :type port: int
+        :param port: Port to listen on
+        :type facility: str
+        :param facility: Name of the facility of the session, served by default
+        """
+        self.session = session
+        self.collector = collector
+        self.host = host
+        self.port = port
+        self.upstream_fetches = 0
+        self.epoch = '{0:x}'.format(int(time.time() * 1000))  # Distinguishes versions of sessions before a restart
+
+        self.stream_clients = 0
+        metrics.gauge('api_stream_clients', 'Clients connected to the read API stream', lambda: self.stream_clients)
+
+        self._server = None
+        self._responses = OrderedDict()
+        self._facilities = OrderedDict()  # Facility -> _Facility, the default one first
+        self.add_facility(facility, session, collector)
+
+    @classmethod
+    def for_shards(cls, shards, host='127.0.0.1', port=DEFAULT_API_PORT):
+        """ Serve every facility of a FacilityCollectors, the first one by default
+        :rtype: ReadApiServer
+        """
+        shards = list(shards)
+        server = cls(shards[0].session, shards[0].collector, host=host, port=port, facility=shards[0].facility)
+        for shard in shards[1:]:
+            server.add_facility(shard.facility, shard.session, shard.collector)
+        return server
+
+    def add_facility(self, facility, session, collector=None):
+        """ Serve the readings of another facility, selected with the facility query parameter """
+        self._facilities[facility] = _Facility(facility, session, collector)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def _refresh(self, source, combo):
+        # Simultaneous requests for the same floor and wing share one gateway fetch
+        future = source.in_flight.get(combo)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            self.upstream_fetches += 1
+            future = loop.run_in_executor(None, source.collector.sweep, [combo])
+            source.in_flight[combo] = future
+            future.add_done_callback(lambda done: source.in_flight.pop(combo, None))
+        await asyncio.shield(future)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                for line_number in range(MAX_HEADER_LINES):
+                    if request_line not in (b'\r\n', b'\n'):
+                        break
+                    request_line = await reader.readline()  # Empty lines before a request are ignored (RFC 7230)
+                if not request_line:
+                    break
+                headers = {}
+                for line_number in range(MAX_HEADER_LINES):
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) == 3 and parts[0] == 'GET' and urlsplit(parts[1]).path == '/stream':
+                    await self._stream(urlsplit(parts[1]), headers, writer)
+                    break
+                keep_alive = headers.get('connection', '').lower() != 'close' and parts[-1:] == ['HTTP/1.1']
+                started = time.perf_counter()
+                status, response_headers, body = await self._respond(parts, headers)
+                path = urlsplit(parts[1]).path if len(parts) > 1 else ''
+                API_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path if path in API_PATHS else 'other',
+                                            status=status)
+
+                lines = ['HTTP/1.1 {0} {1}'.format(status, STATUS_REASONS[status])]
+                response_headers['Content-Length'] = str(len(body))
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                lines.extend('{0}: {1}'.format(name, value) for name, value in response_headers.items())
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                if parts[:1] != ['HEAD']:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # Client went away, or the server is shutting down
+        finally:
+            writer.close()
+
+    async def _stream(self, url, headers, writer):
+        # Events are sent as they are recorded until the client goes away, each write being one chunk
+        try:
+            source = self._source({name: values[-1] for name, values in parse_qs(url.query).items()})
+        except HttpError as error:
+            body = json.dumps({'error': str(error)}).encode('utf-8')
+            writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n'
+                         'Connection: close\r\n\r\n'.format(error.status, STATUS_REASONS[error.status],
+                                                               len(body)).encode('latin-1') + body)
+            await writer.drain()
+            return
+
+        def send(text):
+            data = text.encode('utf-8')
+            writer.write('{0:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n')
+
+        stream = source.stream
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(wake.set)
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        stream.subscribe(notify)
+        self.stream_clients += 1
+        try:
+            last_event_id = headers.get('last-event-id')
+            while True:
+                wake.clear()
+                events = stream.since(last_event_id)
+                if events is None:
+                    # New client, or one too far behind to resume
+                    last_event_id, data = stream.snapshot()
+                    send('id: {0}\nevent: snapshot\ndata: {1}\n\n'.format(last_event_id, data))
+                    API_STREAM_EVENTS.inc(event='snapshot')
+                for last_event_id, data in events or []:
+                    send('id: {0}\nevent: delta\ndata: {1}\n\n'.format(last_event_id, data))
+                    API_STREAM_EVENTS.inc(event='delta')
+                await writer.drain()
+                try:
+                    await asyncio.wait_for(wake.wait(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    send(': keepalive\n\n')
+        finally:
+            self.stream_clients -= 1
+            stream.unsubscribe(notify)
+
+    async def _respond(self, parts, headers):
+        try:
+            if len(parts) != 3:
+                raise HttpError(400, 'Malformed request line')
+            if parts[0] not in ('GET', 'HEAD'):
+                raise HttpError(405, 'Only GET and HEAD are supported')
+
+            url = urlsplit(parts[1])
+            if url.path == '/metrics':
+                if not metrics.is_enabled():
+                    raise HttpError(404, 'Metrics are disabled')
+                return 200, {'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-cache'}, \
+                    metrics.render_prometheus().encode('utf-8')
+
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            if url.path == '/facilities':
+                return 200, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}, json.dumps(
+                    [{'facility': source.name,
+                      'combos': [{'floor': combo_floor, 'wing': combo_wing}
+                                 for combo_floor, combo_wing in source.combos()]}
+                     for source in self._facilities.values()]).encode('utf-8')
+
+            source = self._source(query)
+            combo = self._combo(query)
+
+            if url.path == '/latest' and 'max_age' in query and source.collector is not None and combo is not None:
+                fetched_at = source.fetched_at.get(combo)
+                if fetched_at is None or time.monotonic() - fetched_at > float(query['max_age']):
+                    await self._refresh(source, combo)
+
+            etag = '"{0}-{1}"'.format(self.epoch, source.session.version)
+            vary = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+            if headers.get('if-none-match') == etag:
+                return 304, vary, b''
+
+            use_gzip = 'gzip' in headers.get('accept-encoding', '')
+            cache_key = (url.path, url.query, use_gzip)
+            cached = self._responses.get(cache_key)
+            if cached is not None and cached[0] == etag:
+                API_RESPONSE_CACHE.inc(result='hit')
+                body = cached[1]
+            else:
+                API_RESPONSE_CACHE.inc(result='miss')
+                body = await asyncio.get_running_loop().run_in_executor(None, self._body, source, url.path, query,
+                                                                        combo, use_gzip)
+                self._responses[cache_key] = (etag, body)
+                self._responses.move_to_end(cache_key)
+                while len(self._responses) > MAX_CACHED_RESPONSES:
+                    self._responses.popitem(last=False)
+
+            response_headers = dict(vary)
+            response_headers['Content-Type'] = 'application/json'
+            if use_gzip:
+                response_headers['Content-Encoding'] = 'gzip'
+            return 200, response_headers, body
+
+        except HttpError as error:
+            return error.status, {'Content-Type': 'application/json'}, json.dumps(
+                {'error': str(error)}).encode('utf-8')
+        except ValueError as error:
+            return 400, {'Content-Type': 'application/json'}, json.dumps({'error': str(error)}).encode('utf-8')
+        except Exception:
+            traceback.print_exc()
+            return 500, {'Content-Type': 'application/json'}, json.dumps(
+                {'error': 'Internal server error'}).encode('utf-8')
+
+    def _source(self, query):
+        if 'facility' not in query:
+            return next(iter(self._facilities.values()))
+        source = self._facilities.get(query['facility'])
+        if source is None:
+            raise HttpError(404, 'Unknown facility ' + query['facility'])
+        return source
+
+    @staticmethod
+    def _combo(query):
+        if 'floor' in query and 'wing' in query:
+            return int(query['floor']), query['wing']
+        if 'floor' in query or 'wing' in query:
+            raise HttpError(400, 'floor and wing must be given together')
+        return None
+
+    @staticmethod
+    def _filter(readings, combo):
+        if combo is None:
+            return readings
+        return readings[(readings['Floor'] == combo[0]) & (readings['Wing'] == combo[1])]
+
+    @staticmethod
+    def _records(session, readings):
+        air_df = session.readings.to_air_df(readings)
+        air_df = air_df.astype(object).where(air_df.notna(), None)
+        return air_df.to_dict(orient='records')
+
+    def _body(self, source, path, query, combo, use_gzip):
+        # Runs on a worker thread: the DataFrame conversions and archive reads of a query can take a while
+        body = json.dumps(self._content(source, path, query, combo)).encode('utf-8')
+        if use_gzip:
+            body = gzip.compress(body, compresslevel=5)
+        return body
+
+    def _content(self, source, path, query, combo):
+        session = source.session
+        if path == '/latest':
+            return self._records(session, self._filter(session.readings.latest(), combo))
+
+        if path == '/aggregates':
+            units = session.aggregates.units
+            content = []
+            for (group_floor, group_wing, measurement_column), aggregate in sorted(session.aggregates.items()):
+                if combo is not None and (group_floor, group_wing) != combo:
+                    continue
+                summary = {name: _clean(value) for name, value in aggregate._asdict().items()}
+                summary.update({'floor': group_floor, 'wing': group_wing, 'measurement': measurement_column,
+                                'units': units.get(measurement_column, '')})
+                content.append(summary)
+            return content
+
+        if path == '/readings':
+            readings = self._filter(session.readings.view(), combo)
+            if 'start' in query:
+                readings = readings[readings['Timestamp'] >= int(query['start'])]
+            if 'end' in query:
+                readings = readings[readings['Timestamp'] < int(query['end'])]
+            return self._records(session, readings)
+
+        if path == '/history':
+            if source.rollups is None:
+                raise HttpError(404, 'No archive to read history from')
+            history = source.rollups.query(None if combo is None else [combo], query.get('start'), query.get('end'),
+                                           float(query['resolution']) if 'resolution' in query else None)
+            history = history.astype(object).where(history.notna(), None)
+            return history.to_dict(orient='records')
+
+        if path == '/alerts':
+            if session.alerts is None:
+                raise HttpError(404, 'Alerts are not evaluated')
+            units = session.readings.units
+            return [dict(alert._asdict(), units=units.get(alert.measurement, ''),
+                         since=time.strftime(DATE_FORMAT, time.gmtime(alert.since)),
+                         timestamp=time.strftime(DATE_FORMAT, time.gmtime(alert.timestamp)))
+                    for alert in session.alerts.active(combo)]
+
+        if path == '/stats':
+            if session.rolling_stats is None:
+                raise HttpError(404, 'Rolling statistics are not kept')
+            units = session.readings.units
+            now = local_now()  # Windows end now, even for rooms no longer read
+            if 'room' in query:
+                selected = [({'room': query['room']}, session.rolling_stats.room, (query['room'],))]
+            else:
+                selected = [({'floor': group_floor, 'wing': group_wing}, session.rolling_stats.combo,
+                             (group_floor, group_wing))
+                            for group_floor, group_wing in ([combo] if combo is not None else source.combos())]
+            content = []
+            for group, lookup, key in selected:
+                for measurement_column in MEASUREMENT_COLUMNS.values():
+                    stats = lookup(*key, measurement_column, now)
+                    if stats is None:
+                        continue
+                    summary = {name: _clean(value) for name, value in stats._asdict().items() if name != 'windows'}
+                    summary['windows'] = {name: {field: _clean(value) for field, value in window._asdict().items()}
+                                          for name, window in stats.windows.items()}
+                    summary.update(group, measurement=measurement_column, units=units.get(measurement_column, ''))
+                    content.append(summary)
+            return content
+
+        raise HttpError(404, 'Unknown path ' + path)
@@ -0,0 +1,288 @@
+"""
+#
+# File:              reading_stream.py
+# Description:       Pushes the readings a session records to displays as
+#                    numbered deltas, holding only the rooms whose readings
+#                    changed, over the read API's /stream (server-sent events).
+#                    A client that reconnects resumes from its last event, and
+#                    one that connects for the first time, or has fallen too far
+#                    behind, gets a snapshot of every room first.
+#
+"""
+
+import itertools
+import json
+import math
+import threading
+import time
+from collections import deque
+
+import numpy
+import pandas as pd
+import requests
+
+from rollups import ROLLUP_COLUMNS
+
+DEFAULT_HISTORY = 1000  # Deltas kept for clients to resume from
+DEFAULT_RETRY = 1  # Seconds before the first reconnection attempt
+MAX_RETRY = 30  # Seconds between reconnection attempts
+READ_TIMEOUT = 60  # Seconds without a byte, keepalives included, before a client reconnects
+CONNECT_TIMEOUT = 5  # Seconds
+
+
+def _clean(value):
+    # JSON has no NaN, send missing values as null
+    return None if math.isnan(value) else value
+
+
+class ReadingStream(object):
+    """
+    Numbered deltas of the readings of a session. Each room's latest row is
+    kept, and a reading of only one of its measurements is merged into it.
+    A recorded reading that repeats it is sent as just the room and its new
+    timestamp, one that repeats it within the same minute is not sent at
+    all, and anything else is sent in full. Every delta is
+    encoded once, whatever the number of clients. Event IDs combine the
+    sequence number with an epoch that changes when the stream is recreated,
+    so clients of a restarted collector start over with a snapshot.
+    """
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        """ Constructor
+        :type history: int
+        :param history: Number of deltas kept for clients to resume from
+        """
+        self.epoch = '{0:x}'.format(int(time.time() * 1000))
+        self.sequence = 0
+        self._latest = {}  # Room -> [room, floor, wing, timestamp, temperature, CO2 level] last sent
+        self._units = {}
+        self._deltas = deque(maxlen=history)  # (sequence, JSON text)
+        self._snapshot = None  # (sequence, JSON text) of the latest snapshot encoded
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def event_id(self, sequence):
+        return '{0}-{1}'.format(self.epoch, sequence)
+
+    def subscribe(self, function):
+        """ Call a function, without arguments, from the recording thread after every new delta """
+        with self._lock:
+            self._subscribers.append(function)
+
+    def unsubscribe(self, function):
+        with self._lock:
+            self._subscribers.remove(function)
+
+    def publish(self, columns, units):
+        """ Add a batch of readings, given as ReadingsStore.append() arguments, sending what changed """
+        changed = []
+        confirmed = {}  # Timestamp -> rooms read again with unchanged readings
+        with self._lock:
+            for index, room in enumerate(columns['rooms']):
+                row = [room, int(columns['floors'][index]), str(columns['wings'][index]),
+                       int(columns['timestamps'][index]), _clean(float(columns['temperatures'][index])),
+                       _clean(float(columns['co2_levels'][index]))]
+                previous = self._latest.get(room)
+                measured = [position for position in (4, 5) if row[position] is not None]
+                if previous is not None:
+                    # A reading of one measurement (adaptive polling) keeps the other's latest value
+                    for position in (4, 5):
+                        if row[position] is None:
+                            row[position] = previous[position]
+                if (previous is None or row[1:3] != previous[1:3] or
+                        any(row[position] != previous[position] for position in measured)):
+                    if previous is not None and row[3] < previous[3]:
+                        continue  # Older than what was sent
+                    changed.append(row)
+                elif row[3] > previous[3]:
+                    confirmed.setdefault(row[3], []).append(room)
+                else:
+                    continue  # Already sent
+                self._latest[room] = row
+            if not changed and not confirmed:
+                return
+
+            self._units.update(units)
+            self.sequence += 1
+            self._deltas.append((self.sequence, json.dumps({
+                'sequence': self.sequence,
+                'units': self._units,
+                'changed': changed,
+                'confirmed': [[timestamp, rooms] for timestamp, rooms in confirmed.items()],
+            })))
+            subscribers = list(self._subscribers)
+        for function in subscribers:
+            function()
+
+    def snapshot(self):
+        """ Get the latest row of every room
+        :rtype: tuple
+        :return: Event ID and JSON text of the snapshot
+        """
+        with self._lock:
+            if self._snapshot is None or self._snapshot[0] != self.sequence:
+                self._snapshot = (self.sequence, json.dumps({
+                    'sequence': self.sequence,
+                    'units': self._units,
+                    'rooms': list(self._latest.values()),
+                }))
+            return self.event_id(self._snapshot[0]), self._snapshot[1]
+
+    def since(self, event_id):
+        """ Get the deltas after an event, for a client resuming from it
+        :type event_id: str
+        :param event_id: ID of the last event the client received, None if it has none
+        :rtype: list
+        :return: (event ID, JSON text) of each delta, or None if the client needs a snapshot first
+        """
+        epoch, _, sequence = (event_id or '').partition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        with self._lock:
+            if sequence > self.sequence:
+                return None
+            if sequence == self.sequence:
+                return []
+            if not self._deltas or self._deltas[0][0] > sequence + 1:
+                return None  # Dropped from the history
+            first = sequence + 1 - self._deltas[0][0]
+            return [(self.event_id(number), text) for number, text in itertools.islice(self._deltas, first, None)]
+
+
+def _rows_to_columns(rows):
+    # [room, floor, wing, timestamp, temperature, CO2 level] rows to ReadingsStore.append() arguments
+    return {
+        'timestamps': numpy.array([row[3] for row in rows], dtype=numpy.int64),
+        'rooms': [row[0] for row in rows],
+        'floors': numpy.array([row[1] for row in rows], dtype=numpy.int16),
+        'wings': [row[2] for row in rows],
+        'temperatures': numpy.array([numpy.nan if row[4] is None else row[4] for row in rows], dtype=numpy.float32),
+        'co2_levels': numpy.array([numpy.nan if row[5] is None else row[5] for row in rows], dtype=numpy.float32),
+    }
+
+
+class StreamFollower(object):
+    """
+    Records the readings a collector pushes over its read API's /stream to
+    a local session, reconnecting with a growing delay whenever the stream
+    is lost and resuming from the last event received. Listeners are called
+    with the readings recorded from each event, in the ReadingsStore.view()
+    format.
+    """
+
+    def __init__(self, session, url, facility=None, retry=DEFAULT_RETRY):
+        """ Constructor
+        :type session: SessionData
+        :param session: Local session the readings are recorded to
+        :type url: str
+        :param url: Base URL of the collector's read API, such as http://server:8080
+        :type facility: str
+        :param facility: Facility to follow, the collector's first one if None
+        :type retry: float
+        :param retry: Seconds before the first reconnection attempt, doubled after each failed one
+        """
+        self.session = session
+        self.url = url.rstrip('/')
+        self.facility = facility
+        self.retry = retry
+        self.listeners = []
+        self.last_event_id = None
+        self.events = 0
+        self.reconnections = 0
+
+        self._latest = {}  # Room -> latest row received
+        self._http = requests.Session()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        # Takes effect on the next event or keepalive
+        self._stop_event.set()
+
+    def _params(self, **params):
+        if self.facility is not None:
+            params['facility'] = self.facility
+        return params
+
+    def history(self, combo, start, resolution):
+        """ Get the statistics of every room of a floor and wing over time, from the collector's /history
+        :rtype: DataFrame
+        :return: ROLLUP_COLUMNS, by bucket and room
+        """
+        response = self._http.get(self.url + '/history', timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                                  params=self._params(floor=combo[0], wing=combo[1], start=int(start),
+                                                      resolution=resolution))
+        response.raise_for_status()
+        return pd.DataFrame(response.json(), columns=ROLLUP_COLUMNS)
+
+    def apply(self, event, data):
+        """ Record the readings of a snapshot or delta event """
+        content = json.loads(data)
+        if event == 'snapshot':
+            rows = [row for row in content['rooms'] if row != self._latest.get(row[0])]
+        else:
+            rows = content['changed']
+            for timestamp, rooms in content['confirmed']:
+                rows.extend([room, known[1], known[2], timestamp, known[4], known[5]]
+                            for room, known in ((room, self._latest.get(room)) for room in rooms)
+                            if known is not None)
+        if not rows:
+            return
+        for row in rows:
+            self._latest[row[0]] = row
+
+        start = self.session.readings.sequence
+        self.session.record_columns(_rows_to_columns(rows), content['units'], archive=False)
+        readings = self.session.readings.since(start)[0]
+        for listener in self.listeners:
+            listener(readings)
+
+    def follow(self):
+        """ Record the events of one connection to the stream, until it ends """
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+        response = self._http.get(self.url + '/stream', params=self._params(), headers=headers, stream=True,
+                                  timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        try:
+            response.raise_for_status()
+            event_id, event, data = None, None, []
+            for line in response.iter_lines(decode_unicode=True):
+                if self._stop_event.is_set():
+                    return
+                if line is None or line.startswith(':'):
+                    continue  # Keepalive
+                if line:
+                    field, _, value = line.partition(':')
+                    value = value[1:] if value.startswith(' ') else value
+                    if field == 'id':
+                        event_id = value
+                    elif field == 'event':
+                        event = value
+                    elif field == 'data':
+                        data.append(value)
+                    continue
+
+                # A blank line ends the event
+                if data:
+                    self.apply(event, '\n'.join(data))
+                    self.events += 1
+                    self.last_event_id = event_id
+                event_id, event, data = None, None, []
+        finally:
+            response.close()
+
+    def run(self):
+        """ Follow the stream until stopped, reconnecting whenever it is lost """
+        delay = self.retry
+        while not self._stop_event.is_set():
+            events = self.events
+            try:
+                self.follow()
+            except (requests.RequestException, ValueError) as error:
+                if not self._stop_event.is_set():
+                    print('Lost the stream from ' + self.url + ': ' + str(error))
+            # Reconnect straight away after a stream that delivered events, then back off
+            delay = self.retry if self.events > events else min(delay * 2, MAX_RETRY)
+            self.reconnections += 1
+            self._stop_event.wait(delay)
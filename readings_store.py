@@ -0,0 +1,337 @@
+"""
+#
+# File:              readings_store.py
+# Description:       Columnar store for the readings of a session, backed by
+#                    preallocated NumPy arrays with amortized growth and an
+#                    optional retention window.
+#
+"""
+
+import threading
+
+import numpy
+import pandas as pd
+
+from air_data import AIR_COLUMNS
+
+DEFAULT_INITIAL_CAPACITY = 1024
+MISSING_FLOOR = -1
+DATE_FORMAT = "%m/%d/%Y %H:%M"
+
+
+class ReadingsStore(object):
+    """
+    Holds one row per reading: timestamp as int64 epoch seconds, room and wing
+    as categorical codes, floor as int16 and temperature/CO2 as float32 with
+    NaN for missing values. Live rows are kept contiguous, so view() wraps
+    the arrays in a DataFrame without copying them.
+
+    Appends only ever write past the live rows, and compaction writes into
+    fresh arrays, so a DataFrame returned by view() stays valid while the
+    store keeps growing.
+    """
+
+    def __init__(self, initial_capacity=DEFAULT_INITIAL_CAPACITY, max_rows=None, retention=None):
+        """ Constructor
+        :type initial_capacity: int
+        :param initial_capacity: Rows to preallocate
+        :type max_rows: int
+        :param max_rows: Maximum rows kept, oldest rows are dropped beyond it (None for no limit)
+        :type retention: float
+        :param retention: Seconds of history kept (None for no limit)
+        """
+        self.max_rows = max_rows
+        self.retention = retention
+        self.units = {'Temperature': '', 'CO2 Level': ''}
+
+        self.rooms = []
+        self.wings = []
+        self._room_codes = {}
+        self._wing_codes = {}
+        # Sequence number of the latest row with a value of each measurement, per room
+        self._last_seq = {'temperature': numpy.empty(0, dtype=numpy.int64), 'co2': numpy.empty(0, dtype=numpy.int64)}
+
+        self._start = 0  # Index of the oldest live row
+        self._end = 0  # Index one past the newest live row
+        self._start_seq = 0  # Sequence number of the oldest live row
+        self._lock = threading.Lock()
+        self._arrays = self._allocate(max(1, initial_capacity if max_rows is None else
+                                          min(initial_capacity, max_rows)))
+
+    @staticmethod
+    def _allocate(capacity):
+        return {
+            'timestamp': numpy.empty(capacity, dtype=numpy.int64),
+            'room': numpy.empty(capacity, dtype=numpy.int32),
+            'floor': numpy.empty(capacity, dtype=numpy.int16),
+            'wing': numpy.empty(capacity, dtype=numpy.int16),
+            'temperature': numpy.empty(capacity, dtype=numpy.float32),
+            'co2': numpy.empty(capacity, dtype=numpy.float32),
+        }
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._arrays['timestamp'])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._arrays.values())
+
+    @property
+    def sequence(self):
+        """Sequence number of the next row appended, counting every row ever appended"""
+        return self._start_seq + len(self)
+
+    @staticmethod
+    def _code(value, codes, categories):
+        code = codes.get(value)
+        if code is None:
+            code = len(categories)
+            codes[value] = code
+            categories.append(value)
+        return code
+
+    def _relocate(self, capacity):
+        # Copy the live rows to the front of fresh arrays of the given capacity
+        arrays = self._allocate(capacity)
+        count = self._end - self._start
+        for name, array in self._arrays.items():
+            arrays[name][:count] = array[self._start:self._end]
+        self._arrays = arrays
+        self._start = 0
+        self._end = count
+
+    def _drop_oldest(self, count):
+        self._start += count
+        self._start_seq += count
+
+    def _make_room(self, count):
+        if self.max_rows is not None:
+            # Drop the oldest rows that would not fit
+            overflow = len(self) + count - self.max_rows
+            if overflow > 0:
+                self._drop_oldest(min(overflow, len(self)))
+
+        if self._end + count <= self.capacity:
+            return
+
+        needed = len(self) + count
+        capacity = self.capacity
+
+        # With a row limit, leave room for max_rows of appends between compactions so they stay amortized
+        limit = None if self.max_rows is None else 2 * self.max_rows
+        if needed > capacity // 2 and (limit is None or capacity < limit):
+            # Grow geometrically so appends stay amortized O(1)
+            capacity = max(capacity * 2, needed)
+            if limit is not None:
+                capacity = min(capacity, max(limit, needed))
+        self._relocate(capacity)
+
+    def _expire(self, now):
+        if self.retention is None or len(self) == 0:
+            return
+        timestamps = self._arrays['timestamp'][self._start:self._end]
+        expired = int(numpy.searchsorted(timestamps, now - self.retention, side='left'))
+        if expired:
+            self._drop_oldest(expired)
+
+    def append(self, timestamps, rooms, floors, wings, temperatures, co2_levels):
+        """ Append a batch of readings. Timestamps must not go backwards between batches.
+        :type timestamps: array-like
+        :param timestamps: Epoch seconds of each reading
+        :type rooms: list
+        :param rooms: Room label of each reading
+        :type floors: array-like
+        :param floors: Floor of each reading, MISSING_FLOOR if unknown
+        :type wings: list
+        :param wings: Wing of each reading
+        :type temperatures: array-like
+        :param temperatures: Temperature of each reading, NaN if missing
+        :type co2_levels: array-like
+        :param co2_levels: CO2 level of each reading, NaN if missing
+        """
+        count = len(rooms)
+        if count == 0:
+            return
+
+        with self._lock:
+            room_codes = numpy.fromiter((self._code(room, self._room_codes, self.rooms) for room in rooms),
+                                        dtype=numpy.int32, count=count)
+            wing_codes = numpy.fromiter((self._code(str(wing), self._wing_codes, self.wings) for wing in wings),
+                                        dtype=numpy.int16, count=count)
+
+            self._make_room(count)
+            rows = slice(self._end, self._end + count)
+            self._arrays['timestamp'][rows] = timestamps
+            self._arrays['room'][rows] = room_codes
+            self._arrays['floor'][rows] = floors
+            self._arrays['wing'][rows] = wing_codes
+            self._arrays['temperature'][rows] = temperatures
+            self._arrays['co2'][rows] = co2_levels
+
+            # Remember where the latest value of each room's measurements is, rows may only hold one of them
+            first_seq = self._start_seq + len(self)
+            seqs = numpy.arange(first_seq, first_seq + count)
+            for name, last_seq in self._last_seq.items():
+                if len(last_seq) < len(self.rooms):
+                    last_seq = numpy.concatenate(
+                        [last_seq, numpy.full(len(self.rooms) - len(last_seq), -1, dtype=numpy.int64)])
+                    self._last_seq[name] = last_seq
+                valid = ~numpy.isnan(self._arrays[name][rows])
+                numpy.maximum.at(last_seq, room_codes[valid], seqs[valid])
+
+            self._end += count
+            self._expire(int(numpy.max(timestamps)))
+
+    def append_df(self, air_df):
+        """ Append the rows of an air values DataFrame, as built by air_data.build_air_df() """
+        if air_df is None or air_df.empty:
+            return
+
+        columns, units = air_df_columns(air_df)
+        self.units.update(units)
+        self.append(**columns)
+
+    def _frame(self, rows):
+        arrays = self._arrays
+        return pd.DataFrame({
+            'Timestamp': arrays['timestamp'][rows],
+            'Room': pd.Categorical.from_codes(arrays['room'][rows], categories=list(self.rooms)),
+            'Temperature': arrays['temperature'][rows],
+            'CO2 Level': arrays['co2'][rows],
+            'Floor': arrays['floor'][rows],
+            'Wing': pd.Categorical.from_codes(arrays['wing'][rows], categories=list(self.wings)),
+        }, copy=False)
+
+    def view(self):
+        """ Get every live reading, oldest first, without copying the numeric columns
+        :rtype: DataFrame
+        """
+        with self._lock:
+            return self._frame(slice(self._start, self._end))
+
+    def since(self, sequence):
+        """ Get the readings appended from the given sequence number on, to follow the store incrementally
+        :rtype: tuple
+        :return: The readings still in the store, oldest first, and the sequence number to pass next time
+        """
+        with self._lock:
+            first = self._start + max(0, sequence - self._start_seq)
+            return self._frame(slice(first, self._end)), self._start_seq + len(self)
+
+    def latest(self):
+        """ Get the latest temperature and CO2 level of every room still in the store, in one row per room
+        stamped with the newer of the two
+        :rtype: DataFrame
+        """
+        with self._lock:
+            offset = self._start - self._start_seq
+            temperature_seq, co2_seq = self._last_seq['temperature'], self._last_seq['co2']
+            live_temperature = temperature_seq >= self._start_seq
+            live_co2 = co2_seq >= self._start_seq
+            rooms = numpy.flatnonzero(live_temperature | live_co2)
+            rows = numpy.maximum(temperature_seq[rooms], co2_seq[rooms]) + offset
+            order = numpy.argsort(rows, kind='stable')
+            rooms, rows = rooms[order], rows[order]
+
+            frame = self._frame(rows)
+            for name, column, live, last_seq in [('temperature', 'Temperature', live_temperature, temperature_seq),
+                                                 ('co2', 'CO2 Level', live_co2, co2_seq)]:
+                value_rows = numpy.where(live[rooms], last_seq[rooms] + offset, rows)
+                frame[column] = numpy.where(live[rooms], self._arrays[name][value_rows], numpy.nan).astype(
+                    numpy.float32)
+            return frame
+
+    def combos(self):
+        """ Get every (floor, wing) combination with readings in the store
+        :rtype: list
+        """
+        with self._lock:
+            rows = slice(self._start, self._end)
+            pairs = numpy.unique(numpy.stack([self._arrays['floor'][rows], self._arrays['wing'][rows]]), axis=1)
+            wings = list(self.wings)
+        return [(int(pair_floor), wings[pair_wing]) for pair_floor, pair_wing in pairs.T
+                if pair_floor != MISSING_FLOOR and wings[pair_wing] != '']
+
+    def to_air_df(self, readings=None):
+        """ Convert readings (all live readings by default) back to the air values DataFrame format
+        :rtype: DataFrame
+        """
+        return readings_to_air_df(self.view() if readings is None else readings, self.units)
+
+
+def air_df_columns(air_df):
+    """ Convert an air values DataFrame to the typed columns taken by ReadingsStore.append()
+    :rtype: tuple
+    :return: Dictionary of append() arguments, and dictionary of the units found for each measurement
+    """
+    units = {}
+    for column, units_column in [('Temperature', 'Temperature Units'), ('CO2 Level', 'CO2 Units')]:
+        known_units = air_df[units_column][air_df[units_column].astype(str) != '']
+        if not known_units.empty:
+            units[column] = str(known_units.iloc[-1])
+
+    timestamps = pd.to_datetime(air_df['Date / Time'], format=DATE_FORMAT).to_numpy(dtype='datetime64[s]')
+    floors = pd.to_numeric(air_df['Floor'], errors='coerce').fillna(MISSING_FLOOR)
+    columns = {
+        'timestamps': timestamps.astype(numpy.int64),
+        'rooms': air_df['Room'].astype(str).tolist(),
+        'floors': floors.to_numpy(dtype=numpy.int16),
+        'wings': air_df['Wing'].astype(str).tolist(),
+        'temperatures': pd.to_numeric(air_df['Temperature'], errors='coerce').to_numpy(dtype=numpy.float32),
+        'co2_levels': pd.to_numeric(air_df['CO2 Level'], errors='coerce').to_numpy(dtype=numpy.float32),
+    }
+    return columns, units
+
+
+def readings_to_air_df(readings, units):
+    """ Convert readings in the ReadingsStore.view() format to the air values DataFrame format
+    :rtype: DataFrame
+    """
+    timestamps = pd.to_datetime(readings['Timestamp'], unit='s').dt.strftime(DATE_FORMAT)
+    temperatures = readings['Temperature'].round()
+    co2_levels = readings['CO2 Level'].round()
+
+    air_df = pd.DataFrame({
+        'Date / Time': timestamps,
+        'Room': readings['Room'].astype(str),
+        'Temperature': temperatures.astype('Int64'),
+        'Temperature Units': numpy.where(temperatures.notna(), units.get('Temperature', ''), ''),
+        'CO2 Level': co2_levels.astype('Int64'),
+        'CO2 Units': numpy.where(co2_levels.notna(), units.get('CO2 Level', ''), ''),
+        'Floor': readings['Floor'].astype('Int64').where(readings['Floor'] != MISSING_FLOOR),
+        'Wing': readings['Wing'].astype(str),
+    })
+    return air_df[AIR_COLUMNS]
+
+
+def air_df_to_readings(air_df):
+    """ Convert an air values DataFrame to the ReadingsStore.view() format
+    :rtype: DataFrame
+    """
+    columns, units = air_df_columns(air_df)
+    return pd.DataFrame({
+        'Timestamp': columns['timestamps'],
+        'Room': pd.Categorical(columns['rooms']),
+        'Temperature': columns['temperatures'],
+        'CO2 Level': columns['co2_levels'],
+        'Floor': columns['floors'],
+        'Wing': pd.Categorical(columns['wings']),
+    })
+
+
+def readings_to_columns(readings):
+    """ Convert readings in the ReadingsStore.view() format to ReadingsStore.append() arguments
+    :rtype: dict
+    """
+    return {
+        'timestamps': readings['Timestamp'].to_numpy(dtype=numpy.int64),
+        'rooms': readings['Room'].astype(str).tolist(),
+        'floors': readings['Floor'].to_numpy(dtype=numpy.int16),
+        'wings': readings['Wing'].astype(str).tolist(),
+        'temperatures': readings['Temperature'].to_numpy(dtype=numpy.float32),
+        'co2_levels': readings['CO2 Level'].to_numpy(dtype=numpy.float32),
+    }
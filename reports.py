@@ -0,0 +1,241 @@
+"""
+#
+# File:              reports.py
+# Description:       Daily or weekly report of every room over a long archive:
+#                    minimum, mean and maximum temperature and CO2 level, the
+#                    time spent above CO2 thresholds, and the means during the
+#                    occupied hours. Each floor/wing and period is summarized
+#                    in a pool of worker processes, reading only its own part
+#                    of the archive, and written out as soon as it is done, so
+#                    the archive is never loaded whole.
+#
+"""
+
+import argparse
+import calendar
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import pandas as pd
+
+from readings_store import DATE_FORMAT
+from rollups import MEASUREMENTS, Rollups, local_now
+from session_persistence import ARCHIVE_PATH, SessionArchive
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None  # Reports can only be written as CSV
+
+PERIODS = {'day': 1, 'week': 7}  # Days per period, weeks starting on Monday
+DAY_SECONDS = 24 * 60 * 60
+DEFAULT_DAYS = 28  # Days reported when no start is given
+DEFAULT_CO2_THRESHOLDS = [1000, 1500]  # ppm
+DEFAULT_OCCUPIED_HOURS = (7, 15)  # Weekdays from 7:00 to 15:00
+BUCKET_SECONDS = 60  # Readings are stamped to the minute, so this is as fine as the archive gets
+MAX_GAP = 15 * 60  # Seconds a reading is assumed to hold at most, so gaps in collection are not counted
+PERIOD_FORMAT = '%m/%d/%Y'
+
+# Archives opened by this worker process, by directory
+_rollups = {}
+
+
+def period_starts(start, end, period):
+    """ Get the start of every period overlapping a range, in local epoch seconds
+    :type period: str
+    :param period: Key of PERIODS
+    :rtype: list
+    """
+    days = PERIODS[period]
+    first_day = int(start) // DAY_SECONDS
+    if days == 7:
+        first_day -= (first_day + 3) % 7  # The epoch was a Thursday
+    return list(range(first_day * DAY_SECONDS, int(end), days * DAY_SECONDS))
+
+
+def report_columns(co2_thresholds):
+    """ Get the columns of a report
+    :rtype: list
+    """
+    statistics = ['{0} {1}'.format(column, statistic) for column in MEASUREMENTS
+                  for statistic in ['Min', 'Mean', 'Max']]
+    return (['Period', 'Room', 'Floor', 'Wing'] + statistics +
+            ['Minutes CO2 Above {0:g}'.format(threshold) for threshold in co2_thresholds] +
+            ['Occupied {0} Mean'.format(column) for column in MEASUREMENTS])
+
+
+def _weighted_means(codes, room_count, means, counts, selected=None):
+    # Mean of each room's buckets, weighted by their number of readings
+    means = numpy.nan_to_num(means)
+    if selected is not None:
+        counts = numpy.where(selected, counts, 0)
+    totals = numpy.bincount(codes, weights=means * counts, minlength=room_count)
+    weights = numpy.bincount(codes, weights=counts, minlength=room_count)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(weights > 0, totals / weights, numpy.nan)
+
+
+def summarize_rooms(history, co2_thresholds, occupied_hours):
+    """ Summarize the history of every room over one period
+    :type history: DataFrame
+    :param history: ROLLUP_COLUMNS of one floor and wing, by bucket and room
+    :rtype: DataFrame
+    :return: Room and the statistics of the report, one row per room
+    """
+    history = history.sort_values(['Room', 'Timestamp'], kind='stable', ignore_index=True)
+    codes, rooms = pd.factorize(history['Room'].astype(str), sort=True)
+    timestamps = history['Timestamp'].to_numpy(dtype=numpy.int64)
+
+    # Each bucket holds until the room's next one, or as long as the one before if it is the last
+    same_room = codes[1:] == codes[:-1]
+    durations = numpy.full(len(history), float(BUCKET_SECONDS))
+    durations[:-1][same_room] = numpy.diff(timestamps)[same_room]
+    last = numpy.flatnonzero(numpy.append(~same_room, True) & numpy.append(False, same_room))
+    durations[last] = durations[last - 1]
+    durations = numpy.minimum(durations, MAX_GAP)
+
+    seconds_of_day = timestamps % DAY_SECONDS
+    weekdays = (timestamps // DAY_SECONDS + 3) % 7  # Monday is 0
+    occupied = ((weekdays < 5) & (seconds_of_day >= occupied_hours[0] * 60 * 60) &
+                (seconds_of_day < occupied_hours[1] * 60 * 60))
+
+    # Rows are sorted by room, so each room's buckets are one run, reduced at its first row
+    firsts = numpy.flatnonzero(numpy.append(True, ~same_room))
+    report = pd.DataFrame({'Room': rooms})
+    for column in MEASUREMENTS:
+        means = history[column + ' Mean'].to_numpy(dtype=numpy.float64)
+        counts = history[column + ' Count'].to_numpy(dtype=numpy.float64)
+        report[column + ' Min'] = numpy.fmin.reduceat(history[column + ' Min'].to_numpy(dtype=numpy.float64), firsts)
+        report[column + ' Mean'] = _weighted_means(codes, len(rooms), means, counts)
+        report[column + ' Max'] = numpy.fmax.reduceat(history[column + ' Max'].to_numpy(dtype=numpy.float64), firsts)
+        report['Occupied {0} Mean'.format(column)] = _weighted_means(codes, len(rooms), means, counts, occupied)
+
+    co2_means = history['CO2 Level Mean'].to_numpy(dtype=numpy.float64)
+    for threshold in co2_thresholds:
+        with numpy.errstate(invalid='ignore'):
+            above = co2_means > threshold
+        report['Minutes CO2 Above {0:g}'.format(threshold)] = numpy.bincount(
+            codes, weights=durations * above, minlength=len(rooms)) / 60
+    return report
+
+
+def summarize_period(task):
+    """ Summarize one floor and wing over one period, in a worker process
+    :type task: tuple
+    :param task: Archive directory, (floor, wing), start and end of the period, CO2 thresholds and occupied hours
+    :rtype: DataFrame
+    :return: Rows of the report, or None if there were no readings
+    """
+    directory, combo, start, end, co2_thresholds, occupied_hours = task
+    rollups = _rollups.get(directory)
+    if rollups is None:
+        rollups = _rollups[directory] = Rollups(SessionArchive(directory, read_only=True))
+
+    # Raw readings by the minute, with the 5-minute tier standing in for those past the retention window
+    history = rollups.query([combo], start, end, resolution=BUCKET_SECONDS)
+    if history.empty:
+        return None
+    report = summarize_rooms(history, co2_thresholds, occupied_hours)
+    report.insert(0, 'Period', time.strftime(PERIOD_FORMAT, time.gmtime(start)))
+    report.insert(2, 'Floor', combo[0])
+    report.insert(3, 'Wing', combo[1])
+    return report[report_columns(co2_thresholds)]
+
+
+class _ReportWriter(object):
+    """Appends the rows of a report to a CSV or Parquet file as they are computed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._parquet = path.endswith('.parquet')
+        if self._parquet and pyarrow is None:
+            raise ImportError('pyarrow is required to write Parquet reports')
+        self._writer = None
+
+    def write(self, report):
+        if self._parquet:
+            table = pyarrow.Table.from_pandas(report, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            report.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(report)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def export_report(directory, path, start=None, end=None, period='day', co2_thresholds=None,
+                  occupied_hours=DEFAULT_OCCUPIED_HOURS, workers=None):
+    """ Write the report of every room of an archive, one row per room and period
+    :type directory: str
+    :param directory: Archive directory, of one facility
+    :type path: str
+    :param path: Report file, Parquet if it ends in .parquet and CSV otherwise
+    :type start: int
+    :param start: Epoch second the first period must include, DEFAULT_DAYS before the end if None
+    :type end: int
+    :param end: Epoch second to stop before, the present if None
+    :type period: str
+    :param period: 'day' or 'week'
+    :type co2_thresholds: list
+    :param co2_thresholds: CO2 levels to report the time spent above, DEFAULT_CO2_THRESHOLDS if None
+    :type occupied_hours: tuple
+    :param occupied_hours: First and last hour of the occupied part of weekdays
+    :type workers: int
+    :param workers: Worker processes, one per CPU if None
+    :rtype: int
+    :return: Number of rows written
+    """
+    end = local_now() + 1 if end is None else int(end)
+    start = end - DEFAULT_DAYS * DAY_SECONDS if start is None else int(start)
+    co2_thresholds = DEFAULT_CO2_THRESHOLDS if co2_thresholds is None else co2_thresholds
+    combos = SessionArchive(directory, read_only=True).partitions()
+
+    # Periods in order, each split by floor and wing, so rows come out sorted by period
+    days = PERIODS[period] * DAY_SECONDS
+    tasks = [(directory, combo, period_start, min(period_start + days, end), co2_thresholds, occupied_hours)
+             for period_start in period_starts(start, end, period) for combo in combos]
+    writer = _ReportWriter(path)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for report in executor.map(summarize_period, tasks):
+                if report is not None:
+                    writer.write(report)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a daily or weekly report of every room of an archive.')
+    parser.add_argument('output', help='report file, written as Parquet if it ends in .parquet and as CSV otherwise')
+    parser.add_argument('--archive', default=ARCHIVE_PATH,
+                        help='archive directory, the Facility=<name> one of a facility when there are several')
+    parser.add_argument('--start', default=None,
+                        help='first date and time, as MM/DD/YYYY HH:MM (default: {0} days ago)'.format(DEFAULT_DAYS))
+    parser.add_argument('--end', default=None, help='date and time to stop before, as MM/DD/YYYY HH:MM')
+    parser.add_argument('--period', choices=list(PERIODS), default='day', help='length of each row of a room')
+    parser.add_argument('--co2-thresholds', type=float, nargs='+', default=DEFAULT_CO2_THRESHOLDS,
+                        help='CO2 levels to report the time spent above, in ppm')
+    parser.add_argument('--occupied-hours', type=int, nargs=2, default=list(DEFAULT_OCCUPIED_HOURS),
+                        metavar=('FIRST', 'LAST'), help='occupied hours of weekdays, e.g. 7 15 for 7:00 to 15:00')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    options = parser.parse_args()
+
+    def epoch(text):
+        return None if text is None else calendar.timegm(time.strptime(text, DATE_FORMAT))
+
+    if not os.path.isdir(options.archive):
+        print('Error:\nCouldn\'t find ' + options.archive + '!')
+        raise SystemExit(1)
+    started = time.perf_counter()
+    rows = export_report(options.archive, options.output, epoch(options.start), epoch(options.end), options.period,
+                         options.co2_thresholds, tuple(options.occupied_hours), options.workers)
+    print('Wrote {0} rows to {1} in {2:.1f} s'.format(rows, options.output, time.perf_counter() - started))
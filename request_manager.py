@@ -0,0 +1,157 @@
+"""
+#
+# File:              request_manager.py
+# Description:       Runs on-demand reads of a floor/wing as futures, with one
+#                    request in flight per floor/wing, a cap on concurrent
+#                    requests and cancellation of requests no longer wanted.
+#
+"""
+
+import threading
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import metrics
+from air_data import build_air_df, room_instances
+from collector import SWEEP_SECONDS, combo_label
+
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+class _Request(object):
+    """State of one request, shared by its worker and whoever cancels it"""
+
+    def __init__(self, combo):
+        self.combo = combo
+        self.future = None
+        self.poll = None  # Future of the gateway reads, while they run
+        self.cancelled = threading.Event()
+
+
+class RequestManager(object):
+    """
+    Reads the rooms of a floor and wing through a Collector's poller and
+    publishes them through the collector. Requesting a floor and wing that
+    is already queued or running returns the same future. Cancelling a
+    queued request drops it, cancelling a running one cancels its gateway
+    reads, and either way its future resolves to None.
+    """
+
+    def __init__(self, collector, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """ Constructor
+        :type collector: Collector
+        :param collector: Collector whose poller reads the rooms and whose session records them
+        :type max_in_flight: int
+        :param max_in_flight: Maximum requests running at once, the others wait in a queue
+        """
+        self.collector = collector
+        self.max_in_flight = max_in_flight
+        self.submitted = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+        self.completed = 0
+        self.failed = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._requests = {}  # (floor, wing) -> its queued or running _Request
+        self._running = 0
+        self._lock = threading.Lock()
+
+        metrics.gauge('floor_wing_requests', 'On-demand floor/wing reads, by state',
+                      lambda: {(('state', state),): count for state, count in self.metrics().items()})
+
+    def _run(self, request):
+        with self._lock:
+            if request.cancelled.is_set():
+                return None
+            self._running += 1
+            rooms = self.collector.registry.rooms_in(*request.combo)
+            request.poll = self.collector.poller.submit(room_instances(rooms))
+
+        try:
+            with SWEEP_SECONDS.time(combo=combo_label([request.combo])):
+                readings = request.poll.result()
+            if request.cancelled.is_set():
+                return None
+            return self.collector.publish(build_air_df(rooms, readings))
+        except CancelledError:
+            return None
+        finally:
+            with self._lock:
+                self._running -= 1
+                request.poll = None
+
+    def _finished(self, request):
+        future = request.future
+        with self._lock:
+            if self._requests.get(request.combo) is request:
+                del self._requests[request.combo]
+            if future.cancelled() or request.cancelled.is_set():
+                self.cancelled += 1
+            elif future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def request(self, selected_floor, selected_wing):
+        """ Read and record every room of a floor and wing, unless that is already queued or running
+        :rtype: Future
+        :return: Future of the air values DataFrame, or of None if the request is cancelled
+        """
+        combo = (int(selected_floor), str(selected_wing))
+        with self._lock:
+            request = self._requests.get(combo)
+            if request is not None and not request.cancelled.is_set():
+                self.deduplicated += 1
+                return request.future
+
+            request = _Request(combo)
+            request.future = self._executor.submit(self._run, request)
+            self._requests[combo] = request
+            self.submitted += 1
+        request.future.add_done_callback(lambda done: self._finished(request))
+        return request.future
+
+    def cancel(self, selected_floor, selected_wing):
+        """ Cancel the request of a floor and wing, if there is one
+        :rtype: bool
+        :return: Whether a request was cancelled
+        """
+        with self._lock:
+            request = self._requests.get((int(selected_floor), str(selected_wing)))
+            if request is None or request.cancelled.is_set() or request.future.done():
+                return False
+            request.cancelled.set()
+            poll = request.poll
+        if not request.future.cancel() and poll is not None:
+            poll.cancel()
+        return True
+
+    def cancel_all(self, keep=None):
+        """ Cancel every request, except the one of the (floor, wing) given as keep
+        :rtype: int
+        :return: Number of requests cancelled
+        """
+        with self._lock:
+            combos = [combo for combo in self._requests if combo != keep]
+        return sum(self.cancel(*combo) for combo in combos)
+
+    def metrics(self):
+        """ Get the number of requests in each state, and counts of what happened to them so far
+        :rtype: dict
+        """
+        with self._lock:
+            in_flight = sum(1 for request in self._requests.values() if not request.future.done())
+            return {
+                'queued': in_flight - self._running,
+                'running': self._running,
+                'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'cancelled': self.cancelled,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def close(self):
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,219 @@
+"""
+#
+# File:              rolling_stats.py
+# Description:       Incremental statistics of the readings of each room and
+#                    each floor/wing, updated in O(1) per reading so long
+#                    sessions never have to rescan their history.
+#
+"""
+
+import math
+import threading
+from collections import deque, namedtuple
+
+import numpy
+
+MEASUREMENT_COLUMNS = {'temperatures': 'Temperature', 'co2_levels': 'CO2 Level'}
+DEFAULT_WINDOWS = {'15 min': 15 * 60, '1 h': 60 * 60, '24 h': 24 * 60 * 60}  # Seconds
+DEFAULT_EWMA_HALF_LIFE = 10 * 60  # Seconds
+DEFAULT_WINDOW_BUCKETS = 60  # Slots per window, so a 15 min window moves 15 s at a time and a 24 h one 24 min
+
+WindowSummary = namedtuple('WindowSummary', ['count', 'mean', 'minimum', 'maximum'])
+StatsSummary = namedtuple('StatsSummary', ['count', 'mean', 'variance', 'minimum', 'maximum', 'ewma', 'latest',
+                                           'windows'])
+
+
+class RunningStats(object):
+    """
+    Mean and variance (Welford's algorithm), min/max and a time-decayed
+    exponentially-weighted average over every value seen so far.
+    """
+
+    def __init__(self, ewma_half_life=DEFAULT_EWMA_HALF_LIFE):
+        """ Constructor
+        :type ewma_half_life: float
+        :param ewma_half_life: Seconds after which a value's weight in the EWMA has halved
+        """
+        self.ewma_half_life = ewma_half_life
+        self.count = 0
+        self.mean = math.nan
+        self._m2 = 0.0
+        self.minimum = math.nan
+        self.maximum = math.nan
+        self.ewma = math.nan
+        self.latest = math.nan
+        self._ewma_timestamp = None
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    def add(self, timestamp, value):
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            self.minimum = value
+            self.maximum = value
+            self.ewma = value
+        else:
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (value - self.mean)
+            self.minimum = min(self.minimum, value)
+            self.maximum = max(self.maximum, value)
+
+            # Weight the new value by how much time has passed since the last one
+            elapsed = max(timestamp - self._ewma_timestamp, 0)
+            alpha = 1 - 0.5 ** (elapsed / self.ewma_half_life)
+            self.ewma += alpha * (value - self.ewma)
+        self._ewma_timestamp = timestamp
+        self.latest = value
+
+
+class WindowedStats(object):
+    """
+    Count, mean, min and max of the values of the last `window` seconds.
+    Values are accumulated into `buckets` slots of window / buckets seconds
+    each, so a window holds at most that many entries however often values
+    arrive, and expires a slot at a time. A running sum gives the mean, and
+    monotonic deques of slot minimums and maximums give the min and max,
+    so each value costs amortized O(1) to add and to expire.
+    """
+
+    def __init__(self, window, buckets=DEFAULT_WINDOW_BUCKETS):
+        """ Constructor
+        :type window: float
+        :param window: Length of the window, in seconds
+        :type buckets: int
+        :param buckets: Slots the window is divided into, bounding its memory
+        """
+        self.window = window
+        self.buckets = buckets
+        self._slot_seconds = window / buckets
+        self._slots = deque()  # [slot, sum, count], oldest first
+        self._sum = 0.0
+        self._count = 0
+        self._minimums = deque()  # Increasing values, each with its slot, at most one per slot
+        self._maximums = deque()  # Decreasing values, each with its slot, at most one per slot
+
+    def _slot(self, timestamp):
+        return int(timestamp // self._slot_seconds)
+
+    def add(self, timestamp, value):
+        slot = self._slot(timestamp)
+        if self._slots and self._slots[-1][0] >= slot:
+            latest = self._slots[-1]  # Late values join the latest slot
+            latest[1] += value
+            latest[2] += 1
+            slot = latest[0]
+        else:
+            self._slots.append([slot, value, 1])
+        self._sum += value
+        self._count += 1
+        while self._minimums and self._minimums[-1][1] >= value:
+            self._minimums.pop()
+        if not self._minimums or self._minimums[-1][0] != slot:
+            self._minimums.append((slot, value))
+        while self._maximums and self._maximums[-1][1] <= value:
+            self._maximums.pop()
+        if not self._maximums or self._maximums[-1][0] != slot:
+            self._maximums.append((slot, value))
+        self.expire(timestamp)
+
+    def expire(self, now):
+        cutoff = self._slot(now) - self.buckets
+        while self._slots and self._slots[0][0] <= cutoff:
+            _, expired_sum, expired_count = self._slots.popleft()
+            self._sum -= expired_sum
+            self._count -= expired_count
+        while self._minimums and self._minimums[0][0] <= cutoff:
+            self._minimums.popleft()
+        while self._maximums and self._maximums[0][0] <= cutoff:
+            self._maximums.popleft()
+        if not self._slots:
+            self._sum = 0.0  # Drop accumulated rounding error
+
+    def summary(self):
+        if self._count == 0:
+            return WindowSummary(0, math.nan, math.nan, math.nan)
+        return WindowSummary(self._count, self._sum / self._count, self._minimums[0][1], self._maximums[0][1])
+
+
+class SeriesStats(object):
+    """Running and windowed statistics of one series of values"""
+
+    def __init__(self, windows, ewma_half_life):
+        self.running = RunningStats(ewma_half_life)
+        self.windows = {name: WindowedStats(length) for name, length in windows.items()}
+
+    def add(self, timestamp, value):
+        self.running.add(timestamp, value)
+        for windowed in self.windows.values():
+            windowed.add(timestamp, value)
+
+    def summary(self, now=None):
+        if now is not None:
+            for windowed in self.windows.values():
+                windowed.expire(now)
+        running = self.running
+        return StatsSummary(running.count, running.mean, running.variance, running.minimum, running.maximum,
+                            running.ewma, running.latest,
+                            {name: windowed.summary() for name, windowed in self.windows.items()})
+
+
+class RollingStatsEngine(object):
+    """
+    Statistics of every measurement per room and per (floor, wing), fed one
+    sweep at a time. Missing (NaN) values are skipped.
+    """
+
+    def __init__(self, windows=None, ewma_half_life=DEFAULT_EWMA_HALF_LIFE):
+        """ Constructor
+        :type windows: dict
+        :param windows: Window name -> length in seconds, defaults to 15 min, 1 h and 24 h
+        :type ewma_half_life: float
+        :param ewma_half_life: Seconds after which a value's weight in the EWMA has halved
+        """
+        self.windows = dict(DEFAULT_WINDOWS if windows is None else windows)
+        self.ewma_half_life = ewma_half_life
+        self._rooms = {}
+        self._combos = {}
+        self._lock = threading.Lock()
+
+    def _series(self, series, key):
+        stats = series.get(key)
+        if stats is None:
+            stats = SeriesStats(self.windows, self.ewma_half_life)
+            series[key] = stats
+        return stats
+
+    def update(self, columns):
+        """ Add a sweep of readings, given as ReadingsStore.append() arguments """
+        with self._lock:
+            for argument, measurement_column in MEASUREMENT_COLUMNS.items():
+                values = numpy.asarray(columns[argument], dtype=numpy.float64)
+                for index in numpy.flatnonzero(~numpy.isnan(values)):
+                    timestamp = int(columns['timestamps'][index])
+                    value = float(values[index])
+                    room_key = (columns['rooms'][index], measurement_column)
+                    combo_key = (int(columns['floors'][index]), str(columns['wings'][index]), measurement_column)
+                    self._series(self._rooms, room_key).add(timestamp, value)
+                    self._series(self._combos, combo_key).add(timestamp, value)
+
+    def room(self, room, measurement_column, now=None):
+        """ Get the statistics of a room's measurement, with windows ending at `now` (default: latest reading)
+        :rtype: StatsSummary
+        :return: The statistics, or None if the room has no readings of the measurement
+        """
+        with self._lock:
+            stats = self._rooms.get((str(room), measurement_column))
+            return stats.summary(now) if stats is not None else None
+
+    def combo(self, selected_floor, selected_wing, measurement_column, now=None):
+        """ Get the statistics of a floor and wing's measurement, with windows ending at `now` (default: latest reading)
+        :rtype: StatsSummary
+        :return: The statistics, or None if the floor and wing have no readings of the measurement
+        """
+        with self._lock:
+            stats = self._combos.get((int(selected_floor), str(selected_wing), measurement_column))
+            return stats.summary(now) if stats is not None else None
@@ -0,0 +1,333 @@
+"""
+#
+# File:              rollups.py
+# Description:       Compacts the raw readings of a session archive into
+#                    5-minute, hourly and daily tiers holding the minimum,
+#                    mean, maximum and count of each measurement per room,
+#                    prunes raw readings older than a retention window once
+#                    rolled up, and answers history queries from the coarsest
+#                    tier fine enough for the requested range.
+#
+"""
+
+import argparse
+import calendar
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy
+import pandas as pd
+
+import metrics
+from collector import report_loop_error
+from readings_store import DATE_FORMAT
+from session_persistence import ARCHIVE_PATH, SessionArchive, local_now, partition_path
+
+Tier = namedtuple('Tier', ['name', 'seconds'])
+TIERS = [Tier('5min', 5 * 60), Tier('hourly', 60 * 60), Tier('daily', 24 * 60 * 60)]  # Finest first
+
+DEFAULT_RAW_RETENTION = 30 * 24 * 60 * 60  # Seconds of raw readings kept once rolled up
+DEFAULT_COMPACT_INTERVAL = 5 * 60  # Seconds between compactions
+DEFAULT_MAX_POINTS = 500  # Buckets per room a query returns at most, unless a resolution is given
+SETTLE_SECONDS = 2 * 60  # Seconds after its end before a bucket is compacted, so late sweeps are included
+PRUNE_STEP = 24 * 60 * 60  # Raw readings are pruned a whole day at a time, so files are rarely rewritten
+
+ROLLUPS_DIRECTORY = 'rollups'
+ROLLUP_FILE = 'rollup.bin'
+ROLLUP_DTYPE = numpy.dtype([('timestamp', '<i8'), ('room', '<i4'),
+                            ('temperature_min', '<f4'), ('temperature_mean', '<f4'), ('temperature_max', '<f4'),
+                            ('temperature_count', '<i4'),
+                            ('co2_min', '<f4'), ('co2_mean', '<f4'), ('co2_max', '<f4'), ('co2_count', '<i4')])
+
+# Measurement column -> prefix of its fields in ROLLUP_DTYPE
+MEASUREMENTS = {'Temperature': 'temperature', 'CO2 Level': 'co2'}
+STATISTICS = ['Min', 'Mean', 'Max', 'Count']
+ROLLUP_COLUMNS = ['Timestamp', 'Room', 'Floor', 'Wing'] + ['{0} {1}'.format(column, statistic)
+                                                            for column in MEASUREMENTS for statistic in STATISTICS]
+
+ROLLUP_SECONDS = metrics.histogram('rollup_seconds', 'Seconds to compact readings into rollup tiers, or to query them')
+
+
+def _empty_rollups():
+    rollups = pd.DataFrame({'Timestamp': numpy.empty(0, dtype=numpy.int64), 'Room': numpy.empty(0, dtype=object)})
+    for column in MEASUREMENTS:
+        for statistic in STATISTICS:
+            rollups['{0} {1}'.format(column, statistic)] = numpy.empty(
+                0, dtype=numpy.int64 if statistic == 'Count' else numpy.float64)
+    return rollups
+
+
+def summarize(readings, seconds):
+    """ Roll raw readings, in the ReadingsStore.view() format, up into buckets of the given length
+    :rtype: DataFrame
+    :return: Timestamp (start of the bucket), Room and the statistics of each measurement, by bucket and room
+    """
+    if readings.empty:
+        return _empty_rollups()
+    frame = pd.DataFrame({'Timestamp': readings['Timestamp'].to_numpy(dtype=numpy.int64) // seconds * seconds,
+                          'Room': readings['Room'].astype(str).to_numpy()})
+    aggregations = {}
+    for column in MEASUREMENTS:
+        frame[column] = readings[column].to_numpy(dtype=numpy.float64)
+        for statistic in STATISTICS:
+            aggregations['{0} {1}'.format(column, statistic)] = (column, statistic.lower())
+    return frame.groupby(['Timestamp', 'Room'], sort=True).agg(**aggregations).reset_index()
+
+
+def combine(rollups, seconds):
+    """ Roll rollups up again into longer buckets, weighting each mean by its count
+    :rtype: DataFrame
+    """
+    if rollups.empty:
+        return _empty_rollups()
+    frame = pd.DataFrame({'Timestamp': rollups['Timestamp'].to_numpy(dtype=numpy.int64) // seconds * seconds,
+                          'Room': rollups['Room'].to_numpy()})
+    aggregations = {}
+    for column in MEASUREMENTS:
+        counts = rollups[column + ' Count'].to_numpy()
+        frame[column + ' Min'] = rollups[column + ' Min'].to_numpy()
+        frame[column + ' Max'] = rollups[column + ' Max'].to_numpy()
+        frame[column + ' Count'] = counts
+        frame[column + ' Total'] = numpy.nan_to_num(rollups[column + ' Mean'].to_numpy(dtype=numpy.float64)) * counts
+        aggregations.update({column + ' Min': (column + ' Min', 'min'), column + ' Max': (column + ' Max', 'max'),
+                             column + ' Count': (column + ' Count', 'sum'), column + ' Total': (column + ' Total', 'sum')})
+    combined = frame.groupby(['Timestamp', 'Room'], sort=True).agg(**aggregations).reset_index()
+
+    for column in MEASUREMENTS:
+        counts = combined[column + ' Count'].to_numpy()
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            combined[column + ' Mean'] = numpy.where(counts > 0, combined.pop(column + ' Total') / counts, numpy.nan)
+    return combined[_empty_rollups().columns]
+
+
+class Rollups(object):
+    """
+    Rollup tiers kept next to the raw readings of a SessionArchive, one
+    append-only file of fixed-size records per tier and floor/wing, in
+    bucket order. Each tier is built from the next finer one, so each
+    compaction only reads what was added since the previous one.
+    """
+
+    def __init__(self, archive, raw_retention=DEFAULT_RAW_RETENTION, interval=DEFAULT_COMPACT_INTERVAL):
+        """ Constructor
+        :type archive: SessionArchive
+        :param archive: Archive of the raw readings, read only to only query the tiers
+        :type raw_retention: float
+        :param raw_retention: Seconds of raw readings kept once rolled up, None to keep all of them
+        :type interval: float
+        :param interval: Seconds between compactions when run in the background
+        """
+        self.archive = archive
+        self.raw_retention = raw_retention
+        self.interval = interval
+        self._checked_files = set()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _path(self, tier, partition_floor, partition_wing):
+        directory = os.path.join(self.archive.directory, ROLLUPS_DIRECTORY, tier.name)
+        return os.path.join(partition_path(directory, partition_floor, partition_wing), ROLLUP_FILE)
+
+    def _records(self, tier, combo):
+        path = self._path(tier, *combo)
+        count = os.path.getsize(path) // ROLLUP_DTYPE.itemsize if os.path.isfile(path) else 0
+        if not count:
+            return None
+        return numpy.memmap(path, dtype=ROLLUP_DTYPE, mode='r', shape=(count,))
+
+    def watermark(self, tier, combo):
+        """ Get the end of the latest bucket of a tier, or None if it is empty
+        :rtype: int
+        """
+        records = self._records(tier, combo)
+        if records is None:
+            return None
+        return int(records['timestamp'][-1]) + tier.seconds
+
+    def _read(self, tier, combo, start, end):
+        records = self._records(tier, combo)
+        if records is None:
+            return _empty_rollups()
+        timestamps = records['timestamp']
+        first = 0 if start is None else int(numpy.searchsorted(timestamps, start, side='left'))
+        last = len(records) if end is None else int(numpy.searchsorted(timestamps, end, side='left'))
+        selected = numpy.array(records[first:last])
+        del records
+
+        rollups = pd.DataFrame({'Timestamp': selected['timestamp'],
+                                'Room': self.archive.decode_rooms(selected['room'])})
+        for column, prefix in MEASUREMENTS.items():
+            for statistic in STATISTICS:
+                rollups['{0} {1}'.format(column, statistic)] = selected['{0}_{1}'.format(prefix, statistic.lower())]
+        return rollups
+
+    def _append(self, tier, combo, rollups):
+        records = numpy.empty(len(rollups), dtype=ROLLUP_DTYPE)
+        records['timestamp'] = rollups['Timestamp'].to_numpy()
+        records['room'] = self.archive.encode_rooms(list(rollups['Room']))
+        for column, prefix in MEASUREMENTS.items():
+            for statistic in STATISTICS:
+                records['{0}_{1}'.format(prefix, statistic.lower())] = rollups['{0} {1}'.format(column, statistic)]
+
+        path = self._path(tier, *combo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path not in self._checked_files:
+            # Drop a partial record left behind by a crash mid-write
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+                if size % ROLLUP_DTYPE.itemsize:
+                    os.truncate(path, size - size % ROLLUP_DTYPE.itemsize)
+            self._checked_files.add(path)
+
+        with open(path, 'ab') as rollup_file:
+            rollup_file.write(records.tobytes())
+            rollup_file.flush()
+            os.fsync(rollup_file.fileno())
+
+    def compact(self):
+        """ Roll up every complete bucket not rolled up yet, then prune the raw readings past the retention window
+        :rtype: int
+        :return: Number of raw readings pruned
+        """
+        now = local_now() - SETTLE_SECONDS
+        pruned = 0
+        for combo in self.archive.partitions():
+            for index, tier in enumerate(TIERS):
+                with ROLLUP_SECONDS.time(operation='compact', tier=tier.name):
+                    start = self.watermark(tier, combo)
+                    end = now // tier.seconds * tier.seconds
+                    if start is not None and start >= end:
+                        continue
+                    if index == 0:
+                        rollups = summarize(self.archive.read([combo], start, end), tier.seconds)
+                    else:
+                        rollups = combine(self._read(TIERS[index - 1], combo, start, end), tier.seconds)
+                    if not rollups.empty:
+                        self._append(tier, combo, rollups)
+
+            # Raw readings are only pruned once they are rolled up
+            rolled_up = self.watermark(TIERS[0], combo)
+            if self.raw_retention is not None and rolled_up is not None:
+                before = min(local_now() - self.raw_retention, rolled_up) // PRUNE_STEP * PRUNE_STEP
+                pruned += self.archive.prune(combo[0], combo[1], before)
+        return pruned
+
+    def tier_for(self, resolution):
+        """ Get the coarsest tier with buckets no longer than the given resolution
+        :rtype: Tier
+        :return: The tier, or None if only raw readings are fine enough
+        """
+        fine_enough = [tier for tier in TIERS if tier.seconds <= resolution]
+        return fine_enough[-1] if fine_enough else None
+
+    def _query_partition(self, combo, tier, start, end, resolution):
+        frames = []
+        if tier is None:
+            # Raw readings, with the finest tier standing in for those past the retention window
+            raw = self.archive.read([combo], start, end)
+            first_raw = int(raw['Timestamp'].iloc[0]) if not raw.empty else end
+            if first_raw > start:
+                frames.append(self._read(TIERS[0], combo, start, first_raw))
+            frames.append(summarize(raw, max(1, int(resolution))))
+        else:
+            # The chosen tier up to its latest bucket, then each finer tier past the end of the coarser one
+            cursor = start
+            for source in TIERS[TIERS.index(tier)::-1]:
+                watermark = self.watermark(source, combo)
+                if watermark is None or watermark <= cursor:
+                    continue
+                rollups = self._read(source, combo, cursor, min(end, watermark))
+                frames.append(rollups if source is tier else combine(rollups, tier.seconds))
+                cursor = watermark
+                if cursor >= end:
+                    break
+            if cursor < end:
+                frames.append(summarize(self.archive.read([combo], cursor, end), tier.seconds))
+
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return None
+        rollups = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        rollups['Floor'] = numpy.int16(combo[0])
+        rollups['Wing'] = combo[1]
+        return rollups
+
+    def query(self, combos=None, start=None, end=None, resolution=None, max_points=DEFAULT_MAX_POINTS):
+        """ Get the statistics of every room over time, from the coarsest tier fine enough for the range
+        :type combos: list
+        :param combos: (floor, wing) combinations to read, all of them if None
+        :type start: int
+        :param start: Earliest epoch second to include, from the beginning of history if None
+        :type end: int
+        :param end: Epoch second to stop before, the present if None
+        :type resolution: float
+        :param resolution: Longest acceptable bucket, in seconds, by default the range divided by max_points
+        :type max_points: int
+        :param max_points: Buckets per room the default resolution allows
+        :rtype: DataFrame
+        :return: ROLLUP_COLUMNS, by bucket and room
+        """
+        end = local_now() + 1 if end is None else int(end)
+        start = 0 if start is None else int(start)
+        if resolution is None:
+            resolution = max(1, (end - start) / max_points)
+        tier = self.tier_for(resolution)
+
+        with ROLLUP_SECONDS.time(operation='query', tier=tier.name if tier is not None else 'raw'):
+            if tier is not None:
+                start = start // tier.seconds * tier.seconds  # Include the bucket the range starts in
+            combos = self.archive.partitions() if combos is None else combos
+            frames = [frame for frame in (self._query_partition(combo, tier, start, end, resolution)
+                                          for combo in combos) if frame is not None]
+            if not frames:
+                rollups = _empty_rollups()
+                rollups['Floor'] = numpy.empty(0, dtype=numpy.int16)
+                rollups['Wing'] = numpy.empty(0, dtype=object)
+                return rollups[ROLLUP_COLUMNS]
+            rollups = pd.concat(frames, ignore_index=True).sort_values(['Timestamp', 'Room'], kind='stable',
+                                                                        ignore_index=True)
+            return rollups[ROLLUP_COLUMNS]
+
+    def run(self):
+        """ Compact every interval until stopped """
+        while not self._stop_event.is_set():
+            try:
+                self.compact()
+            except Exception:
+                report_loop_error('rollup')
+            self._stop_event.wait(self.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roll up archived readings, or query their history.')
+    parser.add_argument('--archive', default=ARCHIVE_PATH, help='archive directory')
+    subparsers = parser.add_subparsers(dest='command')
+    compact_parser = subparsers.add_parser('compact', help='roll up new readings and prune old raw readings')
+    compact_parser.add_argument('--raw-retention-days', type=float, default=DEFAULT_RAW_RETENTION / (24 * 60 * 60),
+                                help='days of raw readings to keep once rolled up (0 to keep all of them)')
+    query_parser = subparsers.add_parser('query', help='print the history of a range, e.g. to a CSV file')
+    query_parser.add_argument('--start', default=None, help='first date and time, as MM/DD/YYYY HH:MM')
+    query_parser.add_argument('--end', default=None, help='date and time to stop before, as MM/DD/YYYY HH:MM')
+    query_parser.add_argument('--resolution', type=float, default=None,
+                              help='longest acceptable bucket, in seconds (default: about 500 buckets per room)')
+    options = parser.parse_args()
+
+    if options.command == 'compact':
+        rollups = Rollups(SessionArchive(options.archive),
+                          raw_retention=options.raw_retention_days * 24 * 60 * 60 or None)
+        print('Pruned {0} raw readings'.format(rollups.compact()))
+        rollups.archive.close()
+    elif options.command == 'query':
+        def epoch(text):
+            return None if text is None else calendar.timegm(time.strptime(text, DATE_FORMAT))
+
+        history = Rollups(SessionArchive(options.archive, read_only=True)).query(
+            start=epoch(options.start), end=epoch(options.end), resolution=options.resolution)
+        history['Timestamp'] = pd.to_datetime(history['Timestamp'], unit='s').dt.strftime(DATE_FORMAT)
+        print(history.to_csv(index=False), end='')
+    else:
+        parser.print_help()
@@ -0,0 +1,131 @@
+"""
+#
+# File:              sensor_registry.py
+# Description:       Parses the room sensor file once into typed, indexed
+#                    lookups by room label and by floor/wing, reloading it
+#                    when the file changes on disk.
+#
+"""
+
+import os
+import threading
+import time
+
+import pandas as pd
+
+ROOM_SENSOR_PATH = os.path.join('CSVs', 'ahs_air.csv')
+RELOAD_CHECK_INTERVAL = 1  # Seconds between checks of the file's modification time
+
+
+class _RegistryIndex(object):
+    """Immutable snapshot of the parsed sensor file and its indexes"""
+
+    def __init__(self, rooms, mtime):
+        self.rooms = rooms
+        self.mtime = mtime
+        self.by_label = {label: rooms.iloc[[position]] for position, label in enumerate(rooms['Label'])}
+        self.by_combo = {}
+        for (room_floor, room_wing), combo_rooms in rooms.groupby(['Floor', 'Wing'], sort=True):
+            if room_wing != '':
+                self.by_combo[(int(room_floor), room_wing)] = combo_rooms
+        self.empty = rooms.iloc[0:0]
+
+
+class SensorRegistry(object):
+    """
+    In-memory registry of the rooms in the room sensor file. Each row contains
+    the room label, its facility, the instance IDs of its temperature and CO2
+    sensors, and its wing and floor.
+    """
+
+    def __init__(self, path=ROOM_SENSOR_PATH, check_interval=RELOAD_CHECK_INTERVAL, facility=None):
+        """ Constructor
+        :type path: str
+        :param path: Path of the room sensor CSV file
+        :type check_interval: float
+        :param check_interval: Minimum seconds between checks for changes to the file
+        :type facility: str
+        :param facility: Only hold the rooms of this facility, None for every room
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.facility = facility
+        self._last_check = time.monotonic()
+        self._lock = threading.Lock()
+        self._index = self._load()
+
+    def _load(self):
+        mtime = os.path.getmtime(self.path)
+        rooms = pd.read_csv(self.path, na_filter=False, comment='#', dtype=str)
+
+        # Give the columns proper types, leaving blank instances and floors missing
+        rooms['Label'] = rooms['Label'].str.strip()
+        for column in ['Temperature', 'CO2', 'Floor']:
+            rooms[column] = pd.to_numeric(rooms[column].str.strip(), errors='coerce').astype('Int64')
+        rooms['Wing'] = rooms['Wing'].str.strip()
+        rooms['Facility'] = rooms['Facility'].str.strip()
+        if self.facility is not None:
+            rooms = rooms[rooms['Facility'] == self.facility].reset_index(drop=True)
+
+        return _RegistryIndex(rooms, mtime)
+
+    def reload_if_changed(self):
+        """ Re-parse the file if it has been modified since it was loaded
+        :rtype: bool
+        :return: Whether the registry was reloaded
+        """
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                if os.path.getmtime(self.path) == self._index.mtime:
+                    return False
+                self._index = self._load()
+            except (OSError, ValueError, KeyError):
+                # Keep serving the last good copy while the file is missing or half-written
+                return False
+        return True
+
+    def _current(self):
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.reload_if_changed()
+        return self._index
+
+    @property
+    def rooms(self):
+        return self._current().rooms
+
+    def room(self, label):
+        """ Get the row of the given room
+        :rtype: DataFrame
+        :return: One-row DataFrame, or an empty one for an unknown room
+        """
+        index = self._current()
+        return index.by_label.get(str(label), index.empty)
+
+    def rooms_in(self, selected_floor, selected_wing):
+        """ Get the rows of every room on the given floor and wing
+        :rtype: DataFrame
+        """
+        index = self._current()
+        return index.by_combo.get((int(selected_floor), str(selected_wing)), index.empty)
+
+    def rooms_in_combos(self, combos):
+        """ Get the rows of every room in any of the given (floor, wing) combinations
+        :rtype: DataFrame
+        """
+        index = self._current()
+        frames = [index.by_combo[(int(combo_floor), str(combo_wing))] for combo_floor, combo_wing in combos
+                  if (int(combo_floor), str(combo_wing)) in index.by_combo]
+        return pd.concat(frames) if frames else index.empty
+
+    def combos(self):
+        """ Get every (floor, wing) combination that has rooms, in floor then wing order
+        :rtype: list
+        """
+        return list(self._current().by_combo)
+
+    def facilities(self):
+        """ Get every facility with rooms, in the order they first appear in the file
+        :rtype: list
+        """
+        return [facility for facility in self._current().rooms['Facility'].unique() if facility != '']
@@ -0,0 +1,494 @@
+"""
+#
+# File:              session_persistence.py
+# Description:       Append-only archive of session readings, partitioned by
+#                    floor and wing. Each flush writes one compact columnar
+#                    chunk per partition: Parquet when pyarrow is installed,
+#                    fixed-size NumPy records read back through memory maps
+#                    otherwise.
+#
+"""
+
+import argparse
+import calendar
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy
+import pandas as pd
+
+import metrics
+from readings_store import air_df_columns
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None  # Fall back to the NumPy record format
+
+ARCHIVE_PATH = os.path.join('CSVs', 'session_archive')
+SAVED_DATA_PATH = os.path.join('CSVs', 'ahs_air_data.csv')
+DEFAULT_FLUSH_INTERVAL = 60  # Seconds
+DEFAULT_LATEST_LOOKBACK = 24 * 60 * 60  # Seconds
+
+RECORDS_FILE = 'readings.bin'
+ROOMS_FILE = 'rooms.jsonl'
+UNITS_FILE = 'units.json'
+RECORD_DTYPE = numpy.dtype([('timestamp', '<i8'), ('room', '<i4'), ('temperature', '<f4'), ('co2', '<f4')])
+
+READING_COLUMNS = ['Timestamp', 'Room', 'Temperature', 'CO2 Level', 'Floor', 'Wing']
+
+ARCHIVE_SECONDS = metrics.histogram('archive_seconds', 'Seconds spent reading or writing the session archive')
+
+
+def local_now():
+    # Readings are stamped with the local wall-clock time, stored as epoch seconds
+    return calendar.timegm(time.localtime())
+
+
+def partition_path(directory, partition_floor, partition_wing):
+    return os.path.join(directory, 'Floor={0}'.format(partition_floor), 'Wing={0}'.format(partition_wing))
+
+
+def _empty_readings():
+    return pd.DataFrame({
+        'Timestamp': numpy.empty(0, dtype=numpy.int64),
+        'Room': pd.Categorical([]),
+        'Temperature': numpy.empty(0, dtype=numpy.float32),
+        'CO2 Level': numpy.empty(0, dtype=numpy.float32),
+        'Floor': numpy.empty(0, dtype=numpy.int16),
+        'Wing': pd.Categorical([]),
+    })
+
+
+class SessionArchive(object):
+    """
+    Appended sweeps are buffered in memory and written out at most every
+    flush_interval seconds, so a crash loses at most one interval of
+    readings. Reads only open the partitions of the requested floors and
+    wings, and skip data outside the requested time range.
+    """
+
+    def __init__(self, directory=ARCHIVE_PATH, flush_interval=DEFAULT_FLUSH_INTERVAL, file_format=None,
+                 read_only=False):
+        """ Constructor
+        :type directory: str
+        :param directory: Root directory of the archive
+        :type flush_interval: float
+        :param flush_interval: Seconds between writes of buffered readings
+        :type file_format: str
+        :param file_format: 'parquet' or 'numpy', defaults to parquet when pyarrow is installed
+        :type read_only: bool
+        :param read_only: Only read the archive, e.g. while another process is writing to it
+        """
+        if file_format is None:
+            file_format = 'parquet' if pyarrow is not None else 'numpy'
+        if file_format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is required to write Parquet archives')
+
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.file_format = file_format
+        self.read_only = read_only
+
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._opened_partitions = set()
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+
+        # Labels of the rooms referenced by NumPy records, in code order
+        self._rooms = []
+        self._room_codes = {}
+        self._rooms_size = 0
+        self._load_rooms()
+        rooms_path = os.path.join(directory, ROOMS_FILE)
+        if not read_only and os.path.isfile(rooms_path) and self._rooms_size != os.path.getsize(rooms_path):
+            # Drop a partial label left behind by a crash mid-write
+            os.truncate(rooms_path, self._rooms_size)
+
+        self.units = {}
+        self._load_units()
+
+    def _load_rooms(self):
+        # Read the complete labels added since the last call
+        rooms_path = os.path.join(self.directory, ROOMS_FILE)
+        if not os.path.isfile(rooms_path):
+            return
+        with open(rooms_path, 'rb') as rooms_file:
+            rooms_file.seek(self._rooms_size)
+            for line in rooms_file:
+                if not line.endswith(b'\n'):
+                    break
+                self._rooms_size += len(line)
+                room = json.loads(line)
+                self._room_codes[room] = len(self._rooms)
+                self._rooms.append(room)
+
+    def _load_units(self):
+        units_path = os.path.join(self.directory, UNITS_FILE)
+        if os.path.isfile(units_path):
+            try:
+                with open(units_path) as units_file:
+                    self.units = json.load(units_file)
+            except ValueError:
+                pass  # Being rewritten by another process, keep the units already known
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.flush()
+
+    def append(self, air_df):
+        """ Buffer the rows of an air values DataFrame, flushing if the flush interval has passed """
+        if air_df is None or air_df.empty:
+            return
+        columns, units = air_df_columns(air_df)
+        self.append_columns(columns, units)
+
+    def append_columns(self, columns, units=None):
+        """ Buffer readings given as ReadingsStore.append() arguments, flushing if the flush interval has passed """
+        with self._lock:
+            self._pending.append(columns)
+            if units:
+                self.units.update(units)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write every buffered reading to its partition """
+        if self.read_only:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+            if not pending:
+                return
+
+            readings = pd.DataFrame({
+                'Timestamp': numpy.concatenate([columns['timestamps'] for columns in pending]),
+                'Room': [room for columns in pending for room in columns['rooms']],
+                'Temperature': numpy.concatenate([columns['temperatures'] for columns in pending]),
+                'CO2 Level': numpy.concatenate([columns['co2_levels'] for columns in pending]),
+                'Floor': numpy.concatenate([columns['floors'] for columns in pending]),
+                'Wing': [wing for columns in pending for wing in columns['wings']],
+            })
+
+            with ARCHIVE_SECONDS.time(operation='write'):
+                for (partition_floor, partition_wing), partition in readings.groupby(['Floor', 'Wing'], sort=False):
+                    directory = partition_path(self.directory, partition_floor, partition_wing)
+                    os.makedirs(directory, exist_ok=True)
+                    if self.file_format == 'parquet':
+                        self._write_parquet(directory, partition)
+                    else:
+                        self._write_records(directory, partition)
+
+                with open(os.path.join(self.directory, UNITS_FILE), 'w') as units_file:
+                    json.dump(self.units, units_file)
+
+    def _write_parquet(self, directory, partition):
+        table = pyarrow.Table.from_pandas(partition[['Timestamp', 'Room', 'Temperature', 'CO2 Level']],
+                                          preserve_index=False)
+        file_name = 'part-{0}-{1}.parquet'.format(int(partition['Timestamp'].iloc[0]), uuid.uuid4().hex[:8])
+        pq.write_table(table, os.path.join(directory, file_name))
+
+    def _register_rooms(self, rooms):
+        # Register new rooms before writing records that refer to them
+        new_rooms = [room for room in pd.unique(numpy.asarray(rooms, dtype=object)) if room not in self._room_codes]
+        if new_rooms:
+            with open(os.path.join(self.directory, ROOMS_FILE), 'a') as rooms_file:
+                for room in new_rooms:
+                    self._room_codes[room] = len(self._rooms)
+                    self._rooms.append(room)
+                    line = json.dumps(room) + '\n'
+                    rooms_file.write(line)
+                    self._rooms_size += len(line.encode('utf-8'))
+                rooms_file.flush()
+                os.fsync(rooms_file.fileno())
+        return numpy.array([self._room_codes[room] for room in rooms], dtype=numpy.int32)
+
+    def encode_rooms(self, rooms):
+        """ Get the codes records use for room labels, registering new ones
+        :rtype: ndarray
+        """
+        with self._lock:
+            return self._register_rooms(rooms)
+
+    def decode_rooms(self, codes):
+        """ Get the room labels of record codes
+        :rtype: ndarray
+        """
+        if len(codes) and numpy.max(codes) >= len(self._rooms):
+            # Another process has added rooms since they were loaded
+            self._load_rooms()
+        return numpy.array(self._rooms, dtype=object)[codes]
+
+    def _write_records(self, directory, partition):
+        records = numpy.empty(len(partition), dtype=RECORD_DTYPE)
+        records['timestamp'] = partition['Timestamp'].to_numpy()
+        records['room'] = self._register_rooms(list(partition['Room']))
+        records['temperature'] = partition['Temperature'].to_numpy()
+        records['co2'] = partition['CO2 Level'].to_numpy()
+
+        path = os.path.join(directory, RECORDS_FILE)
+        if directory not in self._opened_partitions:
+            # Drop a partial record left behind by a crash mid-write
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+                if size % RECORD_DTYPE.itemsize:
+                    os.truncate(path, size - size % RECORD_DTYPE.itemsize)
+            self._opened_partitions.add(directory)
+
+        with open(path, 'ab') as records_file:
+            records_file.write(records.tobytes())
+            records_file.flush()
+            os.fsync(records_file.fileno())
+
+    def partitions(self):
+        """ Get every (floor, wing) combination stored in the archive
+        :rtype: list
+        """
+        found = []
+        for directory in sorted(glob.glob(os.path.join(self.directory, 'Floor=*', 'Wing=*'))):
+            floor_name = os.path.basename(os.path.dirname(directory))[len('Floor='):]
+            wing_name = os.path.basename(directory)[len('Wing='):]
+            found.append((int(floor_name), wing_name))
+        return found
+
+    def _read_partition(self, partition_floor, partition_wing, start, end):
+        directory = partition_path(self.directory, partition_floor, partition_wing)
+        frames = []
+
+        parquet_files = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+        if parquet_files:
+            if pyarrow is None:
+                raise ImportError('pyarrow is required to read Parquet archives')
+            filters = []
+            if start is not None:
+                filters.append(('Timestamp', '>=', int(start)))
+            if end is not None:
+                filters.append(('Timestamp', '<', int(end)))
+            table = pq.read_table(parquet_files, filters=filters or None)
+            frames.append(table.to_pandas())
+
+        path = os.path.join(directory, RECORDS_FILE)
+        count = os.path.getsize(path) // RECORD_DTYPE.itemsize if os.path.isfile(path) else 0
+        if count:
+            records = numpy.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+            # Records are appended in time order, so only the requested range is paged in
+            timestamps = records['timestamp']
+            first = 0 if start is None else int(numpy.searchsorted(timestamps, start, side='left'))
+            last = count if end is None else int(numpy.searchsorted(timestamps, end, side='left'))
+            selected = numpy.array(records[first:last])
+            del records
+
+            frames.append(self._decode_records(selected))
+
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return None
+        readings = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        readings['Floor'] = numpy.int16(partition_floor)
+        readings['Wing'] = partition_wing
+        return readings
+
+    def _decode_records(self, records):
+        return pd.DataFrame({
+            'Timestamp': records['timestamp'],
+            'Room': self.decode_rooms(records['room']),
+            'Temperature': records['temperature'],
+            'CO2 Level': records['co2'],
+        })
+
+    def read(self, combos=None, start=None, end=None):
+        """ Read archived readings in the ReadingsStore.view() format, oldest first
+        :type combos: list
+        :param combos: (floor, wing) combinations to read, all of them if None
+        :type start: int
+        :param start: Earliest epoch second to include
+        :type end: int
+        :param end: Epoch second to stop before
+        :rtype: DataFrame
+        """
+        self.flush()
+        with ARCHIVE_SECONDS.time(operation='read'):
+            combos = self.partitions() if combos is None else combos
+
+            frames = []
+            for combo_floor, combo_wing in combos:
+                if not os.path.isdir(partition_path(self.directory, combo_floor, combo_wing)):
+                    continue
+                frame = self._read_partition(combo_floor, combo_wing, start, end)
+                if frame is not None:
+                    frames.append(frame)
+            if not frames:
+                return _empty_readings()
+
+            readings = pd.concat(frames, ignore_index=True)
+            readings = readings.sort_values('Timestamp', kind='stable', ignore_index=True)
+            readings['Room'] = readings['Room'].astype(str).astype('category')
+            readings['Wing'] = readings['Wing'].astype('category')
+            return readings[READING_COLUMNS]
+
+    def read_new(self, cursor=None):
+        """ Read the readings written since the given cursor, e.g. by a collector in another process
+        :type cursor: dict
+        :param cursor: Cursor returned by the previous call, None to read everything
+        :rtype: tuple
+        :return: The new readings in the ReadingsStore.view() format, and the cursor to pass next time
+        """
+        self.flush()
+        cursor = {} if cursor is None else dict(cursor)
+
+        frames = []
+        for partition_floor, partition_wing in self.partitions():
+            directory = partition_path(self.directory, partition_floor, partition_wing)
+            read_count, read_files, file_id, last_timestamp = cursor.get((partition_floor, partition_wing),
+                                                                         (0, frozenset(), None, None))
+            partition_frames = []
+
+            new_files = sorted(set(glob.glob(os.path.join(directory, '*.parquet'))) - read_files)
+            if new_files:
+                if pyarrow is None:
+                    raise ImportError('pyarrow is required to read Parquet archives')
+                partition_frames.append(pq.read_table(new_files).to_pandas())
+
+            path = os.path.join(directory, RECORDS_FILE)
+            count = 0
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                count = stat.st_size // RECORD_DTYPE.itemsize
+                if read_count and stat.st_ino != file_id:
+                    # Pruned since the last read, so the records already read start at their latest timestamp
+                    records = numpy.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+                    read_count = int(numpy.searchsorted(records['timestamp'], last_timestamp, side='right'))
+                    del records
+                file_id = stat.st_ino
+            if count > read_count:
+                records = numpy.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+                selected = numpy.array(records[read_count:count])
+                del records
+                last_timestamp = int(selected['timestamp'][-1])
+                partition_frames.append(self._decode_records(selected))
+
+            cursor[(partition_floor, partition_wing)] = (max(count, read_count), read_files | frozenset(new_files),
+                                                         file_id, last_timestamp)
+            for frame in partition_frames:
+                frame['Floor'] = numpy.int16(partition_floor)
+                frame['Wing'] = partition_wing
+                frames.append(frame)
+
+        self._load_units()
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return _empty_readings(), cursor
+
+        readings = pd.concat(frames, ignore_index=True).sort_values('Timestamp', kind='stable', ignore_index=True)
+        readings['Room'] = readings['Room'].astype(str).astype('category')
+        readings['Wing'] = readings['Wing'].astype('category')
+        return readings[READING_COLUMNS], cursor
+
+    def prune(self, partition_floor, partition_wing, before):
+        """ Delete the readings of a floor and wing older than the given epoch second, e.g. once rolled up
+        :rtype: int
+        :return: Number of readings deleted
+        """
+        if self.read_only:
+            return 0
+        directory = partition_path(self.directory, partition_floor, partition_wing)
+        deleted = 0
+        with self._lock, ARCHIVE_SECONDS.time(operation='prune'):
+            # Parquet chunks are deleted once all of their readings are old enough
+            for path in sorted(glob.glob(os.path.join(directory, '*.parquet'))):
+                timestamps = pq.read_table(path, columns=['Timestamp']).column('Timestamp').to_numpy()
+                if not len(timestamps) or timestamps.max() < before:
+                    os.remove(path)
+                    deleted += len(timestamps)
+
+            path = os.path.join(directory, RECORDS_FILE)
+            count = os.path.getsize(path) // RECORD_DTYPE.itemsize if os.path.isfile(path) else 0
+            if count:
+                records = numpy.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+                first = int(numpy.searchsorted(records['timestamp'], before, side='left'))
+                kept = numpy.array(records[first:]) if first else None
+                del records
+                if first:
+                    # Readers holding the old file keep reading it until they reopen the partition
+                    temporary_path = path + '.tmp'
+                    with open(temporary_path, 'wb') as records_file:
+                        records_file.write(kept.tobytes())
+                        records_file.flush()
+                        os.fsync(records_file.fileno())
+                    try:
+                        os.replace(temporary_path, path)
+                        deleted += first
+                    except PermissionError:
+                        os.remove(temporary_path)  # Mapped by a reader on Windows, pruned on a later call
+        return deleted
+
+    def latest(self, combos=None, lookback=DEFAULT_LATEST_LOOKBACK):
+        """ Read the latest archived temperature and CO2 level of every room in the given (floor, wing)
+        combinations, in one row per room stamped with the newer of the two
+        :type lookback: float
+        :param lookback: Seconds of recent history to search first, before falling back to all of it
+        :rtype: DataFrame
+        """
+        readings = self.read(combos, start=local_now() - lookback)
+        if readings.empty:
+            readings = self.read(combos)
+
+        # A row may only hold one of the measurements, so each comes from the latest row that has it
+        measured = readings[['Temperature', 'CO2 Level']].notna().any(axis=1)
+        latest = readings[measured].drop_duplicates('Room', keep='last').reset_index(drop=True)
+        rooms = latest['Room'].astype(str)
+        for column in ['Temperature', 'CO2 Level']:
+            valid = readings[readings[column].notna()].drop_duplicates('Room', keep='last')
+            values = pd.Series(valid[column].to_numpy(), index=valid['Room'].astype(str).to_numpy())
+            latest[column] = rooms.map(values).to_numpy(dtype=numpy.float32)
+        return latest
+
+
+def migrate(csv_paths, directory=ARCHIVE_PATH, file_format=None):
+    """ Copy the readings of saved session CSV files into an archive
+    :rtype: int
+    :return: Number of readings copied
+    """
+    frames = [pd.read_csv(path, index_col=0, na_filter=False) for path in csv_paths]
+    air_df = pd.concat(frames, ignore_index=True)
+    air_df = air_df[air_df['Date / Time'].astype(str) != '']
+
+    # Archive partitions are kept in time order
+    air_df = air_df.iloc[numpy.argsort(pd.to_datetime(air_df['Date / Time'], format='%m/%d/%Y %H:%M').to_numpy(),
+                                       kind='stable')]
+
+    archive = SessionArchive(directory, flush_interval=float('inf'), file_format=file_format)
+    archive.append(air_df)
+    archive.close()
+    return len(air_df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the archive of saved session readings.')
+    subparsers = parser.add_subparsers(dest='command')
+    migrate_parser = subparsers.add_parser('migrate', help='copy saved session CSV files into the archive')
+    migrate_parser.add_argument('csv_paths', nargs='*', default=[SAVED_DATA_PATH])
+    migrate_parser.add_argument('--archive', default=ARCHIVE_PATH, help='archive directory')
+    migrate_parser.add_argument('--format', choices=['parquet', 'numpy'], help='file format of new chunks')
+    options = parser.parse_args()
+
+    if options.command == 'migrate':
+        copied = migrate(options.csv_paths, options.archive, options.format)
+        print('Copied {0} readings into {1}'.format(copied, options.archive))
+    else:
+        parser.print_help()
@@ -0,0 +1,270 @@
+"""
+#
+# File:              shared_readings.py
+# Description:       Latest reading of every room and the floor/wing summaries,
+#                    kept by a collector in a memory-mapped file of fixed binary
+#                    layout, so any number of displays on the same machine read
+#                    them in place, without polling the gateway or the archive.
+#                    A sequence number around each update (a seqlock) lets
+#                    readers detect and retry a read that overlapped a write,
+#                    so neither side ever waits for the other.
+#
+#                    Layout, little-endian:
+#                      header      HEADER_DTYPE, HEADER_SIZE bytes
+#                      index       JSON of the facility, rooms, floor/wing
+#                                  combinations and measurements, padded to 8 bytes
+#                      rooms       ROOM_DTYPE, one per room of the index
+#                      aggregates  AGGREGATE_DTYPE, one per combination and
+#                                  measurement, combination major
+#
+"""
+
+import json
+import mmap
+import os
+import threading
+import time
+
+import numpy
+
+from air_aggregates import Aggregate, MEASUREMENT_COLUMNS
+
+SHARED_READINGS_FILE = 'latest_readings.bin'  # In the archive directory of each facility
+MAGIC = b'AIRSHM'
+LAYOUT_VERSION = 1
+HEADER_SIZE = 128
+
+STALE_WRITE = 1  # Seconds a write may seem in progress before readers assume its writer died
+
+# The rest of the header is reserved
+HEADER_DTYPE = numpy.dtype({'names': ['magic', 'layout_version', 'index_size', 'sequence', 'written', 'room_count',
+                                      'aggregate_count', 'units'],
+                            'formats': ['S8', '<u4', '<u4', '<u8', '<f8', '<u4', '<u4',
+                                        ('S16', (len(MEASUREMENT_COLUMNS),))],
+                            'itemsize': HEADER_SIZE})
+ROOM_DTYPE = numpy.dtype([('timestamp', '<i8'), ('temperature', '<f4'), ('co2_level', '<f4')])
+AGGREGATE_DTYPE = numpy.dtype([('timestamp', '<i8'), ('mean', '<f8'), ('maximum', '<f8'), ('minimum', '<f8'),
+                               ('count', '<i4'), ('maximum_room', '<i4')])
+
+
+def _aggregate_positions(combos, measurement_columns):
+    # (floor, wing, measurement column) -> row of the aggregates array
+    keys = [(int(combo_floor), str(combo_wing), measurement_column) for combo_floor, combo_wing in combos
+            for measurement_column in measurement_columns]
+    return {key: position for position, key in enumerate(keys)}
+
+
+def _views(buffer, header):
+    # Index, room and aggregate arrays of a file, from its header
+    index_end = HEADER_SIZE + int(header['index_size'])
+    index = json.loads(bytes(buffer[HEADER_SIZE:index_end]).decode('utf-8'))
+    rooms_offset = index_end + -index_end % 8
+    rooms = numpy.frombuffer(buffer, ROOM_DTYPE, int(header['room_count']), rooms_offset)
+    aggregates = numpy.frombuffer(buffer, AGGREGATE_DTYPE, int(header['aggregate_count']),
+                                  rooms_offset + rooms.nbytes)
+    return index, rooms, aggregates
+
+
+class SharedReadingsWriter(object):
+    """
+    Writes the readings a session records to a shared readings file. The
+    file is laid out once for the rooms of the registry, then updated in
+    place; it is only replaced, under the same name, when recreated.
+    Readings of rooms added to the room sensor file later are left out
+    until the collector is restarted.
+    """
+
+    def __init__(self, path, registry, session):
+        """ Constructor
+        :type path: str
+        :param path: Shared readings file, replaced if it exists
+        :type registry: SensorRegistry
+        :param registry: Registry of the facility's rooms
+        :type session: SessionData
+        :param session: Session whose readings and summaries are written, as its listener
+        """
+        self.path = path
+        self.session = session
+
+        rooms = registry.rooms
+        rooms = rooms[rooms['Floor'].notna() & (rooms['Wing'] != '')]
+        labels = rooms['Label'].astype(str).tolist()
+        combos = registry.combos()
+        index = json.dumps({
+            'facility': registry.facility,
+            'rooms': [[label, int(room_floor), str(room_wing)]
+                      for label, room_floor, room_wing in zip(labels, rooms['Floor'], rooms['Wing'])],
+            'combos': [[int(combo_floor), str(combo_wing)] for combo_floor, combo_wing in combos],
+            'measurements': MEASUREMENT_COLUMNS,
+        }).encode('utf-8')
+        self._rooms = {label: position for position, label in enumerate(labels)}
+        self._aggregates = _aggregate_positions(combos, MEASUREMENT_COLUMNS)
+        self._lock = threading.Lock()
+
+        # Laid out next to the file then moved over it, so readers never open a half-initialized one
+        rooms_offset = HEADER_SIZE + len(index) + -(HEADER_SIZE + len(index)) % 8
+        size = rooms_offset + len(labels) * ROOM_DTYPE.itemsize + len(self._aggregates) * AGGREGATE_DTYPE.itemsize
+        temporary_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'wb') as shared_file:
+            shared_file.truncate(size)
+        self._file = open(temporary_path, 'r+b')
+        self._buffer = mmap.mmap(self._file.fileno(), size)
+        self._header = numpy.frombuffer(self._buffer, HEADER_DTYPE, 1)[0]
+        self._header['magic'] = MAGIC
+        self._header['layout_version'] = LAYOUT_VERSION
+        self._header['index_size'] = len(index)
+        self._header['room_count'] = len(labels)
+        self._header['aggregate_count'] = len(self._aggregates)
+        self._buffer[HEADER_SIZE:HEADER_SIZE + len(index)] = index
+        _, self._room_table, self._aggregate_table = _views(self._buffer, self._header)
+        self._room_table['temperature'] = numpy.nan
+        self._room_table['co2_level'] = numpy.nan
+        os.replace(temporary_path, path)
+
+    def update(self, columns, units):
+        """ Write a batch of readings, given as ReadingsStore.append() arguments, and the session's summaries """
+        positions = numpy.array([self._rooms.get(str(room), -1) for room in columns['rooms']], dtype=numpy.int64)
+        timestamps = numpy.asarray(columns['timestamps'], dtype=numpy.int64)
+        known = positions >= 0
+        order = numpy.argsort(timestamps[known], kind='stable')  # The latest of several readings of a room wins
+        positions, timestamps = positions[known][order], timestamps[known][order]
+        values = {field: numpy.asarray(columns[name], dtype=numpy.float32)[known][order]
+                  for name, field in (('temperatures', 'temperature'), ('co2_levels', 'co2_level'))}
+        aggregates = self.session.aggregates
+        units = dict(aggregates.units, **units)
+
+        with self._lock:
+            self._header['sequence'] += 1  # Odd while writing
+            numpy.maximum.at(self._room_table['timestamp'], positions, timestamps)
+            for field, field_values in values.items():
+                read = ~numpy.isnan(field_values)
+                self._room_table[field][positions[read]] = field_values[read]
+            for key, aggregate in aggregates.items():
+                position = self._aggregates.get(key)
+                if position is None:
+                    continue
+                self._aggregate_table[position] = (aggregate.timestamp, aggregate.mean, aggregate.maximum,
+                                                   aggregate.minimum, aggregate.count,
+                                                   self._rooms.get(str(aggregate.maximum_room), -1))
+            for column, measurement_column in enumerate(MEASUREMENT_COLUMNS):
+                self._header['units'][column] = units.get(measurement_column, '').encode('utf-8')[:16]
+            self._header['written'] = time.time()
+            self._header['sequence'] += 1
+
+    def close(self):
+        # The file is left for the readers that still have it open
+        with self._lock:
+            del self._header, self._room_table, self._aggregate_table
+            self._buffer.close()
+            self._file.close()
+
+
+class SharedReadings(object):
+    """
+    Reads a shared readings file in place. Looks up summaries like an
+    AggregateCache, and copies out the rooms read since a previous copy.
+    """
+
+    def __init__(self, path):
+        """ Constructor
+        :type path: str
+        :param path: Shared readings file written by a SharedReadingsWriter
+        """
+        self.path = path
+        with open(path, 'rb') as shared_file:
+            self._inode = os.fstat(shared_file.fileno()).st_ino
+            self._buffer = mmap.mmap(shared_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header = numpy.frombuffer(self._buffer, HEADER_DTYPE, 1)[0]
+        if self._header['magic'] != MAGIC or self._header['layout_version'] != LAYOUT_VERSION:
+            self._buffer.close()
+            raise ValueError(path + ' is not a shared readings file of this version')
+        index, self._room_table, self._aggregate_table = _views(self._buffer, self._header)
+        self.facility = index['facility']
+        self.rooms = [label for label, _, _ in index['rooms']]
+        self._floors = numpy.array([room_floor for _, room_floor, _ in index['rooms']], dtype=numpy.int16)
+        self._wings = [room_wing for _, _, room_wing in index['rooms']]
+        self._aggregates = _aggregate_positions(index['combos'], index['measurements'])
+
+    @property
+    def sequence(self):
+        # Changes whenever readings are written
+        return int(self._header['sequence'])
+
+    def _consistent(self, function):
+        # Retry a read until no write overlapped it
+        started = time.monotonic()
+        while True:
+            sequence = int(self._header['sequence'])
+            if sequence % 2 == 0 or time.monotonic() - started > STALE_WRITE:
+                value = function()
+                if int(self._header['sequence']) == sequence:
+                    return value
+            time.sleep(0)
+
+    def replaced(self):
+        """ Check whether the collector recreated the file since it was opened
+        :rtype: bool
+        """
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return False
+
+    @property
+    def units(self):
+        units = self._consistent(lambda: self._header['units'].copy())
+        return {measurement_column: unit.decode('utf-8') for measurement_column, unit
+                in zip(MEASUREMENT_COLUMNS, units) if unit}
+
+    def _aggregate(self, row):
+        if row['timestamp'] == 0:
+            return None
+        room = self.rooms[row['maximum_room']] if row['maximum_room'] >= 0 else ''
+        return Aggregate(float(row['mean']), float(row['maximum']), room, float(row['minimum']), int(row['count']),
+                         int(row['timestamp']))
+
+    def __len__(self):
+        return len(self.items())
+
+    def get(self, selected_floor, selected_wing, measurement_column):
+        """ Look up the summary of a floor, wing and measurement
+        :rtype: Aggregate
+        :return: The summary, or None if there were no readings for the floor and wing
+        """
+        position = self._aggregates.get((int(selected_floor), str(selected_wing), measurement_column))
+        if position is None:
+            return None
+        return self._aggregate(self._consistent(lambda: self._aggregate_table[position].copy()))
+
+    def items(self):
+        """ Get every summary
+        :rtype: list
+        :return: ((floor, wing, measurement column), Aggregate) pairs
+        """
+        table = self._consistent(self._aggregate_table.copy)
+        items = [(key, self._aggregate(table[position])) for key, position in self._aggregates.items()]
+        return [(key, aggregate) for key, aggregate in items if aggregate is not None]
+
+    def read_since(self, timestamps=None):
+        """ Copy out the rooms read since a previous copy
+        :type timestamps: ndarray
+        :param timestamps: Timestamps of every room returned by the previous call, None for every room read
+        :rtype: tuple
+        :return: The rooms read since, as ReadingsStore.append() arguments, and the timestamps to pass next time
+        """
+        table = self._consistent(self._room_table.copy)
+        read = table['timestamp'] > (0 if timestamps is None else timestamps)
+        positions = numpy.flatnonzero(read)
+        columns = {
+            'timestamps': table['timestamp'][read],
+            'rooms': [self.rooms[position] for position in positions],
+            'floors': self._floors[read],
+            'wings': [self._wings[position] for position in positions],
+            'temperatures': table['temperature'][read],
+            'co2_levels': table['co2_level'][read],
+        }
+        return columns, table['timestamp']
+
+    def close(self):
+        del self._header, self._room_table, self._aggregate_table
+        self._buffer.close()
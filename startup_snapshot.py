@@ -0,0 +1,187 @@
+"""
+#
+# File:              startup_snapshot.py
+# Description:       Small JSON file of the last known state of each facility's
+#                    display: its floors, wings and rooms, and the summaries it
+#                    last showed. The display writes it as readings come in and
+#                    reads it at launch, so the window can be drawn and filled
+#                    before pandas or the archive are loaded. Only the standard
+#                    library is imported here, to keep that path fast.
+#
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+SNAPSHOT_PATH = os.path.join('CSVs', 'display_snapshot.json')
+DEFAULT_WRITE_INTERVAL = 5  # Minimum seconds between writes
+
+# The fields of air_aggregates.Aggregate the display shows
+SnapshotAggregate = namedtuple('SnapshotAggregate', ['mean', 'maximum', 'maximum_room', 'timestamp'])
+
+
+def file_stamp(path):
+    # Modification time and size, to tell whether the room sensor file changed since a snapshot was written
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class Snapshot(object):
+    """
+    Last known state of one facility's display. Looks up summaries like an
+    AggregateCache, so the display can show them the same way.
+    """
+
+    def __init__(self, facility, facilities, rooms, aggregates=None, units=None, written=None):
+        """ Constructor
+        :type facility: str
+        :param facility: Facility displayed
+        :type facilities: list
+        :param facilities: Every facility of the room sensor file, in file order
+        :type rooms: OrderedDict
+        :param rooms: (floor, wing) -> room labels, in floor then wing order
+        :type aggregates: dict
+        :param aggregates: (floor, wing, measurement column) -> SnapshotAggregate
+        :type units: dict
+        :param units: Measurement column -> units
+        :type written: float
+        :param written: Epoch second the snapshot was written, None if it never was
+        """
+        self.facility = facility
+        self.facilities = list(facilities)
+        self.rooms = rooms
+        self.aggregates = aggregates or {}
+        self.units = units or {}
+        self.written = written
+
+    def combos(self):
+        return list(self.rooms)
+
+    def get(self, selected_floor, selected_wing, measurement_column):
+        return self.aggregates.get((int(selected_floor), str(selected_wing), measurement_column))
+
+    @classmethod
+    def from_registry(cls, registry, facilities):
+        """ Build a snapshot without summaries from the room sensor file
+        :type registry: SensorRegistry
+        :param registry: Registry of the facility's rooms
+        :type facilities: list
+        :param facilities: Every facility of the room sensor file
+        :rtype: Snapshot
+        """
+        rooms = OrderedDict((combo, sorted(registry.rooms_in(*combo)['Label'].astype(str)))
+                            for combo in registry.combos())
+        return cls(registry.facility, facilities, rooms)
+
+
+def _read_file(path, sensor_path):
+    # The snapshots of every facility, or None if the file is missing, unreadable or older than the room sensor file
+    try:
+        with open(path) as snapshot_file:
+            content = json.load(snapshot_file)
+        if content.get('sensor_file') != file_stamp(sensor_path):
+            return None
+        return content
+    except (OSError, ValueError):
+        return None
+
+
+def read_snapshot(path, sensor_path, facility=None):
+    """ Read the last known state of a facility's display
+    :type path: str
+    :param path: Snapshot file
+    :type sensor_path: str
+    :param sensor_path: Room sensor file the snapshot must have been written from
+    :type facility: str
+    :param facility: Facility to read, None for the first one of the room sensor file
+    :rtype: Snapshot
+    :return: The snapshot, or None if there is none for the facility and the current room sensor file
+    """
+    content = _read_file(path, sensor_path)
+    if content is None or not content['facilities']:
+        return None
+    facility = content['facilities'][0] if facility is None else facility
+    state = content['by_facility'].get(facility)
+    if state is None:
+        return None
+    rooms = OrderedDict(((combo_floor, combo_wing), labels) for combo_floor, combo_wing, labels in state['rooms'])
+    aggregates = {(combo_floor, combo_wing, measurement_column): SnapshotAggregate(mean, maximum, maximum_room,
+                                                                                  timestamp)
+                  for combo_floor, combo_wing, measurement_column, mean, maximum, maximum_room, timestamp
+                  in state['aggregates']}
+    return Snapshot(facility, content['facilities'], rooms, aggregates, state['units'], state['written'])
+
+
+def write_snapshot(path, sensor_path, snapshot):
+    """ Replace the facility's snapshot, keeping the other facilities' ones
+    :type path: str
+    :param path: Snapshot file
+    :type sensor_path: str
+    :param sensor_path: Room sensor file the snapshot was built from
+    :type snapshot: Snapshot
+    :param snapshot: Snapshot to write
+    """
+    content = _read_file(path, sensor_path) or {'by_facility': {}}
+    content['sensor_file'] = file_stamp(sensor_path)
+    content['facilities'] = snapshot.facilities
+    content['by_facility'][snapshot.facility] = {
+        'written': snapshot.written,
+        'rooms': [[combo_floor, combo_wing, labels] for (combo_floor, combo_wing), labels in snapshot.rooms.items()],
+        'aggregates': [[combo_floor, combo_wing, measurement_column] + list(aggregate)
+                       for (combo_floor, combo_wing, measurement_column), aggregate in snapshot.aggregates.items()],
+        'units': snapshot.units,
+    }
+
+    # Written next to the file then moved over it, so a display starting meanwhile never reads half of it
+    temporary_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as snapshot_file:
+        json.dump(content, snapshot_file)
+    os.replace(temporary_path, path)
+
+
+class SnapshotWriter(object):
+    """
+    Keeps a facility's snapshot up to date with the summaries of a session,
+    writing it at most once per interval. Floors and wings the session has
+    no readings of yet keep the summaries they had.
+    """
+
+    def __init__(self, path, sensor_path, snapshot, interval=DEFAULT_WRITE_INTERVAL):
+        """ Constructor
+        :type path: str
+        :param path: Snapshot file
+        :type sensor_path: str
+        :param sensor_path: Room sensor file the snapshot was built from
+        :type snapshot: Snapshot
+        :param snapshot: Snapshot read at launch, or built from the room sensor file
+        :type interval: float
+        :param interval: Minimum seconds between writes
+        """
+        self.path = path
+        self.sensor_path = sensor_path
+        self.snapshot = snapshot
+        self.interval = interval
+        self._written = None
+        self._lock = threading.Lock()
+
+    def update(self, aggregates, force=False):
+        """ Take the summaries of an AggregateCache, writing them unless the last write was too recent """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._written is not None and now - self._written < self.interval:
+                return
+            self._written = now
+
+            snapshot = self.snapshot
+            for key, aggregate in aggregates.items():
+                snapshot.aggregates[key] = SnapshotAggregate(float(aggregate.mean), float(aggregate.maximum),
+                                                             str(aggregate.maximum_room), int(aggregate.timestamp))
+            snapshot.units.update(aggregates.units)
+            snapshot.written = time.time()
+            try:
+                write_snapshot(self.path, self.sensor_path, snapshot)
+            except OSError as error:
+                print('Could not write ' + self.path + ': ' + str(error))
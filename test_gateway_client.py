@@ -0,0 +1,155 @@
+"""
+#
+# File:              test_gateway_client.py
+# Description:       Tests of the gateway clients against the fake gateway's
+#                    dropped connections, error pages, an open circuit
+#                    breaker, and batch reads with and without gateway
+#                    support. Run with python -m pytest or python -m unittest.
+#
+"""
+
+import math
+import unittest
+
+from async_polling import AsyncPoller
+from bacnet_gateway_requests import (BACnetGatewayClient, CircuitBreaker, is_unavailable, parse_gateway_response,
+                                     DEFAULT_BATCH_SIZE)
+from fake_gateway import FakeGateway
+
+SENSORS = {('ahs', '3001001'): (70.0, 'deg F'), ('ahs', '3001002'): (800.0, 'ppm')}
+PAIRS = list(SENSORS)
+ATTEMPTS = 3
+
+
+class GatewayClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = FakeGateway(sensors=dict(SENSORS))
+        self.gateway.start()
+        self.breaker = CircuitBreaker(failure_threshold=100, reset_timeout=60)
+        self.client = self.make_client(DEFAULT_BATCH_SIZE)
+
+    def tearDown(self):
+        self.client.close()
+        self.gateway.stop()
+
+    def make_client(self, batch_size):
+        return BACnetGatewayClient(self.gateway.hostname, self.gateway.port, max_workers=2, max_attempts=ATTEMPTS,
+                                   backoff_base=0, backoff_cap=0, circuit_breaker=self.breaker, read_timeout=2,
+                                   batch_size=batch_size)
+
+    def test_reads_values_and_units(self):
+        readings = self.client.get_values_and_units(PAIRS)
+        self.assertEqual([reading.units for reading in readings], ['deg F', 'ppm'])
+        self.assertAlmostEqual(readings[0].value, 70.0, delta=1)
+
+    def test_dropped_connection_is_unavailable(self):
+        self.gateway.down = True
+        readings = self.client.get_values_and_units(PAIRS[:1])
+        self.assertTrue(is_unavailable(readings[0]))
+        self.assertEqual(self.gateway.request_count, ATTEMPTS)
+        self.assertEqual(self.breaker.failures, ATTEMPTS)
+
+    def test_error_page_is_unavailable(self):
+        self.gateway.error_rate = 1.0
+        readings = self.client.get_values_and_units(PAIRS)
+        self.assertTrue(all(is_unavailable(reading) for reading in readings))
+        self.assertEqual(self.gateway.request_count, 2 * ATTEMPTS)
+        self.assertEqual(self.breaker.failures, 2 * ATTEMPTS)
+
+    def test_error_page_opens_breaker(self):
+        self.breaker.failure_threshold = 2
+        self.gateway.error_rate = 1.0
+        self.assertTrue(is_unavailable(self.client.get_value_and_units(*PAIRS[0])))
+        self.assertTrue(self.breaker.is_open)
+
+    def test_open_breaker_skips_gateway(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+        readings = self.client.get_values_and_units(PAIRS)
+        self.assertTrue(all(is_unavailable(reading) for reading in readings))
+        self.assertEqual(self.gateway.request_count, 0)
+
+    def test_success_closes_breaker(self):
+        self.gateway.error_rate = 1.0
+        self.client.get_value_and_units(*PAIRS[0])
+        self.gateway.error_rate = 0.0
+        self.assertFalse(is_unavailable(self.client.get_value_and_units(*PAIRS[0])))
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_batch_error_page_is_unavailable(self):
+        self.client.close()
+        self.client = self.make_client(50)
+        self.gateway.error_rate = 1.0
+        readings = self.client.get_values_and_units(PAIRS)
+        self.assertTrue(all(is_unavailable(reading) for reading in readings))
+
+    def test_batch_reads_are_chunked(self):
+        sensors = {('ahs', '30010{0:02d}'.format(number)): (70.0 + number, 'deg F') for number in range(1, 8)}
+        self.gateway.sensors.update(sensors)
+        pairs = sorted(sensors)
+        batch_size = 3
+        self.client.close()
+        self.client = self.make_client(batch_size)
+        readings = self.client.get_values_and_units(pairs)
+        self.assertEqual([reading.units for reading in readings], ['deg F'] * len(pairs))
+        self.assertTrue(self.client.supports_batch)
+        self.assertEqual(self.gateway.request_count, math.ceil(len(pairs) / batch_size))
+
+    def test_gateway_without_batch_reads_falls_back(self):
+        self.gateway.stop()
+        self.gateway = FakeGateway(sensors=dict(SENSORS), batch=False)
+        self.gateway.start()
+        self.client.close()
+        self.client = self.make_client(50)
+        readings = self.client.get_values_and_units(PAIRS)
+        self.assertEqual([reading.units for reading in readings], ['deg F', 'ppm'])
+        self.assertIs(self.client.supports_batch, False)
+        self.assertEqual(self.gateway.request_count, 1 + len(PAIRS))
+
+        # Later reads go straight to single reads
+        self.client.get_values_and_units(PAIRS)
+        self.assertEqual(self.gateway.request_count, 1 + 2 * len(PAIRS))
+
+    def test_unreadable_response_is_unavailable(self):
+        for text in ['<html><body>Bad Gateway</body></html>', '', '[]', '{"bacnet_response": null}']:
+            self.assertTrue(is_unavailable(parse_gateway_response(text)), text)
+
+
+class AsyncPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = FakeGateway(sensors=dict(SENSORS))
+        self.gateway.start()
+        self.breaker = CircuitBreaker(failure_threshold=100, reset_timeout=60)
+        self.poller = AsyncPoller(self.gateway.hostname, self.gateway.port, concurrency=2, max_attempts=ATTEMPTS,
+                                  backoff_base=0, backoff_cap=0, circuit_breaker=self.breaker, read_timeout=2)
+
+    def tearDown(self):
+        self.poller.close()
+        self.gateway.stop()
+
+    def test_reads_values_and_units(self):
+        readings = self.poller.get_values_and_units(PAIRS)
+        self.assertEqual([reading.units for reading in readings], ['deg F', 'ppm'])
+
+    def test_dropped_connection_is_unavailable(self):
+        self.gateway.down = True
+        self.assertTrue(is_unavailable(self.poller.get_values_and_units(PAIRS[:1])[0]))
+        self.assertEqual(self.breaker.failures, ATTEMPTS)
+
+    def test_error_page_is_unavailable(self):
+        self.gateway.error_rate = 1.0
+        readings = self.poller.get_values_and_units(PAIRS)
+        self.assertTrue(all(is_unavailable(reading) for reading in readings))
+        self.assertEqual(self.breaker.failures, 2 * ATTEMPTS)
+
+    def test_open_breaker_skips_gateway(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+        self.assertTrue(is_unavailable(self.poller.get_values_and_units(PAIRS[:1])[0]))
+        self.assertEqual(self.gateway.request_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
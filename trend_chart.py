@@ -0,0 +1,236 @@
+"""
+#
+# File:              trend_chart.py
+# Description:       Line chart of a measurement over time on a Tk canvas.
+#                    Points are decimated to the first, minimum, maximum and
+#                    last of each pixel column, so thousands of readings draw
+#                    as a few hundred vertices, and new readings only redraw
+#                    the newest stretch of the line.
+#
+"""
+
+import math
+import time
+
+import numpy
+
+from tkinter import Canvas
+
+DEFAULT_WIDTH = 900  # Pixels
+DEFAULT_HEIGHT = 220  # Pixels
+DEFAULT_WINDOW = 8 * 60 * 60  # Seconds shown
+CHUNK_COLUMNS = 32  # Pixel columns redrawn as readings arrive, older ones are frozen into their own line
+HEADROOM_COLUMNS = 60  # Empty pixel columns left on the right, so the chart only scrolls every so often
+MIN_SPAN = 2.0  # Smallest range of values on the y axis
+MARGINS = {'left': 55, 'right': 15, 'top': 25, 'bottom': 25}  # Pixels around the plot area
+TICKS = 5
+
+
+def decimate(timestamps, values, start, seconds_per_column):
+    """ Keep the first, minimum, maximum and last point of each pixel column, so the line looks the same
+    :type timestamps: ndarray
+    :param timestamps: Epoch seconds, in increasing order
+    :type values: ndarray
+    :param values: Value at each timestamp, without NaN
+    :type start: float
+    :param start: Epoch second at the left edge of the first column
+    :type seconds_per_column: float
+    :param seconds_per_column: Seconds covered by one pixel column
+    :rtype: tuple
+    :return: The timestamps and values kept, in time order
+    """
+    if len(timestamps) <= 4:
+        return timestamps, values
+    columns = numpy.floor((timestamps - start) / seconds_per_column).astype(numpy.int64)
+    firsts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(columns)) + 1])
+    lasts = numpy.concatenate([firsts[1:], [len(columns)]]) - 1
+
+    # Sorted by column then value, each column starts with its minimum and ends with its maximum
+    by_value = numpy.lexsort((values, columns))
+    kept = numpy.unique(numpy.concatenate([firsts, lasts, by_value[firsts], by_value[lasts]]))
+    return timestamps[kept], values[kept]
+
+
+class TrendChart(object):
+    """
+    The line is drawn as frozen chunks of CHUNK_COLUMNS pixel columns and a
+    live tail. New readings only recompute the tail, a chart that runs out
+    of room scrolls its items instead of redrawing them, and everything is
+    only redrawn when a value falls outside the y axis or a new series is
+    plotted.
+    """
+
+    def __init__(self, master, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, window=DEFAULT_WINDOW):
+        """ Constructor
+        :type master: Widget
+        :param master: Parent of the canvas
+        :type width: int
+        :param width: Width of the canvas, in pixels
+        :type height: int
+        :param height: Height of the canvas, in pixels
+        :type window: float
+        :param window: Seconds shown on the x axis
+        """
+        self.canvas = Canvas(master, width=width, height=height, bg='white', highlightthickness=0)
+        self.width = width
+        self.height = height
+        self.window = window
+        self.plot_width = width - MARGINS['left'] - MARGINS['right']
+        self.plot_height = height - MARGINS['top'] - MARGINS['bottom']
+        self.seconds_per_column = window / self.plot_width
+        self.title = ''
+        self.units = ''
+
+        self._times = numpy.empty(0, dtype=numpy.float64)
+        self._values = numpy.empty(0, dtype=numpy.float64)
+        self._start = 0.0  # Epoch second at the left edge of the plot
+        self._low = 0.0
+        self._high = 1.0
+        self._chunks = []  # (canvas item, epoch second it ends at) of the frozen stretches of the line
+        self._tail = None
+        self._tail_start = 0.0
+
+    def _x(self, timestamp):
+        return MARGINS['left'] + (timestamp - self._start) / self.seconds_per_column
+
+    def _y(self, value):
+        return MARGINS['top'] + (self._high - value) / (self._high - self._low) * self.plot_height
+
+    def _coords(self, first, last):
+        # Canvas coordinates of the points in [first, last), joined to the point before them
+        first = max(0, first - 1)
+        timestamps, values = decimate(self._times[first:last], self._values[first:last], self._start,
+                                      self.seconds_per_column)
+        coords = numpy.empty(2 * len(timestamps))
+        coords[0::2] = self._x(timestamps)
+        coords[1::2] = self._y(values)
+        if len(timestamps) == 1:
+            coords = numpy.concatenate([coords, coords])  # A line needs two points
+        return coords.tolist() if len(coords) else [0, 0, 0, 0]
+
+    def _segment(self, start, end=None):
+        # Indexes of the points from start to end (the newest one if None)
+        first = int(numpy.searchsorted(self._times, start, side='left'))
+        last = len(self._times) if end is None else int(numpy.searchsorted(self._times, end, side='left'))
+        return first, last
+
+    def _draw_time_axis(self):
+        self.canvas.delete('time_axis')
+        bottom = MARGINS['top'] + self.plot_height
+        for tick in range(TICKS + 1):
+            timestamp = self._start + tick * self.window / TICKS
+            x = self._x(timestamp)
+            self.canvas.create_line(x, bottom, x, bottom + 4, fill='Gray', tags='time_axis')
+            self.canvas.create_text(x, bottom + 6, anchor='n', fill='Black', tags='time_axis',
+                                    text=time.strftime('%H:%M', time.gmtime(timestamp)))
+
+    def _draw_value_axis(self):
+        right = MARGINS['left'] + self.plot_width
+        for tick in range(TICKS + 1):
+            value = self._low + tick * (self._high - self._low) / TICKS
+            y = self._y(value)
+            self.canvas.create_line(MARGINS['left'], y, right, y, fill='#E0E0E0', tags='grid')
+            self.canvas.create_text(MARGINS['left'] - 6, y, anchor='e', fill='Black', tags='value_axis',
+                                    text='{0:g}'.format(round(value, 1)))
+        self.canvas.create_text(MARGINS['left'], MARGINS['top'] / 2, anchor='w', fill='Blue', tags='value_axis',
+                                text='{0} ({1})'.format(self.title, self.units) if self.units else self.title)
+        self.canvas.tag_lower('grid')
+
+    def _fit_values(self):
+        low, high = float(numpy.min(self._values)), float(numpy.max(self._values))
+        padding = max((high - low) * 0.1, (MIN_SPAN - (high - low)) / 2)
+        self._low, self._high = low - padding, high + padding
+
+    def _trim(self):
+        first = int(numpy.searchsorted(self._times, self._start, side='left'))
+        if first:
+            self._times, self._values = self._times[first:], self._values[first:]
+
+    def redraw(self):
+        """ Draw the axes and the whole line again """
+        self.canvas.delete('all')
+        self._chunks = []
+        self._tail = None
+        if not len(self._times):
+            self.canvas.create_text(self.width / 2, self.height / 2, fill='Gray', text='No readings to chart yet')
+            return
+
+        self._start = self._times[-1] + HEADROOM_COLUMNS * self.seconds_per_column - self.window
+        self._trim()
+        self._fit_values()
+
+        # Everything but the newest columns is frozen, in one line
+        chunk_seconds = CHUNK_COLUMNS * self.seconds_per_column
+        self._tail_start = self._start + math.floor((self._times[-1] - self._start) / chunk_seconds) * chunk_seconds
+        first, last = self._segment(self._start, self._tail_start)
+        if last > first:
+            item = self.canvas.create_line(*self._coords(first, last), fill='Blue', tags='series')
+            self._chunks.append((item, self._tail_start))
+        self._tail = self.canvas.create_line(*self._coords(*self._segment(self._tail_start)), fill='Blue',
+                                             tags='series')
+
+        # The plot area has no clipping, so lines scrolled past the left edge are hidden behind the margin
+        self.canvas.create_rectangle(0, 0, MARGINS['left'], self.height, fill='white', outline='white',
+                                     tags='margin')
+        self.canvas.create_rectangle(MARGINS['left'], MARGINS['top'], MARGINS['left'] + self.plot_width,
+                                     MARGINS['top'] + self.plot_height, outline='Gray', tags='frame')
+        self._draw_value_axis()
+        self._draw_time_axis()
+
+    def plot(self, timestamps, values, title='', units=''):
+        """ Replace the line with a new series
+        :type timestamps: array-like
+        :param timestamps: Epoch seconds, in increasing order
+        :type values: array-like
+        :param values: Value at each timestamp, NaN where missing
+        """
+        self.title = title
+        self.units = units
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        valid = ~numpy.isnan(values)
+        self._times, self._values = timestamps[valid], values[valid]
+        self.redraw()
+
+    def extend(self, timestamps, values):
+        """ Add readings newer than the ones plotted, redrawing as little as possible """
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        valid = ~numpy.isnan(values)
+        if len(self._times):
+            valid &= timestamps > self._times[-1]
+        if not valid.any():
+            return
+        was_empty = not len(self._times)
+        self._times = numpy.concatenate([self._times, timestamps[valid]])
+        self._values = numpy.concatenate([self._values, values[valid]])
+
+        if was_empty or numpy.min(values[valid]) < self._low or numpy.max(values[valid]) > self._high:
+            self.redraw()
+            return
+
+        # Scroll by whole columns once the newest reading is past the right edge
+        right_edge = self._start + self.window
+        if self._times[-1] > right_edge:
+            columns = math.ceil((self._times[-1] - right_edge) / self.seconds_per_column) + HEADROOM_COLUMNS
+            self._start += columns * self.seconds_per_column
+            self.canvas.move('series', -columns, 0)
+            for item, end in [chunk for chunk in self._chunks if chunk[1] <= self._start]:
+                self.canvas.delete(item)
+            self._chunks = [chunk for chunk in self._chunks if chunk[1] > self._start]
+            self._trim()
+            self.canvas.tag_raise('margin')
+            self.canvas.tag_raise('value_axis')
+            self._draw_time_axis()
+
+        # Freeze the tail once it spans a whole chunk, then redraw what is left of it
+        chunk_seconds = CHUNK_COLUMNS * self.seconds_per_column
+        while self._times[-1] >= self._tail_start + chunk_seconds:
+            end = self._tail_start + chunk_seconds
+            self.canvas.coords(self._tail, *self._coords(*self._segment(self._tail_start, end)))
+            self._chunks.append((self._tail, end))
+            self._tail_start = end
+            self._tail = self.canvas.create_line(0, 0, 0, 0, fill='Blue', tags='series')
+            self.canvas.tag_raise('margin')
+            self.canvas.tag_raise('value_axis')
+        self.canvas.coords(self._tail, *self._coords(*self._segment(self._tail_start)))